@@ -2,42 +2,99 @@
 FastAPI backend for ephemeral chat app.
 Handles auth, message storage, and WebSocket real-time communication.
 """
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, Query, Depends, Request
+from fastapi import (
+    FastAPI, HTTPException, WebSocket, WebSocketDisconnect, Query, Depends, Request, Header, Response
+)
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 from contextlib import asynccontextmanager
-from typing import Dict, Set
+import asyncio
+import json
+import uuid
+from typing import Dict, Set, Optional
+from datetime import datetime, timedelta, timezone
+import os
 import logging
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
-from models import UserSignup, UserLogin, MessageSend, MessageResponse, TokenResponse
-from auth import hash_password, verify_password, create_jwt_token, verify_jwt_token
+from models import (
+    UserSignup, UserLogin, MessageSend, MessageBatch, MessageResponse, TokenResponse, RefreshRequest,
+    ConversationSummary, ConversationPage, SyncPage, MAX_ENCRYPTED_CONTENT, MAX_BATCH_MESSAGES
+)
+from auth import (
+    hash_password, verify_password, create_jwt_token, verify_jwt_token, JWT_EXPIRATION_HOURS,
+    create_refresh_token as new_refresh_token, hash_refresh_token, refresh_token_expiry
+)
 from db import (
     init_db, close_db, create_user, get_user, save_message,
-    get_messages_between, get_contacts
+    create_refresh_token, rotate_refresh_token, revoke_refresh_token,
+    get_messages_between, get_contacts, get_conversations, mark_conversation_read,
+    get_recent_messages_for_user
 )
+from bson import ObjectId
+from bson.errors import InvalidId
 from cache import (
-    init_redis, close_redis, cache_messages, get_cached_messages,
-    invalidate_message_cache, cache_jwt_validation, get_cached_jwt_validation
+    init_redis, close_redis, get_or_load_conversation, invalidate_conversation_cache,
+    cache_jwt_validation, get_cached_jwt_validation, batch_writes, get_pipeline_stats,
+    claim_idempotency_key, store_idempotent_result, release_idempotency_key, IDEMPOTENCY_PENDING,
+    get_version, bump_versions, conversation_version_key, contacts_version_key
 )
+from writer import message_writer, QueueFullError
+from middleware import CompressionMiddleware, BodySizeLimitMiddleware
 
 # Configure logging (avoid sensitive data)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Rate limiter setup
-limiter = Limiter(key_func=get_remote_address)
+# Rate limiter setup (RATE_LIMIT_ENABLED=false for local load testing only).
+# X-RateLimit-* headers (and Retry-After on 429s) let clients pace themselves;
+# limited routes that return plain data take a `response: Response` for them.
+limiter = Limiter(
+    key_func=get_remote_address,
+    enabled=os.getenv("RATE_LIMIT_ENABLED", "true").lower() != "false",
+    headers_enabled=True
+)
+SEND_LIMIT = "30/minute"  # Messages per client, whether sent singly or in batches
+
+# Server-Sent Events tuning
+SSE_KEEPALIVE = 15  # Seconds between comment lines, so proxies don't drop idle streams
+SSE_QUEUE_SIZE = 100  # Events buffered per stream before a slow reader is dropped
+SSE_RETRY_MS = 3000  # Client reconnect delay advertised in the stream
+# Request size budgets (bytes); routes not listed get MAX_BODY_SIZE
+BODY_LIMITS = {
+    "/messages": MAX_ENCRYPTED_CONTENT + 1024,  # Ciphertext plus the JSON envelope
+    "/messages/batch": MAX_BATCH_MESSAGES * (MAX_ENCRYPTED_CONTENT + 256) + 1024,
+    "/signup": 1024,
+    "/login": 1024,
+    "/token/refresh": 1024,
+    "/token/revoke": 1024,
+}
+WS_MAX_MESSAGE_SIZE = 4096  # Clients only send pings; uvicorn --ws-max-size caps frames too
+
+WAIT_LINGER = 0.05  # Seconds a woken long-poll waits for more messages in the same burst
+
+# A send takes its timestamp before its insert commits, so messages can become
+# visible slightly out of cursor order. Sync cursors stay this far behind the
+# newest messages and SSE resumes this far back; clients dedupe by (peer, seq).
+SYNC_OVERLAP = timedelta(seconds=10)
+
 
 # WebSocket connection manager
 class ConnectionManager:
-    """Manages active WebSocket connections for real-time messaging."""
+    """
+    Manages active real-time connections for messaging.
+    WebSockets get events pushed directly; SSE streams (several per user are
+    fine) get them through a queue each.
+    """
     def __init__(self):
         self.active_connections: Dict[str, WebSocket] = {}
+        self.subscribers: Dict[str, Set[asyncio.Queue]] = {}
 
     async def connect(self, username: str, websocket: WebSocket):
         await websocket.accept()
@@ -49,8 +106,32 @@ class ConnectionManager:
             del self.active_connections[username]
             logger.info(f"User {username} disconnected")
 
-    async def send_message(self, username: str, message: dict):
+    def subscribe(self, username: str) -> asyncio.Queue:
+        """Register a queue that receives (event_id, message) for the user."""
+        queue = asyncio.Queue(maxsize=SSE_QUEUE_SIZE)
+        self.subscribers.setdefault(username, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, username: str, queue: asyncio.Queue):
+        queues = self.subscribers.get(username)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self.subscribers[username]
+
+    def is_subscribed(self, username: str, queue: asyncio.Queue) -> bool:
+        return queue in self.subscribers.get(username, ())
+
+    async def send_message(self, username: str, message: dict, event_id: Optional[str] = None):
         """Send a message to a specific user if they're online."""
+        for queue in list(self.subscribers.get(username, ())):
+            try:
+                queue.put_nowait((event_id, message))
+            except asyncio.QueueFull:
+                # The stream ends and the client resumes from its Last-Event-ID
+                logger.warning(f"Dropping slow event stream for {username}")
+                self.unsubscribe(username, queue)
+
         if username in self.active_connections:
             try:
                 await self.active_connections[username].send_json(message)
@@ -65,8 +146,6 @@ manager = ConnectionManager()
 async def lifespan(app: FastAPI):
     """Startup and shutdown events for database/cache connections."""
     # Startup - Initialize DB and Redis in parallel for faster startup
-    import asyncio
-
     async def init_db_safe():
         try:
             await init_db()
@@ -86,8 +165,20 @@ async def lifespan(app: FastAPI):
     # Run both initializations concurrently
     await asyncio.gather(init_db_safe(), init_redis_safe())
 
+    # Write-behind needs both stores, so it starts (and replays) after them
+    try:
+        await message_writer.start()
+    except Exception as e:
+        logger.error(f"Write-behind writer failed to start: {e}")
+
     yield
 
+    # Flush queued messages before the stores go away
+    try:
+        await message_writer.stop()
+    except Exception as e:
+        logger.error(f"Error stopping write-behind writer: {e}")
+
     # Shutdown - Close connections in parallel
     async def close_db_safe():
         try:
@@ -126,6 +217,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress large JSON responses (history, sync pages) per Accept-Encoding
+app.add_middleware(CompressionMiddleware)
+
+# Added last so it runs first: oversized bodies are rejected before anything reads them
+app.add_middleware(BodySizeLimitMiddleware, route_limits=BODY_LIMITS)
+
 
 # Dependency for JWT authentication
 async def get_current_user(token: str = Query(...)) -> str:
@@ -148,7 +245,6 @@ async def get_current_user(token: str = Query(...)) -> str:
 @app.get("/")
 async def root():
     """Health check endpoint with configuration status."""
-    import os
     from db import db
     from cache import redis_client
 
@@ -167,12 +263,18 @@ async def root():
     return config_status
 
 
+@app.get("/metrics")
+async def metrics():
+    """Internal performance counters (no user data)."""
+    return {"cache": get_pipeline_stats(), "message_writer": message_writer.get_stats()}
+
+
 @app.post("/signup", response_model=TokenResponse, status_code=201)
 @limiter.limit("5/minute")  # Strict limit for signup to prevent abuse
-async def signup(request: Request, user: UserSignup):
+async def signup(request: Request, response: Response, user: UserSignup):
     """
     Create a new user account.
-    Returns JWT token immediately so user can start chatting.
+    Returns JWT and refresh tokens immediately so user can start chatting.
     """
     # Hash password with Argon2id
     hashed_pw = hash_password(user.password)
@@ -182,17 +284,14 @@ async def signup(request: Request, user: UserSignup):
     if not success:
         raise HTTPException(status_code=400, detail="Username already exists")
 
-    # Generate JWT token
-    token = create_jwt_token(user.username)
-
     logger.info(f"New user created: {user.username}")
-    return TokenResponse(access_token=token)
+    return await _start_session(user.username)
 
 
 @app.post("/login", response_model=TokenResponse)
 @limiter.limit("10/minute")  # Standard rate limit
-async def login(request: Request, user: UserLogin):
-    """Authenticate user and return JWT token."""
+async def login(request: Request, response: Response, user: UserLogin):
+    """Authenticate user and return JWT and refresh tokens."""
     # Get user from database
     db_user = await get_user(user.username.lower())
     if not db_user:
@@ -202,74 +301,540 @@ async def login(request: Request, user: UserLogin):
     if not verify_password(db_user["hashed_password"], user.password):
         raise HTTPException(status_code=401, detail="Invalid credentials")
 
-    # Generate JWT token
-    token = create_jwt_token(user.username.lower())
+    return await _start_session(user.username.lower())
+
+
+@app.post("/token/refresh", response_model=TokenResponse)
+@limiter.limit("10/minute")
+async def refresh_token(request: Request, response: Response, body: RefreshRequest):
+    """
+    Exchange a refresh token for a new access token and refresh token,
+    without the password (and without an Argon2id verification).
+    Each refresh token works once; reusing one revokes the whole session.
+    """
+    token = new_refresh_token()
+    username = await rotate_refresh_token(
+        hash_refresh_token(body.refresh_token), hash_refresh_token(token), refresh_token_expiry()
+    )
+    if not username:
+        raise HTTPException(status_code=401, detail="Invalid or expired refresh token")
+    return _token_response(username, token)
 
-    return TokenResponse(access_token=token)
+
+@app.post("/token/revoke", status_code=204)
+@limiter.limit("10/minute")
+async def revoke_token(request: Request, body: RefreshRequest):
+    """End a session (logout): its refresh tokens stop working."""
+    await revoke_refresh_token(hash_refresh_token(body.refresh_token))
+    return Response(status_code=204)
+
+
+async def _start_session(username: str) -> TokenResponse:
+    """Tokens for a fresh login: a new refresh token family."""
+    token = new_refresh_token()
+    await create_refresh_token(username, hash_refresh_token(token), uuid.uuid4().hex, refresh_token_expiry())
+    return _token_response(username, token)
+
+
+def _token_response(username: str, refresh: str) -> TokenResponse:
+    return TokenResponse(
+        access_token=create_jwt_token(username),
+        refresh_token=refresh,
+        expires_in=JWT_EXPIRATION_HOURS * 3600
+    )
+
+
+def _batch_cost(request: Request) -> int:
+    """Charge a batch against the send budget once per message it carries."""
+    return getattr(request.state, "batch_size", MAX_BATCH_MESSAGES)
+
+
+async def _counted_batch(request: Request, batch: MessageBatch) -> MessageBatch:
+    """Parse a batch and note its size for _batch_cost."""
+    request.state.batch_size = len(batch.messages)
+    return batch
 
 
 @app.post("/messages", status_code=201)
-@limiter.limit("30/minute")  # Higher limit for actual messaging
-async def send_message(request: Request, message: MessageSend, username: str = Depends(get_current_user)):
+@limiter.shared_limit(SEND_LIMIT, scope="send")  # Higher limit for actual messaging
+async def send_message(
+    request: Request,
+    response: Response,
+    message: MessageSend,
+    username: str = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", max_length=128)
+):
     """
     Send an encrypted message to another user.
     Invalidates cache and notifies recipient via WebSocket if online.
+    With an Idempotency-Key header, a retried request returns the original
+    result without saving, invalidating or pushing a second time.
     """
-    # Save to database
-    saved_msg = await save_message(username, message.recipient, message.encrypted_content)
-
-    # Invalidate cache for both users
-    await invalidate_message_cache(username)
-    await invalidate_message_cache(message.recipient)
-
-    # Notify recipient via WebSocket if online
-    await manager.send_message(message.recipient, {
-        "type": "new_message",
-        "sender": username,
-        "encrypted_content": message.encrypted_content,
-        "timestamp": saved_msg["timestamp"].isoformat()
-    })
-
-    return {"status": "sent", "timestamp": saved_msg["timestamp"]}
+    if idempotency_key:
+        replayed = await _claim_send(username, idempotency_key)
+        if replayed is not None:
+            return JSONResponse(replayed, status_code=201, headers={"Idempotent-Replayed": "true"})
+
+    saved_msg = await _save_sent(username, message, idempotency_key)
+    result = _send_result(saved_msg)
+
+    # Invalidate the cached conversation (shared by both users), bump the ETag
+    # versions it affects and record the idempotent result in one pipeline
+    async with batch_writes():
+        await _record_sent(username, message.recipient, result, idempotency_key)
+
+    # Notify recipient via WebSocket/SSE if online
+    await manager.send_message(
+        message.recipient, _message_event(saved_msg), event_id=_encode_sync_cursor(saved_msg)
+    )
+
+    return result
+
+
+@app.post("/messages/batch", status_code=201)
+@limiter.shared_limit(SEND_LIMIT, scope="send", cost=_batch_cost)
+async def send_message_batch(
+    request: Request,
+    response: Response,
+    batch: MessageBatch = Depends(_counted_batch),
+    username: str = Depends(get_current_user)
+):
+    """
+    Send several queued messages in one request, e.g. a client's offline
+    outbox after it reconnects. Messages are saved in order and each carries
+    its own idempotency key, so re-uploading a batch never duplicates.
+    Each message counts against the same budget as POST /messages.
+    Returns {"results": [...]} in request order: a send result per message,
+    or {"status": "failed", "detail"} for ones the client should retry.
+    Saving stops at the first failure, so a retried message never lands
+    after ones queued behind it.
+    """
+    results, sent = [], []
+    for index, message in enumerate(batch.messages):
+        try:
+            replayed = await _claim_send(username, message.idempotency_key)
+            if replayed is not None:
+                results.append(replayed)
+                continue
+            saved_msg = await _save_sent(username, message, message.idempotency_key)
+        except Exception as e:
+            if isinstance(e, HTTPException):
+                detail = e.detail
+            else:
+                # Storage trouble: keep what was saved, the client retries the rest
+                logger.exception("Batch send failed")
+                detail = "Server error"
+            results.append({"status": "failed", "detail": detail})
+            skipped = len(batch.messages) - index - 1
+            results += [{"status": "failed", "detail": "Not sent, an earlier message failed"}] * skipped
+            break
+        result = _send_result(saved_msg)
+        results.append(result)
+        sent.append((message, saved_msg, result))
+
+    async with batch_writes():
+        for message, _, result in sent:
+            await _record_sent(username, message.recipient, result, message.idempotency_key)
+
+    for message, saved_msg, _ in sent:
+        await manager.send_message(
+            message.recipient, _message_event(saved_msg), event_id=_encode_sync_cursor(saved_msg)
+        )
+
+    return {"results": results}
+
+
+async def _claim_send(username: str, idempotency_key: str) -> Optional[dict]:
+    """Claim an idempotency key. Returns the original result for a replay."""
+    previous = await claim_idempotency_key(username, idempotency_key)
+    if previous == IDEMPOTENCY_PENDING:
+        raise HTTPException(status_code=409, detail="Original request still in progress, retry shortly")
+    return json.loads(previous) if previous is not None else None
+
+
+async def _save_sent(username: str, message: MessageSend, idempotency_key: Optional[str]) -> dict:
+    """Save to database, or enqueue for a batched write when write-behind is on."""
+    try:
+        if message_writer.running:
+            try:
+                return await message_writer.enqueue(username, message.recipient, message.encrypted_content)
+            except QueueFullError:
+                raise HTTPException(status_code=503, detail="Server busy, please retry")
+        # With write-behind on, the writer's allocator numbers these too, even while it's stopped
+        seq = await message_writer.next_sequence(username, message.recipient) if message_writer.enabled else None
+        return await save_message(username, message.recipient, message.encrypted_content, seq)
+    except Exception:
+        # Nothing was saved, so let the client retry with the same key
+        if idempotency_key:
+            await release_idempotency_key(username, idempotency_key)
+        raise
+
+
+def _send_result(saved_msg: dict) -> dict:
+    return {"status": "sent", "timestamp": saved_msg["timestamp"].isoformat(), "seq": saved_msg["seq"]}
+
+
+async def _record_sent(username: str, recipient: str, result: dict, idempotency_key: Optional[str]):
+    """Cache writes for a sent message; call inside batch_writes()."""
+    await invalidate_conversation_cache(username, recipient)
+    await bump_versions(
+        conversation_version_key(username, recipient),
+        contacts_version_key(username),
+        contacts_version_key(recipient)
+    )
+    if idempotency_key:
+        await store_idempotent_result(username, idempotency_key, result)
 
 
 @app.get("/messages/{other_user}", response_model=list[MessageResponse])
 @limiter.limit("20/minute")
-async def get_messages(request: Request, other_user: str, username: str = Depends(get_current_user)):
+async def get_messages(
+    request: Request,
+    response: Response,
+    other_user: str,
+    after_seq: Optional[int] = Query(None, ge=0),
+    if_none_match: Optional[str] = Header(None),
+    username: str = Depends(get_current_user)
+):
     """
     Fetch messages between current user and another user.
-    Uses cache for speed, falls back to database.
+    Uses the per-conversation cache (including cached empty results) and
+    coalesces concurrent misses into a single database query.
+    Pass after_seq to get only messages newer than a known sequence number,
+    e.g. to fill a gap detected from WebSocket events.
+    Reading is side-effect free, so cached reads never touch the database;
+    clients mark a conversation read with POST /conversations/{peer}/read.
+    Supports If-None-Match: an unchanged conversation gets a 304.
+    """
+    version = await get_version(conversation_version_key(username, other_user))
+    if version:
+        etag = _etag(version, "all" if after_seq is None else after_seq)
+        if _etag_matches(if_none_match, etag):
+            return _not_modified(etag)
+        _set_etag(response, etag)
+
+    # Loaded at (or after) `version`, so the body is never older than its ETag
+    return await _conversation_after(username, other_user, after_seq, version)
+
+
+async def _conversation_after(
+    username: str, other_user: str, after_seq: Optional[int], version: Optional[str] = None
+) -> list:
+    """Cached conversation history, optionally only messages after a sequence number."""
+    messages = await get_or_load_conversation(
+        username, other_user,
+        lambda: get_messages_between(username, other_user),
+        version=version
+    )
+    if after_seq is not None:
+        messages = [msg for msg in messages if (msg.get("seq") or 0) > after_seq]
+    return messages
+
+
+@app.get("/messages/{other_user}/wait", response_model=list[MessageResponse])
+@limiter.limit("60/minute")  # Separate budget - an idle long-poll costs ~2 requests a minute
+async def wait_for_messages(
+    request: Request,
+    response: Response,
+    other_user: str,
+    after: int = Query(..., ge=0, description="Last sequence number the client has"),
+    timeout: int = Query(25, ge=1, le=55),
+    username: str = Depends(get_current_user)
+):
     """
-    # Try cache first (cache key is per user, so we need to check both)
-    cached = await get_cached_messages(username)
-    if cached:
-        # Filter for the specific conversation
-        filtered = [
-            msg for msg in cached
-            if (msg["sender"] == other_user and msg["recipient"] == username) or
-               (msg["sender"] == username and msg["recipient"] == other_user)
-        ]
-        if filtered:
-            return filtered
-
-    # Fetch from database
-    messages = await get_messages_between(username, other_user)
-
-    # Cache for next time
-    if messages:
-        await cache_messages(username, messages)
+    Long-poll for messages from other_user newer than `after`.
+    Returns at once if there are any, otherwise holds the request until one
+    arrives (woken by the same in-process fan-out as WebSocket/SSE) or the
+    timeout passes, in which case the list is empty. Like GET /messages it
+    writes nothing: clients mark what they showed with POST /conversations/{peer}/read.
+    """
+    # Subscribe before checking history so a message sent in between still wakes us
+    queue = manager.subscribe(username)
+    try:
+        messages = await _conversation_after(username, other_user, after)
+        if not messages:
+            messages = await _wait_for_events(queue, username, other_user, after, timeout)
+    finally:
+        manager.unsubscribe(username, queue)
 
     return messages
 
 
+async def _wait_for_events(queue: asyncio.Queue, username: str, other_user: str,
+                           after: int, timeout: float) -> list:
+    """
+    Collect new messages from other_user straight from fan-out events, so a
+    wake-up costs no database or cache read (and works before write-behind flushes).
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    messages = []
+    while True:
+        remaining = deadline - loop.time()
+        if messages:
+            # Give a burst of messages a moment to arrive together
+            remaining = min(remaining, WAIT_LINGER)
+        if remaining <= 0:
+            break
+        try:
+            _, event = await asyncio.wait_for(queue.get(), timeout=remaining)
+        except asyncio.TimeoutError:
+            break
+        if event.get("type") == "new_message" and event["sender"] == other_user \
+                and (event.get("seq") or 0) > after:
+            messages.append({**event, "recipient": username})
+    return messages
+
+
 @app.get("/contacts", response_model=list[str])
 @limiter.limit("20/minute")
-async def get_user_contacts(request: Request, username: str = Depends(get_current_user)):
-    """Get list of users the current user has chatted with."""
-    contacts = await get_contacts(username)
+async def get_user_contacts(
+    request: Request,
+    response: Response,
+    limit: int = Query(50, ge=1, le=200),
+    if_none_match: Optional[str] = Header(None),
+    username: str = Depends(get_current_user)
+):
+    """
+    Get users the current user has chatted with, most recent first.
+    Supports If-None-Match: an unchanged list gets a 304.
+    """
+    version = await get_version(contacts_version_key(username))
+    if version:
+        etag = _etag(version, limit)
+        if _etag_matches(if_none_match, etag):
+            return _not_modified(etag)
+        _set_etag(response, etag)
+
+    contacts = await get_contacts(username, limit)
     return contacts
 
 
+def _etag(version: str, variant) -> str:
+    """
+    Weak ETag from a resource version plus the query variant it was served
+    for. Weak because CompressionMiddleware may send the same content gzipped
+    or not, and a strong tag would have to differ between the two.
+    """
+    return f'W/"{version}-{variant}"'
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison, as If-None-Match requires: W/ prefixes are ignored on both sides."""
+    if not if_none_match:
+        return False
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return etag.removeprefix("W/") in tags or "*" in tags
+
+
+def _set_etag(response: Response, etag: str):
+    response.headers["ETag"] = etag
+    # Per-user data: caches may store it but must revalidate every time
+    response.headers["Cache-Control"] = "private, no-cache"
+
+
+def _not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+
+
+def _encode_conversation_cursor(summary: dict) -> str:
+    """Opaque page cursor: last_message_at in epoch ms plus the peer for ties."""
+    timestamp = summary["last_message_at"]
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return f"{int(timestamp.timestamp() * 1000)}:{summary['peer']}"
+
+
+def _decode_conversation_cursor(cursor: str) -> tuple:
+    try:
+        ms, peer = cursor.split(":", 1)
+        return datetime.fromtimestamp(int(ms) / 1000, tz=timezone.utc), peer
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+@app.get("/conversations", response_model=ConversationPage)
+@limiter.limit("20/minute")
+async def list_conversations(
+    request: Request,
+    response: Response,
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = Query(None),
+    username: str = Depends(get_current_user)
+):
+    """
+    List conversations with last message metadata and unread counts.
+    Summaries are maintained incrementally on every send, so this is one query.
+    """
+    before = _decode_conversation_cursor(cursor) if cursor else None
+    summaries = await get_conversations(username, limit, before)
+
+    conversations = [
+        ConversationSummary(unread_count=summary.get("unread", 0), **summary)
+        for summary in summaries
+    ]
+    next_cursor = _encode_conversation_cursor(summaries[-1]) if len(summaries) == limit else None
+    return ConversationPage(conversations=conversations, next_cursor=next_cursor)
+
+
+@app.post("/conversations/{peer}/read", status_code=204)
+@limiter.limit("30/minute")
+async def read_conversation(
+    request: Request, response: Response, peer: str, username: str = Depends(get_current_user)
+):
+    """Mark a conversation as read, e.g. once an open chat has shown its messages."""
+    await mark_conversation_read(username, peer)
+
+
+def _sync_position(message: dict) -> tuple:
+    """A message's place in sync order: (timestamp, _id)."""
+    timestamp = message["timestamp"]
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp, message["_id"]
+
+
+def _encode_sync_cursor(message: dict) -> str:
+    """Opaque sync cursor: message timestamp in epoch ms plus its _id for ties."""
+    return _encode_position(_sync_position(message))
+
+
+def _encode_position(position: tuple) -> str:
+    timestamp, message_id = position
+    return f"{int(timestamp.timestamp() * 1000)}:{message_id}"
+
+
+def _overlap_start(timestamp: datetime) -> tuple:
+    """The position SYNC_OVERLAP before `timestamp`, ahead of any message at that time."""
+    return timestamp - SYNC_OVERLAP, ObjectId("0" * 24)
+
+
+def _decode_sync_cursor(cursor: str) -> tuple:
+    try:
+        ms, message_id = cursor.split(":", 1)
+        return datetime.fromtimestamp(int(ms) / 1000, tz=timezone.utc), ObjectId(message_id)
+    except (ValueError, InvalidId):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+@app.get("/sync", response_model=SyncPage)
+@limiter.limit("20/minute")
+async def sync(
+    request: Request,
+    response: Response,
+    cursor: Optional[str] = Query(None),
+    limit: int = Query(200, ge=1, le=1000),
+    username: str = Depends(get_current_user)
+):
+    """
+    Everything sent to or by the user since `cursor`, across all conversations.
+    Without a cursor, starts from the beginning of the 24h retention window.
+    The last page's cursor stays SYNC_OVERLAP behind the present, so the next
+    sync repeats recent messages (dedupe by peer and seq) rather than skipping
+    one that committed late.
+    """
+    after = _decode_sync_cursor(cursor) if cursor else None
+
+    # Fetch one extra to know whether another page follows
+    messages = await get_recent_messages_for_user(username, after=after, limit=limit + 1)
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+
+    if not messages:
+        next_cursor = cursor
+    elif has_more:
+        next_cursor = _encode_sync_cursor(messages[-1])
+    else:
+        settled = _overlap_start(datetime.now(timezone.utc))
+        if after:
+            settled = max(settled, after)  # Never hand back an earlier cursor than we were given
+        next_cursor = _encode_position(min(_sync_position(messages[-1]), settled))
+    return SyncPage(messages=messages, cursor=next_cursor, has_more=has_more)
+
+
+def _message_event(message: dict) -> dict:
+    """Real-time event payload for a stored message."""
+    timestamp = message["timestamp"]
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return {
+        "type": "new_message",
+        "sender": message["sender"],
+        "encrypted_content": message["encrypted_content"],
+        "timestamp": timestamp.isoformat(),
+        "seq": message.get("seq")
+    }
+
+
+def _format_sse(event_id: Optional[str], message: dict) -> str:
+    lines = [f"id: {event_id}"] if event_id else []
+    lines.append(f"event: {message['type']}")
+    lines.append(f"data: {json.dumps(message)}")
+    return "\n".join(lines) + "\n\n"
+
+
+async def event_stream(request: Request, username: str, after: Optional[tuple]):
+    """
+    Yield SSE frames: first anything missed since `after`, then live events.
+    The replay starts SYNC_OVERLAP before `after`, so a message that committed
+    after a later one isn't skipped; clients drop the repeats by seq.
+    Subscribes before replaying so nothing sent in between is lost; live events
+    already covered by the replay are skipped.
+    """
+    queue = manager.subscribe(username)
+    try:
+        yield f"retry: {SSE_RETRY_MS}\n\n"
+
+        # Replay in sync-sized pages; only messages sent to the user are events
+        replayed = set()
+        position = _overlap_start(after[0]) if after else None
+        while position is not None:
+            page = await get_recent_messages_for_user(username, after=position, limit=200)
+            for msg in page:
+                if msg["recipient"] == username:
+                    event_id = _encode_sync_cursor(msg)
+                    replayed.add(event_id)
+                    yield _format_sse(event_id, _message_event(msg))
+            if page:
+                position = _sync_position(page[-1])
+            if len(page) < 200:
+                break
+
+        while manager.is_subscribed(username, queue):
+            try:
+                event_id, message = await asyncio.wait_for(queue.get(), timeout=SSE_KEEPALIVE)
+            except asyncio.TimeoutError:
+                if await request.is_disconnected():
+                    break
+                yield ": keepalive\n\n"
+                continue
+            if event_id in replayed:
+                continue
+            yield _format_sse(event_id, message)
+    finally:
+        manager.unsubscribe(username, queue)
+
+
+@app.get("/events")
+@limiter.limit("10/minute")
+async def events(
+    request: Request,
+    last_event_id: Optional[str] = Header(None, alias="Last-Event-ID"),
+    username: str = Depends(get_current_user)
+):
+    """
+    Server-Sent Events stream of new messages, for clients whose proxies
+    block WebSocket upgrades. Event ids are sync cursors, so a reconnecting
+    client that sends Last-Event-ID gets what it missed (plus a short overlap).
+    """
+    after = _decode_sync_cursor(last_event_id) if last_event_id else None
+    return StreamingResponse(
+        event_stream(request, username, after),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 @app.websocket("/ws/{username}")
 async def websocket_endpoint(websocket: WebSocket, username: str, token: str = Query(...)):
     """
@@ -287,7 +852,12 @@ async def websocket_endpoint(websocket: WebSocket, username: str, token: str = Q
     try:
         while True:
             # Keep connection alive, handle ping/pong
-            data = await websocket.receive_json()
+            text = await websocket.receive_text()
+            if len(text) > WS_MAX_MESSAGE_SIZE:
+                await websocket.close(code=1009)  # Message too big
+                manager.disconnect(username)
+                return
+            data = json.loads(text)
 
             # Handle different message types if needed
             if data.get("type") == "ping":
@@ -1,8 +1,12 @@
 """
 Auth utilities: password hashing with Argon2id and JWT token management.
 Argon2id is the gold standard for password hashing - slower by design.
+Refresh tokens are random and high-entropy, so a fast SHA-256 is enough to
+store them safely - renewing a session never pays for Argon2id again.
 """
 import os
+import hashlib
+import secrets
 from datetime import datetime, timedelta, timezone
 from argon2 import PasswordHasher
 from argon2.exceptions import VerifyMismatchError
@@ -12,6 +16,7 @@ import jwt
 JWT_SECRET = os.getenv("JWT_SECRET", "dev-secret-change-in-production")
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_HOURS = 1
+REFRESH_TOKEN_DAYS = int(os.getenv("REFRESH_TOKEN_DAYS", "30"))
 
 # Argon2 hasher with reasonable defaults for free-tier performance
 ph = PasswordHasher(
@@ -64,3 +69,18 @@ def verify_jwt_token(token: str) -> str | None:
         return None
     except jwt.InvalidTokenError:
         return None
+
+
+def create_refresh_token() -> str:
+    """Create an opaque refresh token (only its hash is stored server-side)."""
+    return secrets.token_urlsafe(32)
+
+
+def hash_refresh_token(token: str) -> str:
+    """Storage key for a refresh token."""
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def refresh_token_expiry() -> datetime:
+    """Expiry for a newly issued refresh token. Each rotation extends the session."""
+    return datetime.now(timezone.utc) + timedelta(days=REFRESH_TOKEN_DAYS)
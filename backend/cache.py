@@ -5,10 +5,21 @@ Async operations optimized for performance within free tier constraints.
 """
 import os
 import json
-from typing import Optional, List
+import time
+import uuid
+import random
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Optional, List, Dict, Set, Tuple, Callable, Awaitable
 from redis.asyncio import Redis, ConnectionPool
 from datetime import datetime
 
+from codec import encode_messages, decode_messages, is_encoded
+
+logger = logging.getLogger(__name__)
+
 # Redis connection from env
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
 
@@ -16,11 +27,61 @@ REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
 pool: Optional[ConnectionPool] = None
 redis_client: Optional[Redis] = None
 
+# Conversation cache tuning
+EMPTY_CONVERSATION_TTL = 30  # Short TTL so brand-new conversations appear quickly
+TTL_JITTER = 0.1  # Spread expiries +/-10% so hot keys don't all expire together
+LOAD_LOCK_MS = 3000  # Cross-worker lock held while one worker reloads a key
+LOCK_WAIT_INTERVAL = 0.05  # Seconds between cache checks while another worker loads
+LOCK_WAIT_ATTEMPTS = 20
+
+# Idempotency keys for POST /messages
+IDEMPOTENCY_TTL = 86400  # How long a completed result is replayed for duplicates
+IDEMPOTENCY_PENDING_TTL = 30  # Short, so a crashed request doesn't block retries for long
+IDEMPOTENCY_PENDING = b"pending"
+
+# Resource version counters behind ETags
+VERSION_TTL = 172800  # Outlives the 24h message retention
+
+# In-flight loads per cache key, with the conversation version each started
+# at, so concurrent misses share one DB query
+_inflight: Dict[str, Tuple[Optional[str], asyncio.Task]] = {}
+
+# Store a loaded conversation only if its version hasn't moved since the load
+# started - a load that raced a send would otherwise cache stale history
+_CACHE_IF_CURRENT = """
+if redis.call('get', KEYS[2]) == ARGV[1] then
+    return redis.call('setex', KEYS[1], ARGV[2], ARGV[3])
+end
+return false
+"""
+
+# Release a lock only while we still hold it; it may have expired and been re-taken
+_RELEASE_LOCK = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Command batching: commands issued in the same event-loop tick share one pipeline
+_pending_commands: List[tuple] = []
+_flush_scheduled = False
+_batch_tasks: Set[asyncio.Task] = set()  # Held so running batches aren't garbage-collected
+
+# Writes issued inside batch_writes() are collected here and sent on exit
+_write_scope: ContextVar[Optional[List[tuple]]] = ContextVar("cache_write_scope", default=None)
+
+# Counters for /metrics - round_trips_saved shows what batching buys us
+pipeline_stats = {"commands": 0, "round_trips": 0, "pipelines": 0}
+
 
 async def init_redis():
     """Initialize Redis connection pool. Call this on startup."""
-    global pool, redis_client
-    pool = ConnectionPool.from_url(REDIS_URL, decode_responses=True)
+    global pool, redis_client, _flush_scheduled
+    # Raw bytes so binary message lists round-trip; text values use _text()
+    pool = ConnectionPool.from_url(REDIS_URL, decode_responses=False)
+    _pending_commands.clear()
+    _flush_scheduled = False
     redis_client = Redis(connection_pool=pool)
 
 
@@ -32,35 +93,126 @@ async def close_redis():
         await pool.aclose()
 
 
-async def cache_messages(username: str, messages: List[dict], ttl: int = 300):
+def get_pipeline_stats() -> dict:
+    """Batching counters: commands sent, round trips used and round trips saved."""
+    stats = dict(pipeline_stats)
+    stats["round_trips_saved"] = stats["commands"] - stats["round_trips"]
+    return stats
+
+
+async def _send(commands: List[tuple]) -> list:
     """
-    Cache messages for a user. TTL defaults to 5 minutes.
-    Stores as JSON string for simplicity.
+    Send commands to Redis in a single round trip.
+    Returns one result per command, with exceptions in place of failed commands.
     """
     if not redis_client:
-        return
+        return [None] * len(commands)
 
-    key = f"messages:{username}"
-    # Convert datetime objects to ISO strings for JSON serialization
-    serializable_msgs = []
-    for msg in messages:
-        msg_copy = msg.copy()
-        if isinstance(msg_copy.get('timestamp'), datetime):
-            msg_copy['timestamp'] = msg_copy['timestamp'].isoformat()
-        serializable_msgs.append(msg_copy)
+    pipeline_stats["commands"] += len(commands)
+    pipeline_stats["round_trips"] += 1
 
-    await redis_client.setex(key, ttl, json.dumps(serializable_msgs))
+    # A lone command gains nothing from a pipeline, so send it directly
+    if len(commands) == 1:
+        command, args, kwargs = commands[0]
+        try:
+            return [await getattr(redis_client, command)(*args, **kwargs)]
+        except Exception as e:
+            return [e]
 
+    pipeline_stats["pipelines"] += 1
+    pipe = redis_client.pipeline(transaction=False)
+    for command, args, kwargs in commands:
+        getattr(pipe, command)(*args, **kwargs)
+    try:
+        return await pipe.execute(raise_on_error=False)
+    except Exception as e:
+        return [e] * len(commands)
 
-async def get_cached_messages(username: str) -> Optional[List[dict]]:
-    """Retrieve cached messages for a user. Returns None if not cached."""
-    if not redis_client:
-        return None
 
-    key = f"messages:{username}"
-    data = await redis_client.get(key)
-    if not data:
+def _flush_pending():
+    """Send everything queued during the last tick. Scheduled via call_soon."""
+    global _pending_commands, _flush_scheduled
+    batch, _pending_commands = _pending_commands, []
+    _flush_scheduled = False
+    task = asyncio.ensure_future(_run_batch(batch))
+    _batch_tasks.add(task)
+    task.add_done_callback(_batch_done)
+
+
+def _batch_done(task: asyncio.Task):
+    _batch_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Redis batch failed: {task.exception()}")
+
+
+async def _run_batch(batch: List[tuple]):
+    """Execute a tick's worth of commands and resolve their futures."""
+    results = await _send([(command, args, kwargs) for command, args, kwargs, _ in batch])
+    for (_, _, _, future), result in zip(batch, results):
+        if future.done():
+            continue
+        if isinstance(result, Exception):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+
+async def _execute(command: str, *args, **kwargs):
+    """
+    Run a Redis command through the per-tick batcher.
+    Commands from concurrent coroutines issued in the same event-loop tick
+    are sent together as one pipeline.
+    """
+    global _flush_scheduled
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    _pending_commands.append((command, args, kwargs, future))
+    if not _flush_scheduled:
+        _flush_scheduled = True
+        loop.call_soon(_flush_pending)
+    return await future
+
+
+async def _execute_write(command: str, *args, **kwargs):
+    """
+    Run a fire-and-forget write. Inside batch_writes() it is deferred until
+    the scope exits; otherwise it goes through the per-tick batcher.
+    """
+    scope = _write_scope.get()
+    if scope is not None:
+        scope.append((command, args, kwargs))
         return None
+    return await _execute(command, *args, **kwargs)
+
+
+@asynccontextmanager
+async def batch_writes():
+    """
+    Request scope that collects cache writes and sends them as one pipeline
+    on exit. Reads inside the scope won't see the deferred writes.
+    """
+    commands: List[tuple] = []
+    token = _write_scope.set(commands)
+    try:
+        yield
+    finally:
+        _write_scope.reset(token)
+        if commands:
+            await _send(commands)
+
+
+def _text(value) -> Optional[str]:
+    """Decode a raw Redis reply to str (the pool returns bytes)."""
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+def _load_messages(data) -> Optional[List[dict]]:
+    """
+    Decode a cached message list. Handles the binary format and legacy JSON
+    entries written before it; unknown binary versions count as a miss.
+    """
+    if is_encoded(data):
+        return decode_messages(data)
 
     messages = json.loads(data)
     # Convert ISO strings back to datetime objects
@@ -71,22 +223,13 @@ async def get_cached_messages(username: str) -> Optional[List[dict]]:
     return messages
 
 
-async def invalidate_message_cache(username: str):
-    """Invalidate cached messages when new messages arrive."""
-    if not redis_client:
-        return
-
-    key = f"messages:{username}"
-    await redis_client.delete(key)
-
-
 async def cache_jwt_validation(token: str, username: str, ttl: int = 300):
     """Cache JWT validation result. TTL matches token lifetime."""
     if not redis_client:
         return
 
     key = f"jwt:{token}"
-    await redis_client.setex(key, ttl, username)
+    await _execute_write("setex", key, ttl, username)
 
 
 async def get_cached_jwt_validation(token: str) -> Optional[str]:
@@ -95,7 +238,7 @@ async def get_cached_jwt_validation(token: str) -> Optional[str]:
         return None
 
     key = f"jwt:{token}"
-    return await redis_client.get(key)
+    return _text(await _execute("get", key))
 
 
 async def invalidate_jwt_cache(token: str):
@@ -104,4 +247,213 @@ async def invalidate_jwt_cache(token: str):
         return
 
     key = f"jwt:{token}"
-    await redis_client.delete(key)
+    await _execute_write("delete", key)
+
+
+def conversation_version_key(user1: str, user2: str) -> str:
+    first, second = sorted((user1, user2))
+    return f"version:conversation:{first}:{second}"
+
+
+def contacts_version_key(username: str) -> str:
+    return f"version:contacts:{username}"
+
+
+async def get_version(key: str) -> Optional[str]:
+    """
+    Current version of a resource, for ETags. Missing counters start at the
+    current time in ns, so a counter recreated after expiry or a Redis flush
+    never repeats a version a client may still hold.
+    """
+    if not redis_client:
+        return None
+
+    # Same tick, so SET NX and GET go out as one pipeline, in order
+    _, version = await asyncio.gather(
+        _execute("set", key, time.time_ns(), nx=True, ex=VERSION_TTL),
+        _execute("get", key)
+    )
+    return _text(version)
+
+
+async def bump_versions(*keys: str):
+    """Advance resource versions after a change. Batch with batch_writes()."""
+    if not redis_client:
+        return
+
+    for key in keys:
+        await _execute_write("set", key, time.time_ns(), nx=True, ex=VERSION_TTL)
+        await _execute_write("incr", key)
+        await _execute_write("expire", key, VERSION_TTL)
+
+
+def idempotency_key(username: str, key: str) -> str:
+    """Idempotency keys are scoped per user so clients can't collide."""
+    return f"idempotency:{username}:{key}"
+
+
+async def claim_idempotency_key(username: str, key: str) -> Optional[bytes]:
+    """
+    Claim an idempotency key for a new request (SET NX).
+    Returns None if this request owns the key, otherwise the stored value:
+    IDEMPOTENCY_PENDING while the first request is still running, or its result.
+    """
+    if not redis_client:
+        return None
+
+    cache_key = idempotency_key(username, key)
+    if await _execute("set", cache_key, IDEMPOTENCY_PENDING, nx=True, ex=IDEMPOTENCY_PENDING_TTL):
+        return None
+    # Only duplicates pay for the second round trip
+    return await _execute("get", cache_key)
+
+
+async def store_idempotent_result(username: str, key: str, result: dict, ttl: int = IDEMPOTENCY_TTL):
+    """Store a completed request's result so duplicates get the same response."""
+    if not redis_client:
+        return
+
+    await _execute_write("set", idempotency_key(username, key), json.dumps(result), ex=ttl)
+
+
+async def release_idempotency_key(username: str, key: str):
+    """Drop a claimed key after a failed request so the client can retry it."""
+    if not redis_client:
+        return
+
+    await _execute_write("delete", idempotency_key(username, key))
+
+
+def conversation_key(user1: str, user2: str) -> str:
+    """Cache key shared by both participants of a conversation."""
+    first, second = sorted((user1, user2))
+    return f"conversation:{first}:{second}"
+
+
+def _jittered(ttl: int) -> int:
+    """Randomize a TTL slightly to avoid synchronized expiry."""
+    spread = int(ttl * TTL_JITTER)
+    return ttl + random.randint(-spread, spread) if spread else ttl
+
+
+async def cache_conversation(
+    user1: str, user2: str, messages: List[dict], ttl: int = 300, version: Optional[str] = None
+):
+    """
+    Cache a conversation's messages. Empty results are cached too (negative
+    caching) but only for EMPTY_CONVERSATION_TTL seconds. With `version`,
+    nothing is stored unless the conversation is still at that version.
+    """
+    if not redis_client:
+        return
+
+    key = conversation_key(user1, user2)
+    ttl = _jittered(ttl if messages else EMPTY_CONVERSATION_TTL)
+    if version is None:
+        await _execute_write("setex", key, ttl, encode_messages(messages))
+    else:
+        await _execute(
+            "eval", _CACHE_IF_CURRENT, 2, key, conversation_version_key(user1, user2),
+            version, ttl, encode_messages(messages)
+        )
+
+
+async def get_cached_conversation(user1: str, user2: str) -> Optional[List[dict]]:
+    """
+    Retrieve a cached conversation. Returns None on a miss; an empty list
+    means the conversation is known to be empty.
+    """
+    if not redis_client:
+        return None
+
+    data = await _execute("get", conversation_key(user1, user2))
+    if data is None:
+        return None
+
+    return _load_messages(data)
+
+
+async def invalidate_conversation_cache(user1: str, user2: str):
+    """Invalidate a cached conversation when a new message is sent in it."""
+    # A load already running may have read the database before the send;
+    # later readers start a fresh one instead of sharing its result
+    _inflight.pop(conversation_key(user1, user2), None)
+    if not redis_client:
+        return
+
+    await _execute_write("delete", conversation_key(user1, user2))
+
+
+async def get_or_load_conversation(
+    user1: str,
+    user2: str,
+    loader: Callable[[], Awaitable[List[dict]]],
+    ttl: int = 300,
+    version: Optional[str] = None
+) -> List[dict]:
+    """
+    Read-through cache for a conversation with stampede protection.
+    Concurrent misses in this process share a single loader call, and a short
+    Redis lock stops other workers from reloading the same key at the same time.
+    Pass the conversation `version` the caller read (e.g. for an ETag): the
+    result is then never older than that version, since only loads started
+    at it are shared.
+    """
+    cached = await get_cached_conversation(user1, user2)
+    if cached is not None:
+        return cached
+
+    key = conversation_key(user1, user2)
+    entry = _inflight.get(key)
+    if entry is None or (version is not None and entry[0] != version):
+        task = asyncio.create_task(_load_conversation(user1, user2, loader, ttl, version))
+        entry = (version, task)
+        _inflight[key] = entry
+        task.add_done_callback(
+            lambda done: _inflight.pop(key, None) if _inflight.get(key, (None, None))[1] is done else None
+        )
+
+    # Shield so one cancelled request doesn't cancel the load for everyone else
+    return await asyncio.shield(entry[1])
+
+
+async def _load_conversation(
+    user1: str,
+    user2: str,
+    loader: Callable[[], Awaitable[List[dict]]],
+    ttl: int,
+    version: Optional[str] = None
+) -> List[dict]:
+    """
+    Load a conversation from the database, holding the cross-worker lock if possible.
+    The result is cached only if no message was sent since `version` (read
+    here if not given).
+    """
+    if not redis_client:
+        return await loader()
+
+    lock_key = f"lock:{conversation_key(user1, user2)}"
+    token = uuid.uuid4().hex
+    if version is None:
+        version, acquired = await asyncio.gather(
+            get_version(conversation_version_key(user1, user2)),
+            _execute("set", lock_key, token, nx=True, px=LOAD_LOCK_MS)
+        )
+    else:
+        acquired = await _execute("set", lock_key, token, nx=True, px=LOAD_LOCK_MS)
+
+    if not acquired:
+        # Another worker is already loading - give it a moment to fill the cache
+        for _ in range(LOCK_WAIT_ATTEMPTS):
+            await asyncio.sleep(LOCK_WAIT_INTERVAL)
+            cached = await get_cached_conversation(user1, user2)
+            if cached is not None:
+                return cached
+
+    try:
+        messages = await loader()
+        await cache_conversation(user1, user2, messages, ttl, version=version)
+        return messages
+    finally:
+        if acquired:
+            await _execute("eval", _RELEASE_LOCK, 1, lock_key, token)
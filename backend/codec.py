@@ -0,0 +1,118 @@
+"""
+Compact binary encoding for cached message lists.
+Stores messages column by column so each column decodes in a single C-level call,
+instead of JSON parsing plus a per-message timestamp conversion loop.
+
+Layout (little-endian), version 2:
+    magic "CM" | version u8 | count u32
+    names: count u16, then each name as u8 length + utf-8 bytes
+    sender name index   count x u16
+    recipient name index count x u16
+    timestamps          count x i64 (epoch milliseconds, UTC)
+    sequence numbers    count x i64 (0 for messages stored before sequencing)
+    content lengths     count x u32 (characters)
+    content             utf-8 blob of all encrypted_content strings joined
+"""
+import struct
+from datetime import datetime, timedelta, timezone
+from itertools import accumulate, repeat
+from operator import truediv
+from typing import List, Optional
+
+MAGIC = b"CM"
+VERSION = 2
+
+_HEADER = struct.Struct("<2sBI")
+_EPOCH = datetime(1970, 1, 1)  # Mongo hands back naive UTC datetimes
+_ONE_MS = timedelta(milliseconds=1)
+
+
+def _to_ms(timestamp: datetime) -> int:
+    """Convert a datetime (naive UTC or aware) to epoch milliseconds."""
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return (timestamp - _EPOCH) // _ONE_MS
+
+
+def is_encoded(data: bytes) -> bool:
+    """Check whether a cached value uses this binary format (any version)."""
+    return isinstance(data, bytes) and data[:2] == MAGIC
+
+
+def encode_messages(messages: List[dict]) -> bytes:
+    """
+    Encode messages to the compact binary format.
+    Only client-visible fields are kept - Mongo's _id is dropped.
+    """
+    names: dict[str, int] = {}
+    senders = [names.setdefault(msg["sender"], len(names)) for msg in messages]
+    recipients = [names.setdefault(msg["recipient"], len(names)) for msg in messages]
+    contents = [msg["encrypted_content"] for msg in messages]
+    count = len(messages)
+
+    parts = [_HEADER.pack(MAGIC, VERSION, count), struct.pack("<H", len(names))]
+    for name in names:
+        encoded = name.encode("utf-8")
+        parts.append(struct.pack("<B", len(encoded)))
+        parts.append(encoded)
+
+    parts.append(struct.pack(f"<{count}H", *senders))
+    parts.append(struct.pack(f"<{count}H", *recipients))
+    parts.append(struct.pack(f"<{count}q", *[_to_ms(msg["timestamp"]) for msg in messages]))
+    parts.append(struct.pack(f"<{count}q", *[msg.get("seq") or 0 for msg in messages]))
+    parts.append(struct.pack(f"<{count}I", *map(len, contents)))
+    parts.append("".join(contents).encode("utf-8"))
+
+    return b"".join(parts)
+
+
+def decode_messages(data: bytes) -> Optional[List[dict]]:
+    """
+    Decode the binary format back to message dicts with UTC-aware timestamps.
+    Returns None for unknown versions so callers treat them as a cache miss.
+    """
+    magic, version, count = _HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        return None
+
+    offset = _HEADER.size
+    (name_count,) = struct.unpack_from("<H", data, offset)
+    offset += 2
+    names = []
+    for _ in range(name_count):
+        length = data[offset]
+        names.append(data[offset + 1:offset + 1 + length].decode("utf-8"))
+        offset += 1 + length
+
+    # Each column is unpacked in one call
+    senders = struct.unpack_from(f"<{count}H", data, offset)
+    offset += 2 * count
+    recipients = struct.unpack_from(f"<{count}H", data, offset)
+    offset += 2 * count
+    timestamps = struct.unpack_from(f"<{count}q", data, offset)
+    offset += 8 * count
+    seqs = struct.unpack_from(f"<{count}q", data, offset)
+    offset += 8 * count
+    lengths = struct.unpack_from(f"<{count}I", data, offset)
+    offset += 4 * count
+    content = data[offset:].decode("utf-8")
+
+    ends = list(accumulate(lengths))
+    starts = [0] + ends[:-1]
+    # Timestamp conversion runs entirely inside map() - no Python-level calls
+    datetimes = map(
+        datetime.fromtimestamp, map(truediv, timestamps, repeat(1000)), repeat(timezone.utc)
+    )
+
+    return [
+        {
+            "sender": names[sender],
+            "recipient": names[recipient],
+            "encrypted_content": content[start:end],
+            "timestamp": timestamp,
+            "seq": seq or None,
+        }
+        for sender, recipient, start, end, timestamp, seq in zip(
+            senders, recipients, starts, ends, datetimes, seqs
+        )
+    ]
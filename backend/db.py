@@ -5,11 +5,13 @@ Using motor (async PyMongo) for better performance with FastAPI.
 import os
 import sys
 import ssl
-from typing import Optional, List
+import asyncio
+from typing import Optional, List, Tuple
 from datetime import datetime, timedelta, timezone
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
-from pymongo import ASCENDING, IndexModel
-from pymongo.errors import DuplicateKeyError
+from pymongo import ASCENDING, DESCENDING, IndexModel, UpdateOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+from bson import ObjectId
 
 # MongoDB connection from env
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
@@ -20,6 +22,14 @@ client: Optional[AsyncIOMotorClient] = None
 db: Optional[AsyncIOMotorDatabase] = None
 
 
+class SequenceConflictError(Exception):
+    """Raised by save_messages for messages whose (conversation, seq) was already taken."""
+
+    def __init__(self, messages: List[dict]):
+        super().__init__(f"{len(messages)} message(s) reused a sequence number")
+        self.messages = messages
+
+
 async def init_db():
     """
     Initialize MongoDB connection and create indexes.
@@ -87,12 +97,25 @@ async def init_db():
     await db.users.create_index([("username", ASCENDING)], unique=True)
 
     # Create indexes for messages collection
-    # Compound index for efficient recipient+timestamp queries
+    # Compound indexes for efficient sender/recipient + timestamp queries.
+    # _id is included so /sync can page in (timestamp, _id) order from both sides of its $or
     await db.messages.create_index([
         ("recipient", ASCENDING),
-        ("timestamp", ASCENDING)
+        ("timestamp", ASCENDING),
+        ("_id", ASCENDING)
     ])
-    await db.messages.create_index([("sender", ASCENDING)])
+    await db.messages.create_index([
+        ("sender", ASCENDING),
+        ("timestamp", ASCENDING),
+        ("_id", ASCENDING)
+    ])
+
+    # Per-conversation sequence numbers are unique (older messages have none)
+    await db.messages.create_index(
+        [("conversation", ASCENDING), ("seq", ASCENDING)],
+        unique=True,
+        partialFilterExpression={"seq": {"$exists": True}}
+    )
 
     # TTL index to auto-delete messages after 24 hours
     await db.messages.create_index(
@@ -100,6 +123,15 @@ async def init_db():
         expireAfterSeconds=86400  # 24 hours in seconds
     )
 
+    # Contacts: one document per (owner, peer), listed most recent first
+    await db.contacts.create_index([("owner", ASCENDING), ("peer", ASCENDING)], unique=True)
+    # peer breaks last_message_at ties in get_conversations' page order, so it's in the index too
+    await db.contacts.create_index([("owner", ASCENDING), ("last_message_at", DESCENDING), ("peer", ASCENDING)])
+
+    # Refresh tokens: keyed by hash, removed by TTL once expired, revoked per family
+    await db.refresh_tokens.create_index([("expires_at", ASCENDING)], expireAfterSeconds=0)
+    await db.refresh_tokens.create_index([("family", ASCENDING)])
+
 
 async def close_db():
     """Close MongoDB connection. Call this on shutdown."""
@@ -115,7 +147,6 @@ async def create_user(username: str, hashed_password: str) -> bool:
         await db.users.insert_one({
             "username": username,
             "hashed_password": hashed_password,
-            "contacts": [],
             "created_at": datetime.now(timezone.utc)
         })
         return True
@@ -128,51 +159,254 @@ async def get_user(username: str) -> Optional[dict]:
     return await db.users.find_one({"username": username})
 
 
-async def add_contact(username: str, contact: str):
+async def create_refresh_token(username: str, token_hash: str, family: str, expires_at: datetime):
+    """Store a refresh token. A family is one login session's chain of rotated tokens."""
+    await db.refresh_tokens.insert_one({
+        "_id": token_hash,
+        "username": username,
+        "family": family,
+        "used": False,
+        "expires_at": expires_at,
+        "created_at": datetime.now(timezone.utc)
+    })
+
+
+async def rotate_refresh_token(token_hash: str, new_hash: str, expires_at: datetime) -> Optional[str]:
+    """
+    Exchange a refresh token for a new one in the same family. Returns the
+    username, or None if the token is unknown, expired or already used.
+    A used token coming back means it was copied, so its whole family is revoked.
+    """
+    now = datetime.now(timezone.utc)
+    current = await db.refresh_tokens.find_one_and_update(
+        {"_id": token_hash, "used": False, "expires_at": {"$gt": now}},
+        {"$set": {"used": True, "used_at": now}}
+    )
+    if current is None:
+        reused = await db.refresh_tokens.find_one({"_id": token_hash, "used": True})
+        if reused:
+            await db.refresh_tokens.delete_many({"family": reused["family"]})
+        return None
+
+    await create_refresh_token(current["username"], new_hash, current["family"], expires_at)
+    return current["username"]
+
+
+async def revoke_refresh_token(token_hash: str):
+    """Revoke a refresh token's family (logout)."""
+    token = await db.refresh_tokens.find_one({"_id": token_hash})
+    if token:
+        await db.refresh_tokens.delete_many({"family": token["family"]})
+
+
+def _contact_upsert(owner: str, peer: str, last_message_at: datetime) -> UpdateOne:
+    """
+    Upsert one (owner, peer) contact. $max keeps the newest timestamp even
+    when batched writes land out of order.
+    """
+    return UpdateOne(
+        {"owner": owner, "peer": peer},
+        {"$max": {"last_message_at": last_message_at}},
+        upsert=True
+    )
+
+
+def _conversation_upsert(owner: str, peer: str, last_message: dict, unread: int) -> UpdateOne:
+    """
+    Upsert a contact along with its conversation summary: last message
+    preview and unread count. The preview only moves forward in time, so
+    batches that land out of order can't replace a newer message.
+    """
+    timestamp = last_message["timestamp"]
+    is_newer = {"$gte": [timestamp, {"$ifNull": ["$last_message_at", timestamp]}]}
+
+    def newer_or_current(field: str, value):
+        return {"$cond": [is_newer, {"$literal": value}, f"${field}"]}
+
+    return UpdateOne(
+        {"owner": owner, "peer": peer},
+        [{"$set": {
+            "last_message_at": {"$max": ["$last_message_at", timestamp]},
+            "last_sender": newer_or_current("last_sender", last_message["sender"]),
+            "last_ciphertext": newer_or_current("last_ciphertext", last_message["encrypted_content"]),
+            "unread": {"$add": [{"$ifNull": ["$unread", 0]}, unread]},
+        }}],
+        upsert=True
+    )
+
+
+async def get_contacts(username: str, limit: int = 50) -> List[str]:
+    """Get user's contacts, most recent conversation first."""
+    cursor = db.contacts.find(
+        {"owner": username}, {"peer": 1, "_id": 0}
+    ).sort("last_message_at", DESCENDING).limit(limit)
+
+    return [contact["peer"] for contact in await cursor.to_list(length=limit)]
+
+
+def _contact_updates(messages: List[dict]) -> List[UpdateOne]:
+    """
+    Contact updates for a batch of messages, one per (owner, peer) pair.
+    Each carries the pair's newest message and how many messages the owner received.
     """
-    Add a contact to user's contact list (for recent chats).
-    Uses $addToSet to avoid duplicates.
+    latest = {}
+    unread = {}
+    for msg in messages:
+        for pair in ((msg["sender"], msg["recipient"]), (msg["recipient"], msg["sender"])):
+            if pair not in latest or msg["timestamp"] > latest[pair]["timestamp"]:
+                latest[pair] = msg
+        received = (msg["recipient"], msg["sender"])
+        unread[received] = unread.get(received, 0) + 1
+
+    return [
+        _conversation_upsert(owner, peer, msg, unread.get((owner, peer), 0))
+        for (owner, peer), msg in latest.items()
+    ]
+
+
+async def get_conversations(
+    username: str,
+    limit: int = 20,
+    before: Optional[Tuple[datetime, str]] = None
+) -> List[dict]:
     """
-    await db.users.update_one(
-        {"username": username},
-        {"$addToSet": {"contacts": contact}}
+    Get conversation summaries, most recent first, in a single indexed query.
+    `before` is the (last_message_at, peer) of the last item on the previous page.
+    """
+    query = {"owner": username}
+    if before:
+        timestamp, peer = before
+        query["$or"] = [
+            {"last_message_at": {"$lt": timestamp}},
+            {"last_message_at": timestamp, "peer": {"$gt": peer}}
+        ]
+
+    cursor = db.contacts.find(query, {"_id": 0, "owner": 0}).sort(
+        [("last_message_at", DESCENDING), ("peer", ASCENDING)]
+    ).limit(limit)
+
+    return await cursor.to_list(length=limit)
+
+
+async def mark_conversation_read(username: str, peer: str):
+    """Reset the unread count for a conversation. No write if already zero."""
+    await db.contacts.update_one(
+        {"owner": username, "peer": peer, "unread": {"$gt": 0}},
+        {"$set": {"unread": 0}}
     )
 
 
-async def get_contacts(username: str) -> List[str]:
-    """Get user's contact list."""
-    user = await get_user(username)
-    return user.get("contacts", []) if user else []
+def conversation_id(user1: str, user2: str) -> str:
+    """Stable id for a conversation, the same from either side."""
+    first, second = sorted((user1, user2))
+    return f"{first}:{second}"
 
 
-async def save_message(sender: str, recipient: str, encrypted_content: str) -> dict:
+async def next_sequence(user1: str, user2: str) -> int:
     """
-    Save an encrypted message. Returns the saved document.
-    Auto-adds each user to the other's contacts.
+    Atomically allocate the next sequence number in a conversation.
+    Counters live in MongoDB so they survive cache flushes and restarts.
     """
-    timestamp = datetime.now(timezone.utc)
+    counter = await db.counters.find_one_and_update(
+        {"_id": conversation_id(user1, user2)},
+        {"$inc": {"seq": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return counter["seq"]
+
+
+async def current_sequence(user1: str, user2: str) -> int:
+    """The last sequence number allocated in a conversation (0 if none)."""
+    counter = await db.counters.find_one({"_id": conversation_id(user1, user2)})
+    return counter["seq"] if counter else 0
+
+
+def _counter_updates(messages: List[dict]) -> List[UpdateOne]:
+    """Raise each conversation's counter to the highest seq in a batch (allocated elsewhere)."""
+    highest = {}
+    for msg in messages:
+        if msg.get("seq"):
+            highest[msg["conversation"]] = max(highest.get(msg["conversation"], 0), msg["seq"])
+    return [
+        UpdateOne({"_id": conversation}, {"$max": {"seq": seq}}, upsert=True)
+        for conversation, seq in highest.items()
+    ]
+
 
-    message_doc = {
+def new_message(sender: str, recipient: str, encrypted_content: str, seq: Optional[int] = None) -> dict:
+    """
+    Build a message document. The _id is assigned here rather than by the
+    server so a replayed write can be recognised as a duplicate.
+    """
+    return {
+        "_id": ObjectId(),
+        "conversation": conversation_id(sender, recipient),
+        "seq": seq,
         "sender": sender,
         "recipient": recipient,
         "encrypted_content": encrypted_content,
-        "timestamp": timestamp
+        "timestamp": datetime.now(timezone.utc)
     }
 
-    result = await db.messages.insert_one(message_doc)
-    message_doc["_id"] = result.inserted_id
 
-    # Add contacts asynchronously (don't wait)
-    await add_contact(sender, recipient)
-    await add_contact(recipient, sender)
+async def save_message(sender: str, recipient: str, encrypted_content: str, seq: Optional[int] = None) -> dict:
+    """
+    Save an encrypted message with the next sequence number in its conversation,
+    or with `seq` when the caller allocated it elsewhere (the write-behind
+    queue's counters). Returns the saved document. Auto-adds each user to the
+    other's contacts. Raises DuplicateKeyError if the seq is already taken.
+    """
+    message_doc = new_message(sender, recipient, encrypted_content, seq)
+    if seq is None:
+        message_doc["seq"] = await next_sequence(sender, recipient)
+    await db.messages.insert_one(message_doc)
+
+    # Only once the message is stored, so a failed insert leaves the
+    # conversation list and unread counts alone
+    writes = [db.contacts.bulk_write(_contact_updates([message_doc]), ordered=False)]
+    if seq is not None:
+        writes.append(db.counters.bulk_write(_counter_updates([message_doc]), ordered=False))
+    await asyncio.gather(*writes)
 
     return message_doc
 
 
+async def save_messages(messages: List[dict]):
+    """
+    Insert a batch of message documents with one insert_many (group commit).
+    Contact updates are coalesced so each pair is written once per batch, and
+    conversation counters are raised to the batch's sequence numbers so they
+    survive losing the Redis counters the write-behind queue allocates from.
+    Duplicate _ids, from replaying a batch that was partly written, are ignored.
+    Messages whose seq another message already holds are not stored: they're
+    raised in a SequenceConflictError once the rest of the batch is written.
+    """
+    conflicts = []
+    try:
+        await db.messages.insert_many(messages, ordered=False)
+    except BulkWriteError as e:
+        errors = [error for error in e.details.get("writeErrors", []) if error.get("keyPattern") != {"_id": 1}]
+        if any(error.get("code") != 11000 or "seq" not in error.get("keyPattern", {}) for error in errors):
+            raise
+        conflicts = [messages[error["index"]] for error in errors]
+
+    stored = [msg for msg in messages if not any(msg is conflict for conflict in conflicts)]
+    if stored:
+        # Only once the messages are stored, like save_message
+        writes = [db.contacts.bulk_write(_contact_updates(stored), ordered=False)]
+        counters = _counter_updates(stored)
+        if counters:
+            writes.append(db.counters.bulk_write(counters, ordered=False))
+        await asyncio.gather(*writes)
+    if conflicts:
+        raise SequenceConflictError(conflicts)
+
+
 async def get_messages_between(user1: str, user2: str, hours: int = 24) -> List[dict]:
     """
     Get messages between two users from the last N hours.
-    Returns messages in chronological order.
+    Returns messages in sequence order (chronological for older unsequenced ones).
     """
     cutoff_time = datetime.now(timezone.utc) - timedelta(hours=hours)
 
@@ -183,24 +417,42 @@ async def get_messages_between(user1: str, user2: str, hours: int = 24) -> List[
             {"sender": user2, "recipient": user1}
         ],
         "timestamp": {"$gte": cutoff_time}
-    }).sort("timestamp", ASCENDING)
+    }).sort([("seq", ASCENDING), ("timestamp", ASCENDING)])
 
     return await cursor.to_list(length=None)
 
 
-async def get_recent_messages_for_user(username: str, hours: int = 24) -> List[dict]:
+async def get_recent_messages_for_user(
+    username: str,
+    hours: int = 24,
+    after: Optional[Tuple[datetime, ObjectId]] = None,
+    limit: Optional[int] = None
+) -> List[dict]:
     """
-    Get all recent messages for a user (sent or received).
-    Used for general message fetching.
+    Get all recent messages for a user (sent or received), across all conversations.
+    Ordered by (timestamp, _id); `after` resumes strictly after that position.
     """
     cutoff_time = datetime.now(timezone.utc) - timedelta(hours=hours)
-
-    cursor = db.messages.find({
+    query = {
         "$or": [
             {"sender": username},
             {"recipient": username}
         ],
         "timestamp": {"$gte": cutoff_time}
-    }).sort("timestamp", ASCENDING)
+    }
 
-    return await cursor.to_list(length=None)
+    if after:
+        timestamp, message_id = after
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        query["timestamp"] = {"$gte": max(cutoff_time, timestamp)}
+        query["$and"] = [{"$or": [
+            {"timestamp": {"$gt": timestamp}},
+            {"timestamp": timestamp, "_id": {"$gt": message_id}}
+        ]}]
+
+    cursor = db.messages.find(query).sort([("timestamp", ASCENDING), ("_id", ASCENDING)])
+    if limit:
+        cursor = cursor.limit(limit)
+
+    return await cursor.to_list(length=limit)
@@ -0,0 +1,173 @@
+"""
+ASGI middleware for the backend.
+BodySizeLimitMiddleware rejects oversized request bodies with 413 before they
+are buffered or parsed. CompressionMiddleware compresses complete responses above a size threshold with
+the best encoding the client accepts: brotli or zstd when those packages are
+installed, gzip otherwise.
+
+Defaults come from benchmarks/bench_compression.py: base64 ciphertext only
+compresses to ~52% whatever the level, so the fastest settings win.
+"""
+import os
+import gzip
+import asyncio
+from typing import Optional
+
+from fastapi import HTTPException
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import JSONResponse
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Request body budget for routes without their own limit
+MAX_BODY_SIZE = int(os.getenv("MAX_BODY_SIZE", "4096"))
+
+# Compression configuration from env
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_ENCODINGS = os.getenv("COMPRESSION_ENCODINGS", "zstd,br,gzip")  # Cheapest first
+GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "1"))
+BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", "1"))
+ZSTD_LEVEL = int(os.getenv("COMPRESSION_ZSTD_LEVEL", "3"))
+# Bodies at least this large are compressed off the event loop
+THREAD_MIN_SIZE = 64 * 1024  # ~2 ms of gzip-1 on a small CPU
+
+# Streams are flushed per event, so they are never buffered for compression
+SKIP_CONTENT_TYPES = ("text/event-stream",)
+
+
+class BodySizeLimitMiddleware:
+    """
+    Enforce per-route request body limits. A declared Content-Length over the
+    limit is rejected without reading the body; otherwise bytes are counted as
+    they stream in and the read fails with 413 once the limit is crossed.
+    """
+
+    def __init__(self, app, default_limit: int = MAX_BODY_SIZE, route_limits: Optional[dict] = None):
+        self.app = app
+        self.default_limit = default_limit
+        self.route_limits = route_limits or {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        limit = self.route_limits.get(scope["path"], self.default_limit)
+        content_length = Headers(scope=scope).get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > limit:
+            response = JSONResponse({"detail": "Request body too large"}, status_code=413)
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def receive_limited():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    # FastAPI re-raises HTTPExceptions from body reading as-is
+                    raise HTTPException(status_code=413, detail="Request body too large")
+            return message
+
+        await self.app(scope, receive_limited, send)
+
+
+def _compressors() -> dict:
+    """Encoders available in this environment, keyed by Content-Encoding."""
+    available = {"gzip": lambda data: gzip.compress(data, GZIP_LEVEL, mtime=0)}
+    if brotli is not None:
+        available["br"] = lambda data: brotli.compress(data, quality=BROTLI_QUALITY)
+    if zstandard is not None:
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+        available["zstd"] = compressor.compress
+    return available
+
+
+def negotiate(accept_encoding: str, preference: list) -> Optional[str]:
+    """Pick the first encoding in server preference order the client accepts (q > 0)."""
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+
+    for encoding in preference:
+        if accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return None
+
+
+class CompressionMiddleware:
+    """Compress single-message HTTP responses when the client accepts it."""
+
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_SIZE, encodings: str = COMPRESSION_ENCODINGS):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.compressors = _compressors()
+        self.preference = [
+            name.strip() for name in encodings.split(",") if name.strip() in self.compressors
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = negotiate(Headers(scope=scope).get("accept-encoding", ""), self.preference)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start_message, passthrough
+            if message["type"] == "http.response.start":
+                # Hold the headers until we know whether the body gets compressed
+                start_message = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            headers = MutableHeaders(raw=start_message["headers"])
+            if message.get("more_body", False) or not self._should_compress(headers, body):
+                passthrough = True
+                await send(start_message)
+                await send(message)
+                return
+
+            if len(body) >= THREAD_MIN_SIZE:
+                compressed = await asyncio.to_thread(self.compressors[encoding], body)
+            else:
+                compressed = self.compressors[encoding](body)
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(compressed))
+            headers.add_vary_header("Accept-Encoding")
+            await send(start_message)
+            await send({"type": "http.response.body", "body": compressed})
+
+        await self.app(scope, receive, send_compressed)
+
+    def _should_compress(self, headers: MutableHeaders, body: bytes) -> bool:
+        if len(body) < self.minimum_size or "content-encoding" in headers:
+            return False
+        return not headers.get("content-type", "").startswith(SKIP_CONTENT_TYPES)
@@ -0,0 +1,62 @@
+"""
+One-off migration: move users.contacts arrays into the contacts collection.
+Safe to run more than once. Run from the backend directory:
+    python migrate_contacts.py
+"""
+import asyncio
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import db
+from db import init_db, close_db, _contact_upsert
+
+
+async def last_message_at(owner: str, peer: str, fallback: datetime) -> datetime:
+    """Timestamp of the latest message between two users, if one is still stored."""
+    latest = await db.db.messages.find_one(
+        {"$or": [
+            {"sender": owner, "recipient": peer},
+            {"sender": peer, "recipient": owner}
+        ]},
+        {"timestamp": 1},
+        sort=[("timestamp", -1)]
+    )
+    return latest["timestamp"] if latest else fallback
+
+
+async def migrate():
+    await init_db()
+    if db.db is None:
+        print("❌ No database connection - nothing migrated")
+        return
+
+    migrated_users = 0
+    migrated_contacts = 0
+    cursor = db.db.users.find(
+        {"contacts.0": {"$exists": True}},
+        {"username": 1, "contacts": 1, "created_at": 1}
+    )
+
+    async for user in cursor:
+        owner = user["username"]
+        # Older conversations without stored messages sort by signup time
+        fallback = user.get("created_at") or datetime(1970, 1, 1, tzinfo=timezone.utc)
+        updates = [
+            _contact_upsert(owner, peer, await last_message_at(owner, peer, fallback))
+            for peer in user["contacts"]
+        ]
+
+        await db.db.contacts.bulk_write(updates, ordered=False)
+        await db.db.users.update_one({"_id": user["_id"]}, {"$unset": {"contacts": ""}})
+        migrated_users += 1
+        migrated_contacts += len(updates)
+
+    print(f"✅ Migrated {migrated_contacts} contacts for {migrated_users} users")
+    await close_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(migrate())
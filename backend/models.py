@@ -4,6 +4,11 @@ Keeping these separate makes the API cleaner and easier to test.
 """
 from pydantic import BaseModel, Field, field_validator, ConfigDict
 from datetime import datetime
+from typing import Optional
+
+# Longest accepted ciphertext (base64 chars) - about 12 KB of plaintext
+MAX_ENCRYPTED_CONTENT = 16384
+MAX_BATCH_MESSAGES = 20  # Messages per POST /messages/batch
 
 
 class UserSignup(BaseModel):
@@ -27,8 +32,8 @@ class UserLogin(BaseModel):
 
 class MessageSend(BaseModel):
     """Message send request containing recipient and encrypted content."""
-    recipient: str
-    encrypted_content: str  # Base64-encoded encrypted message
+    recipient: str = Field(..., max_length=30)
+    encrypted_content: str = Field(..., min_length=1, max_length=MAX_ENCRYPTED_CONTENT)  # Base64-encoded encrypted message
 
     @field_validator('recipient')
     @classmethod
@@ -38,17 +43,60 @@ class MessageSend(BaseModel):
         return v.lower()
 
 
+class BatchMessage(MessageSend):
+    """One message in a batch upload; the key makes re-uploading it safe."""
+    idempotency_key: str = Field(..., min_length=1, max_length=128)
+
+
+class MessageBatch(BaseModel):
+    """Batch upload of queued messages, saved in order."""
+    messages: list[BatchMessage] = Field(..., min_length=1, max_length=MAX_BATCH_MESSAGES)
+
+
 class MessageResponse(BaseModel):
     """Message response model returned when fetching messages."""
     sender: str
     recipient: str
     encrypted_content: str
     timestamp: datetime
+    seq: Optional[int] = None  # Per-conversation sequence number; None for older messages
 
     model_config = ConfigDict(from_attributes=True)
 
 
+class ConversationSummary(BaseModel):
+    """One entry in the conversation list: peer, last message and unread count."""
+    peer: str
+    last_message_at: datetime
+    last_sender: Optional[str] = None
+    last_ciphertext: Optional[str] = None  # Still E2E encrypted
+    unread_count: int = 0
+
+
+class ConversationPage(BaseModel):
+    """A page of conversations. Pass next_cursor back as `cursor` for the next page."""
+    conversations: list[ConversationSummary]
+    next_cursor: Optional[str] = None
+
+
+class SyncPage(BaseModel):
+    """
+    Messages across all conversations since a sync cursor.
+    Store `cursor` and send it back next time; fetch again while has_more is true.
+    """
+    messages: list[MessageResponse]
+    cursor: Optional[str] = None
+    has_more: bool = False
+
+
 class TokenResponse(BaseModel):
     """JWT token response after successful login."""
     access_token: str
     token_type: str = "bearer"
+    refresh_token: Optional[str] = None  # Exchange at /token/refresh for a new pair
+    expires_in: Optional[int] = None  # Access token lifetime in seconds
+
+
+class RefreshRequest(BaseModel):
+    """Refresh token exchange or revocation request."""
+    refresh_token: str = Field(..., min_length=1, max_length=128)
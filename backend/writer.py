@@ -0,0 +1,312 @@
+"""
+Group-commit write-behind queue for message persistence.
+Optional mode (WRITE_BEHIND=true): accepted messages are appended to a Redis stream
+and a background writer flushes them to MongoDB with insert_many every few
+milliseconds or every N messages, whichever comes first.
+
+Without Redis the queue falls back to an in-process asyncio.Queue, which keeps
+the batching but is not crash-safe.
+"""
+import os
+import time
+import socket
+import asyncio
+import logging
+from typing import Optional, List, Tuple
+
+import bson
+
+import cache
+from db import new_message, next_sequence, current_sequence, conversation_id, save_messages, SequenceConflictError
+from cache import (
+    batch_writes, invalidate_conversation_cache, bump_versions,
+    conversation_version_key, contacts_version_key
+)
+
+logger = logging.getLogger(__name__)
+
+# Write-behind configuration from env
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "false").lower() == "true"
+FLUSH_INTERVAL_MS = int(os.getenv("WRITE_BEHIND_FLUSH_MS", "5"))
+MAX_BATCH = int(os.getenv("WRITE_BEHIND_MAX_BATCH", "100"))
+MAX_DEPTH = int(os.getenv("WRITE_BEHIND_MAX_DEPTH", "10000"))
+
+STREAM_KEY = "stream:messages"
+GROUP = "message-writers"
+CLAIM_IDLE_MS = 30000  # Pending entries idle this long belong to a dead worker
+RETRY_DELAY = 1.0  # Seconds between attempts when MongoDB is unavailable
+SEQUENCE_TTL = 172800  # Idle Redis counters expire, then reseed from the copy flushes keep in MongoDB
+
+# INCR a conversation's sequence counter, seeding it with ARGV[1] if it doesn't
+# exist. Returns nil for a missing counter without a seed, so MongoDB is only
+# read the first time a conversation is used.
+_NEXT_SEQUENCE = """
+if redis.call('exists', KEYS[1]) == 0 then
+    if ARGV[1] == '' then
+        return false
+    end
+    redis.call('set', KEYS[1], ARGV[1])
+end
+local seq = redis.call('incr', KEYS[1])
+redis.call('expire', KEYS[1], ARGV[2])
+return seq
+"""
+
+
+class QueueFullError(Exception):
+    """Raised when the write-behind queue is at its depth limit."""
+
+
+class MessageWriter:
+    """Accepts messages into a durable queue and flushes them in batches."""
+
+    def __init__(self, enabled: bool = WRITE_BEHIND):
+        self.enabled = enabled
+        self.consumer = f"{socket.gethostname()}-{os.getpid()}"
+        self.running = False
+        self.durable = False  # True when backed by a Redis stream, decided at start()
+        self._task: Optional[asyncio.Task] = None
+        self._local: Optional[asyncio.Queue] = None
+        self.stats = {
+            "enqueued": 0,
+            "rejected": 0,
+            "replayed": 0,
+            "flushed": 0,
+            "flushes": 0,
+            "queue_depth": 0,
+            "last_batch_size": 0,
+            "max_batch_size": 0,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+            "total_flush_ms": 0.0,
+        }
+
+    def get_stats(self) -> dict:
+        """Batch size and flush latency metrics for /metrics."""
+        stats = dict(self.stats)
+        total_flush_ms = stats.pop("total_flush_ms")
+        flushes = stats["flushes"]
+        stats["avg_batch_size"] = round(stats["flushed"] / flushes, 2) if flushes else 0
+        stats["avg_flush_ms"] = round(total_flush_ms / flushes, 2) if flushes else 0
+        stats["mode"] = "off" if not self.enabled else ("redis" if self.durable else "memory")
+        return stats
+
+    async def start(self):
+        """Start the background writer, replaying anything left from a crash first."""
+        if not self.enabled or self.running:
+            return
+
+        durable = cache.redis_client is not None
+        if durable:
+            try:
+                await cache.redis_client.xgroup_create(STREAM_KEY, GROUP, id="0", mkstream=True)
+            except Exception as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+        else:
+            self._local = asyncio.Queue(maxsize=MAX_DEPTH)
+            logger.warning("Write-behind running without Redis - queued messages are not crash-safe")
+
+        # Only now: while running is set, sends are acked on enqueue and rely on _run to flush them
+        self.durable = durable
+        self.running = True
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the writer after flushing what has already been read."""
+        self.running = False
+        if self._task:
+            await self._task
+            self._task = None
+
+    async def enqueue(self, sender: str, recipient: str, encrypted_content: str) -> dict:
+        """
+        Durably enqueue a message and return its document.
+        Raises QueueFullError when the queue is at its depth limit.
+        """
+        # The sequence number is allocated up front so the client sees it immediately;
+        # a rejected message leaves a gap, which readers already tolerate
+        seq = await self.next_sequence(sender, recipient)
+        message_doc = new_message(sender, recipient, encrypted_content, seq)
+
+        if self.durable:
+            # XLEN and XADD share a round trip; back out the add if we were over the limit
+            pipe = cache.redis_client.pipeline(transaction=False)
+            pipe.xlen(STREAM_KEY)
+            pipe.xadd(STREAM_KEY, {"doc": bson.encode(message_doc)})
+            depth, entry_id = await pipe.execute()
+            self.stats["queue_depth"] = depth + 1
+            if depth >= MAX_DEPTH:
+                await cache.redis_client.xdel(STREAM_KEY, entry_id)
+                self._reject()
+        else:
+            try:
+                self._local.put_nowait(message_doc)
+            except asyncio.QueueFull:
+                self._reject()
+            self.stats["queue_depth"] = self._local.qsize()
+
+        self.stats["enqueued"] += 1
+        return message_doc
+
+    async def next_sequence(self, sender: str, recipient: str) -> int:
+        """
+        Allocate a sequence number from a Redis counter, keeping MongoDB off the
+        ack path. A missing counter is seeded from MongoDB's, which each flush
+        raises to the highest seq it wrote. Without Redis, MongoDB allocates.
+        With write-behind on, direct saves (while the writer is stopped) take
+        their seqs from here too, so the two paths never hand out the same one.
+        """
+        if cache.redis_client is None:
+            return await next_sequence(sender, recipient)
+        key = f"sequence:{conversation_id(sender, recipient)}"
+        seq = await cache.redis_client.eval(_NEXT_SEQUENCE, 1, key, "", SEQUENCE_TTL)
+        if seq is None:
+            seed = await current_sequence(sender, recipient)
+            seq = await cache.redis_client.eval(_NEXT_SEQUENCE, 1, key, seed, SEQUENCE_TTL)
+        return int(seq)
+
+    def _reject(self):
+        self.stats["rejected"] += 1
+        raise QueueFullError("Message queue is full")
+
+    async def _run(self):
+        """Main writer loop."""
+        if self.durable:
+            await self._replay()
+        last_claim = time.monotonic()
+
+        while self.running:
+            try:
+                if self.durable and time.monotonic() - last_claim > CLAIM_IDLE_MS / 1000:
+                    await self._claim_stale()
+                    last_claim = time.monotonic()
+                if self.durable:
+                    messages, entry_ids = self._unpack(await self._read_stream())
+                else:
+                    messages, entry_ids = await self._read_local(), []
+            except Exception as e:
+                logger.error(f"Write-behind read error: {e}")
+                await asyncio.sleep(RETRY_DELAY)
+                continue
+            if messages:
+                await self._flush(messages, entry_ids)
+
+        # Drain whatever is still queued in memory - it would be lost otherwise
+        while self._local is not None and not self._local.empty():
+            await self._flush(self._drain_local())
+
+    @staticmethod
+    def _unpack(entries: List[Tuple]) -> Tuple[List[dict], list]:
+        """Split stream entries into message documents and entry ids."""
+        return [bson.decode(fields[b"doc"]) for _, fields in entries], [entry_id for entry_id, _ in entries]
+
+    async def _replay(self):
+        """Flush entries that were read but never acknowledged before a crash."""
+        # Our own pending entries from a previous run of this consumer
+        while True:
+            response = await cache.redis_client.xreadgroup(
+                GROUP, self.consumer, {STREAM_KEY: "0"}, count=MAX_BATCH
+            )
+            entries = response[0][1] if response else []
+            if not entries:
+                break
+            self.stats["replayed"] += len(entries)
+            await self._flush(*self._unpack(entries))
+
+        await self._claim_stale()
+
+    async def _claim_stale(self):
+        """Take over and flush entries left pending by consumers that died."""
+        start_id = "0-0"
+        while True:
+            start_id, claimed, *_ = await cache.redis_client.xautoclaim(
+                STREAM_KEY, GROUP, self.consumer, CLAIM_IDLE_MS, start_id=start_id, count=MAX_BATCH
+            )
+            if claimed:
+                self.stats["replayed"] += len(claimed)
+                await self._flush(*self._unpack(claimed))
+            if start_id in (b"0-0", "0-0"):
+                break
+
+    async def _read_stream(self) -> List[Tuple]:
+        """Block for new stream entries, then linger briefly to fill the batch."""
+        redis = cache.redis_client
+        response = await redis.xreadgroup(
+            GROUP, self.consumer, {STREAM_KEY: ">"}, count=MAX_BATCH, block=1000
+        )
+        entries = response[0][1] if response else []
+        if entries and len(entries) < MAX_BATCH:
+            await asyncio.sleep(FLUSH_INTERVAL_MS / 1000)
+            response = await redis.xreadgroup(
+                GROUP, self.consumer, {STREAM_KEY: ">"}, count=MAX_BATCH - len(entries)
+            )
+            if response:
+                entries.extend(response[0][1])
+        return entries
+
+    async def _read_local(self) -> List[dict]:
+        """Wait for a message, then linger briefly to fill the batch."""
+        try:
+            first = await asyncio.wait_for(self._local.get(), timeout=1.0)
+        except asyncio.TimeoutError:
+            return []
+        await asyncio.sleep(FLUSH_INTERVAL_MS / 1000)
+        return [first] + self._drain_local(MAX_BATCH - 1)
+
+    def _drain_local(self, limit: int = MAX_BATCH) -> List[dict]:
+        batch = []
+        while len(batch) < limit and not self._local.empty():
+            batch.append(self._local.get_nowait())
+        return batch
+
+    async def _flush(self, messages: List[dict], entry_ids: list = ()):
+        """Write one batch to MongoDB, retrying until it succeeds, then ack it."""
+        started = time.perf_counter()
+        unsaved = messages
+        while True:
+            try:
+                await save_messages(unsaved)
+                break
+            except SequenceConflictError as e:
+                # Already acked, so renumber rather than drop them (e.g. a Redis
+                # counter that expired and was reseeded from a lagging copy)
+                logger.error(f"Write-behind flush found taken seqs, renumbering: {e}")
+                for doc in e.messages:
+                    doc["seq"] = await self.next_sequence(doc["sender"], doc["recipient"])
+                unsaved = e.messages
+            except Exception as e:
+                logger.error(f"Write-behind flush failed, retrying: {e}")
+                await asyncio.sleep(RETRY_DELAY)
+
+        if entry_ids:
+            # Ack and delete together so XLEN stays equal to the unflushed depth
+            pipe = cache.redis_client.pipeline(transaction=False)
+            pipe.xack(STREAM_KEY, GROUP, *entry_ids)
+            pipe.xdel(STREAM_KEY, *entry_ids)
+            await pipe.execute()
+
+        # Readers may have cached the conversation (or taken an ETag) before
+        # this batch landed
+        async with batch_writes():
+            for pair in {tuple(sorted((m["sender"], m["recipient"]))) for m in messages}:
+                await invalidate_conversation_cache(*pair)
+                await bump_versions(
+                    conversation_version_key(*pair),
+                    contacts_version_key(pair[0]),
+                    contacts_version_key(pair[1])
+                )
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        stats = self.stats
+        stats["flushes"] += 1
+        stats["flushed"] += len(messages)
+        stats["last_batch_size"] = len(messages)
+        stats["max_batch_size"] = max(stats["max_batch_size"], len(messages))
+        stats["last_flush_ms"] = round(elapsed_ms, 2)
+        stats["max_flush_ms"] = max(stats["max_flush_ms"], round(elapsed_ms, 2))
+        stats["total_flush_ms"] += elapsed_ms
+        stats["queue_depth"] = max(0, stats["queue_depth"] - len(messages))
+
+
+message_writer = MessageWriter()
@@ -0,0 +1,80 @@
+"""
+Microbenchmark: binary message cache encoding vs the previous JSON format.
+Usage: python benchmarks/bench_cache_encoding.py [message_count]
+"""
+import base64
+import json
+import os
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+from codec import encode_messages, decode_messages
+
+
+def make_history(count: int) -> list:
+    """A synthetic 24h history between two users with realistic ciphertext sizes."""
+    start = datetime(2024, 1, 1)
+    return [
+        {
+            "sender": "alice" if i % 2 else "bob",
+            "recipient": "bob" if i % 2 else "alice",
+            # nonce(12) + ciphertext + tag(16), base64 encoded like the client sends
+            "encrypted_content": base64.b64encode(os.urandom(28 + 20 + i % 200)).decode(),
+            "timestamp": start + timedelta(seconds=i * 86400 // count),
+        }
+        for i in range(count)
+    ]
+
+
+def json_encode(messages: list) -> str:
+    """The previous cache_messages serialization."""
+    serializable_msgs = []
+    for msg in messages:
+        msg_copy = msg.copy()
+        if isinstance(msg_copy.get('timestamp'), datetime):
+            msg_copy['timestamp'] = msg_copy['timestamp'].isoformat()
+        serializable_msgs.append(msg_copy)
+    return json.dumps(serializable_msgs)
+
+
+def json_decode(data: str) -> list:
+    """The previous get_cached_messages deserialization."""
+    messages = json.loads(data)
+    for msg in messages:
+        if 'timestamp' in msg and isinstance(msg['timestamp'], str):
+            msg['timestamp'] = datetime.fromisoformat(msg['timestamp'])
+    return messages
+
+
+def bench(label: str, func, number: int) -> float:
+    per_call = min(timeit.repeat(func, number=number, repeat=5)) / number
+    print(f"  {label:<16} {per_call * 1e6:10.1f} us")
+    return per_call
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    messages = make_history(count)
+    number = max(1, 20000 // count)
+
+    json_data = json_encode(messages)
+    binary_data = encode_messages(messages)
+    assert [m["encrypted_content"] for m in decode_messages(binary_data)] == \
+        [m["encrypted_content"] for m in messages]
+
+    print(f"{count} messages")
+    print(f"  {'json size':<16} {len(json_data.encode()):10d} bytes")
+    print(f"  {'binary size':<16} {len(binary_data):10d} bytes "
+          f"({len(binary_data) / len(json_data.encode()):.0%})")
+    json_enc = bench("json encode", lambda: json_encode(messages), number)
+    bin_enc = bench("binary encode", lambda: encode_messages(messages), number)
+    json_dec = bench("json decode", lambda: json_decode(json_data), number)
+    bin_dec = bench("binary decode", lambda: decode_messages(binary_data), number)
+    print(f"  encode speedup {json_enc / bin_enc:.1f}x, decode speedup {json_dec / bin_dec:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
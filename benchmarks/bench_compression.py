@@ -0,0 +1,61 @@
+"""
+Microbenchmark: response compression size and CPU cost for message history payloads.
+Helps pick COMPRESSION_MIN_SIZE and levels for the CPU the backend runs on.
+Usage: python benchmarks/bench_compression.py [message_count ...]
+"""
+import json
+import os
+import sys
+import timeit
+import gzip
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from bench_cache_encoding import make_history
+from middleware import brotli, zstandard
+
+
+def history_json(count: int) -> bytes:
+    """GET /messages/{other_user} response body for a history of `count` messages."""
+    messages = make_history(count)
+    for seq, msg in enumerate(messages, 1):
+        msg["timestamp"] = msg["timestamp"].isoformat() + "Z"
+        msg["seq"] = seq
+    return json.dumps(messages, separators=(",", ":")).encode()
+
+
+def codecs() -> list:
+    """(label, compress function) for every available encoder and a few levels."""
+    options = [(f"gzip-{level}", lambda data, level=level: gzip.compress(data, level, mtime=0))
+               for level in (1, 5, 6, 9)]
+    if brotli is not None:
+        options += [(f"br-{quality}", lambda data, quality=quality: brotli.compress(data, quality=quality))
+                    for quality in (1, 4, 6)]
+    if zstandard is not None:
+        options += [(f"zstd-{level}", lambda data, level=level: zstandard.ZstdCompressor(level=level).compress(data))
+                    for level in (1, 3, 9)]
+    return options
+
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or [5, 50, 500, 3000]
+    options = codecs()
+    if brotli is None or zstandard is None:
+        print("(install brotli / zstandard to include them)\n")
+
+    for count in counts:
+        body = history_json(count)
+        number = max(1, 2_000_000 // len(body))
+        print(f"{count} messages, {len(body)} bytes")
+        for label, compress in options:
+            compressed = compress(body)
+            per_call = min(timeit.repeat(lambda: compress(body), number=number, repeat=3)) / number
+            mb_per_s = len(body) / per_call / 1e6
+            print(f"  {label:<8} {len(compressed):9d} bytes ({len(compressed) / len(body):4.0%})"
+                  f"  {per_call * 1e3:8.3f} ms  {mb_per_s:6.1f} MB/s")
+        print()
+
+
+if __name__ == "__main__":
+    main()
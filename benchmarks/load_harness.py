@@ -0,0 +1,102 @@
+"""
+HTTP load harness for the backend's message endpoints.
+Signs up throwaway user pairs, then sends messages concurrently and reports
+latency percentiles and throughput.
+
+Run the backend with rate limiting off, since every request comes from one IP:
+    RATE_LIMIT_ENABLED=false uvicorn app:app
+
+Usage:
+    python benchmarks/load_harness.py --url http://localhost:8000 \\
+        --pairs 20 --messages 50 --concurrency 20
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+import uuid
+
+import httpx
+
+
+async def signup(client: httpx.AsyncClient, username: str) -> str:
+    """Create a throwaway user and return its access token."""
+    response = await client.post(
+        "/signup", json={"username": username, "password": "loadtest-password"}
+    )
+    response.raise_for_status()
+    return response.json()["access_token"]
+
+
+async def send(client: httpx.AsyncClient, token: str, recipient: str, latencies: list, errors: list):
+    """Send one message and record its latency."""
+    start = time.perf_counter()
+    try:
+        response = await client.post(
+            "/messages",
+            json={"recipient": recipient, "encrypted_content": os.urandom(64).hex()},
+            params={"token": token},
+        )
+        if response.status_code != 201:
+            errors.append(response.status_code)
+            return
+    except httpx.HTTPError as e:
+        errors.append(type(e).__name__)
+        return
+    latencies.append(time.perf_counter() - start)
+
+
+async def run(url: str, pairs: int, messages: int, concurrency: int):
+    run_id = uuid.uuid4().hex[:6]
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, timeout=30.0, limits=limits) as client:
+        users = [(f"lt{run_id}a{i}", f"lt{run_id}b{i}") for i in range(pairs)]
+        tokens = await asyncio.gather(*[signup(client, a) for a, _ in users])
+        await asyncio.gather(*[signup(client, b) for _, b in users])
+
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies: list = []
+        errors: list = []
+
+        async def worker(token: str, recipient: str):
+            async with semaphore:
+                await send(client, token, recipient, latencies, errors)
+
+        jobs = [
+            worker(token, recipient)
+            for token, (_, recipient) in zip(tokens, users)
+            for _ in range(messages)
+        ]
+        start = time.perf_counter()
+        await asyncio.gather(*jobs)
+        elapsed = time.perf_counter() - start
+
+    report(latencies, errors, elapsed)
+
+
+def report(latencies: list, errors: list, elapsed: float):
+    if not latencies:
+        print(f"No successful requests ({len(errors)} errors: {set(errors)})")
+        return
+    latencies.sort()
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(f"requests   {len(latencies)} ok, {len(errors)} failed")
+    print(f"throughput {len(latencies) / elapsed:.1f} req/s")
+    print(f"latency    p50 {quantiles[49] * 1000:.1f} ms  "
+          f"p95 {quantiles[94] * 1000:.1f} ms  p99 {quantiles[98] * 1000:.1f} ms  "
+          f"max {latencies[-1] * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--url", default=os.getenv("BACKEND_URL", "http://localhost:8000"))
+    parser.add_argument("--pairs", type=int, default=20, help="sender/recipient pairs")
+    parser.add_argument("--messages", type=int, default=50, help="messages per pair")
+    parser.add_argument("--concurrency", type=int, default=20, help="requests in flight")
+    args = parser.parse_args()
+    asyncio.run(run(args.url, args.pairs, args.messages, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,8 @@ Usage: python chat.py
 import requests
 import json
 import sys
+import time
+import uuid
 from datetime import datetime
 
 # API Configuration
@@ -15,6 +17,19 @@ class ChatClient:
     def __init__(self):
         self.token = None
         self.username = None
+        self.etag_cache = {}  # url -> (etag, body) for conditional GETs
+
+    def conditional_get(self, url):
+        """GET with If-None-Match; a 304 returns the cached body with status 200"""
+        cached = self.etag_cache.get(url)
+        headers = {"If-None-Match": cached[0]} if cached else {}
+        response = requests.get(f"{url}?token={self.token}", headers=headers)
+        if response.status_code == 304 and cached:
+            return 200, cached[1]
+        body = response.json()
+        if response.status_code == 200 and "ETag" in response.headers:
+            self.etag_cache[url] = (response.headers["ETag"], body)
+        return response.status_code, body
 
     def signup(self, username, password):
         """Create a new account"""
@@ -56,16 +71,31 @@ class ChatClient:
             print(f"❌ Error: {e}")
             return False
 
-    def send_message(self, recipient, message):
-        """Send a message to another user"""
+    def send_message(self, recipient, message, attempts=4):
+        """Send a message to another user, retrying safely with an idempotency key"""
+        headers = {"Idempotency-Key": uuid.uuid4().hex}
         try:
-            response = requests.post(
-                f"{API_URL}/messages?token={self.token}",
-                json={
-                    "recipient": recipient,
-                    "encrypted_content": message  # In real app, this would be encrypted
-                }
-            )
+            for attempt in range(attempts):
+                if attempt:
+                    time.sleep(0.5 * 2 ** attempt)
+                try:
+                    response = requests.post(
+                        f"{API_URL}/messages?token={self.token}",
+                        json={
+                            "recipient": recipient,
+                            "encrypted_content": message  # In real app, this would be encrypted
+                        },
+                        headers=headers,
+                        timeout=10
+                    )
+                except (requests.ConnectionError, requests.Timeout):
+                    if attempt == attempts - 1:
+                        raise
+                    continue
+                # 409: the first attempt is still being processed
+                if response.status_code not in (409, 502, 503, 504):
+                    break
+
             if response.status_code == 201:
                 data = response.json()
                 timestamp = data.get("timestamp", datetime.now().isoformat())
@@ -81,11 +111,9 @@ class ChatClient:
     def get_messages(self, other_user):
         """Get messages with another user"""
         try:
-            response = requests.get(
-                f"{API_URL}/messages/{other_user}?token={self.token}"
-            )
-            if response.status_code == 200:
-                messages = response.json()
+            status, body = self.conditional_get(f"{API_URL}/messages/{other_user}")
+            if status == 200:
+                messages = body
                 if not messages:
                     print(f"📭 No messages with {other_user}")
                     return []
@@ -119,7 +147,7 @@ class ChatClient:
                 print("=" * 60)
                 return messages
             else:
-                print(f"❌ Failed to get messages: {response.json().get('detail', 'Unknown error')}")
+                print(f"❌ Failed to get messages: {body.get('detail', 'Unknown error')}")
                 return []
         except Exception as e:
             print(f"❌ Error: {e}")
@@ -128,11 +156,9 @@ class ChatClient:
     def get_contacts(self):
         """Get list of contacts"""
         try:
-            response = requests.get(
-                f"{API_URL}/contacts?token={self.token}"
-            )
-            if response.status_code == 200:
-                contacts = response.json()
+            status, body = self.conditional_get(f"{API_URL}/contacts")
+            if status == 200:
+                contacts = body
                 if not contacts:
                     print("📭 No contacts yet")
                     return []
@@ -142,7 +168,7 @@ class ChatClient:
                     print(f"  {i}. {contact}")
                 return contacts
             else:
-                print(f"❌ Failed to get contacts: {response.json().get('detail', 'Unknown error')}")
+                print(f"❌ Failed to get contacts: {body.get('detail', 'Unknown error')}")
                 return []
         except Exception as e:
             print(f"❌ Error: {e}")
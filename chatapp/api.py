@@ -3,27 +3,210 @@ HTTP and WebSocket client helpers for communicating with the backend.
 Uses httpx for async HTTP and websockets for real-time communication.
 """
 import os
+import time
+import uuid
+import random
 import asyncio
+import importlib.util
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
 from typing import Optional, Callable, List, Dict
 import httpx
 from websockets.asyncio.client import connect as ws_connect
-from websockets.exceptions import ConnectionClosed
+from websockets.exceptions import ConnectionClosed, InvalidStatus
 import logging
 
 # Backend URL from env or default to localhost
 BACKEND_URL = os.getenv("BACKEND_URL", "http://localhost:8000")
 WS_URL = BACKEND_URL.replace("http://", "ws://").replace("https://", "wss://")
 
+# Real-time transport: "ws" (default) or "sse" for networks that block WebSocket upgrades
+REALTIME_TRANSPORT = os.getenv("REALTIME_TRANSPORT", "ws").lower()
+
+# HTTP/2 multiplexes every request over one TLS connection: "auto" uses it when h2 is installed
+HTTP2_SETTING = os.getenv("CHATAPP_HTTP2", "auto").lower()
+HTTP2 = HTTP2_SETTING == "true" or (HTTP2_SETTING == "auto" and importlib.util.find_spec("h2") is not None)
+HTTP_LIMITS = httpx.Limits(
+    max_connections=int(os.getenv("CHATAPP_MAX_CONNECTIONS", "10")),
+    max_keepalive_connections=int(os.getenv("CHATAPP_MAX_KEEPALIVE", "5")),
+    keepalive_expiry=30.0,
+)
+# Identical GETs within this many seconds are answered from memory
+RESPONSE_CACHE_TTL = float(os.getenv("CHATAPP_RESPONSE_CACHE_TTL", "2"))
+# Conditional-GET bodies kept, least recently used dropped first; each chat
+# open asks with a new after_seq, so without a cap they'd pile up
+ETAG_CACHE_SIZE = 64
+
 logger = logging.getLogger(__name__)
 
+# Sends are retried with the same Idempotency-Key, so retries never duplicate
+SEND_ATTEMPTS = 4
+SEND_BACKOFF = 0.5  # Seconds, doubled each attempt
+RETRY_STATUSES = {409, 429, 502, 503, 504}  # 409: the original is still in progress
+REJECTED = "rejected"  # Receipt status for a message the server will never accept
+MAX_SENDS_IN_FLIGHT = 4  # Concurrent queued sends, at most one per recipient
+OUTBOX_BATCH_SIZE = 20  # Server's MAX_BATCH_MESSAGES
+
+TOKEN_REFRESH_MARGIN = 300  # Seconds before access token expiry to refresh it
+
+# Real-time reconnects: full-jitter exponential backoff, in seconds
+RECONNECT_BASE = 1.0
+RECONNECT_MAX = 60.0
+STABLE_CONNECTION = 30.0  # A connection that lasted this long resets the backoff
+
+# Client-side copies of the server's per-minute limits, so requests wait for
+# a token locally instead of coming back as 429s. Keys are (method, route).
+# POST /messages/batch shares the POST /messages bucket (see SHARED_RATE_LIMITS).
+RATE_LIMITS = {
+    ("POST", "/signup"): 5,
+    ("POST", "/login"): 10,
+    ("POST", "/token/refresh"): 10,
+    ("POST", "/token/revoke"): 10,
+    ("POST", "/messages"): 30,
+    ("GET", "/messages/{peer}"): 20,
+    ("GET", "/messages/{peer}/wait"): 60,
+    ("GET", "/contacts"): 20,
+    ("GET", "/conversations"): 20,
+    ("POST", "/conversations/{peer}/read"): 30,
+    ("GET", "/sync"): 20,
+}
+# Routes charged to another route's budget, one token per message they carry
+SHARED_RATE_LIMITS = {("POST", "/messages/batch"): ("POST", "/messages")}
+RATE_LIMIT_RETRIES = 2  # 429s retried (after Retry-After) before giving up
+
+
+def rate_limit_route(method: str, path: str) -> tuple:
+    """The RATE_LIMITS key for a request: peer names replaced by {peer}."""
+    segments = path.rstrip("/").split("/")
+    if len(segments) > 2 and segments[1] in ("messages", "conversations") and segments[2] != "batch":
+        segments[2] = "{peer}"
+    return method, "/".join(segments)
+
+
+def rejection(response: httpx.Response) -> Optional[Dict]:
+    """
+    A receipt for a send the server refused for good (a 4xx other than auth,
+    409 or 429, e.g. 422 for a bad recipient or 413 for an oversized
+    message), or None if a later retry might succeed.
+    """
+    if 400 <= response.status_code < 500 and response.status_code not in (401, 409, 429):
+        logger.warning(f"Send rejected: {response.status_code}")
+        return {"status": REJECTED, "status_code": response.status_code}
+    return None
+
+
+def is_rejected(receipt: Optional[Dict]) -> bool:
+    return receipt is not None and receipt.get("status") == REJECTED
+
+
+class TokenBucket:
+    """
+    Allows `rate` requests per `period` seconds, refilling continuously so
+    bursts are smoothed out. The server's rate-limit headers correct it:
+    no requests left, or a Retry-After, blocks it until the window resets.
+    """
+
+    def __init__(self, rate: int, period: float = 60.0):
+        self.capacity = float(rate)
+        self.tokens = float(rate)
+        self.fill_rate = rate / period
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+        self.updated = now
+
+    def delay(self, cost: float = 1) -> float:
+        """Seconds until a request costing `cost` tokens may go out."""
+        now = time.monotonic()
+        self._refill(now)
+        cost = min(cost, self.capacity)
+        wait = 0.0 if self.tokens >= cost else (cost - self.tokens) / self.fill_rate
+        return max(wait, self.blocked_until - now)
+
+    async def acquire(self, cost: float = 1):
+        """
+        Wait for `cost` tokens (at most the capacity) and take them. Waiters
+        are served in order.
+        """
+        cost = min(cost, self.capacity)
+        async with self._lock:
+            wait = self.delay(cost)
+            while wait > 0:
+                await asyncio.sleep(wait)
+                wait = self.delay(cost)
+            self.tokens -= cost
+
+    def update(self, status_code: int, headers: httpx.Headers):
+        """Adjust to what the server says is left of its budget."""
+        now = time.monotonic()
+        self._refill(now)
+        retry_after = headers.get("retry-after")
+        remaining = headers.get("x-ratelimit-remaining")
+        reset = headers.get("x-ratelimit-reset")
+        try:
+            if remaining is not None:
+                self.tokens = min(self.tokens, float(remaining))
+            if retry_after is not None and status_code == 429:
+                self.blocked_until = max(self.blocked_until, now + float(retry_after))
+            elif remaining is not None and float(remaining) < 1 and reset is not None:
+                # Reset is an epoch timestamp for the server's window
+                self.blocked_until = max(self.blocked_until, now + float(reset) - time.time())
+        except ValueError:
+            pass  # Malformed headers: keep pacing by our own count
+
 
 class APIClient:
     """Async HTTP client for backend API calls."""
 
     def __init__(self):
         self.token: Optional[str] = None
+        self.refresh_token: Optional[str] = None
+        self.token_expires_at = 0.0  # time.time() when the access token expires
         self.username: Optional[str] = None
-        self.client = httpx.AsyncClient(base_url=BACKEND_URL, timeout=10.0)
+        self._refresh_lock = asyncio.Lock()
+        self.rate_limits = {route: TokenBucket(rate) for route, rate in RATE_LIMITS.items()}
+        for route, shared in SHARED_RATE_LIMITS.items():
+            self.rate_limits[route] = self.rate_limits[shared]
+        self.client = self.http_client(base_url=BACKEND_URL, timeout=10.0, http2=HTTP2, limits=HTTP_LIMITS)
+        # Last ETag and body per request, for conditional GETs
+        self._etag_cache: OrderedDict = OrderedDict()
+        # Short-lived responses and in-flight GETs, so screens asking for the same data share one request
+        self._response_cache: Dict[tuple, tuple] = {}
+        self._in_flight: Dict[tuple, asyncio.Future] = {}
+        self._cache_generation = 0
+        self.batch_supported = True  # Until a server without POST /messages/batch says otherwise
+
+    def http_client(self, **kwargs) -> httpx.AsyncClient:
+        """An httpx client whose requests are paced by our rate-limit buckets."""
+        return httpx.AsyncClient(
+            event_hooks={"request": [self._throttle], "response": [self._observe_rate_limit]}, **kwargs
+        )
+
+    async def _throttle(self, request: httpx.Request):
+        bucket = self.rate_limits.get(rate_limit_route(request.method, request.url.path))
+        if bucket:
+            await bucket.acquire(request.extensions.get("rate_limit_cost", 1))
+
+    async def _observe_rate_limit(self, response: httpx.Response):
+        bucket = self.rate_limits.get(rate_limit_route(response.request.method, response.request.url.path))
+        if bucket:
+            bucket.update(response.status_code, response.headers)
+        if response.status_code == 429:
+            logger.warning(f"Rate limited on {response.request.url.path}")
+
+    async def _request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        """
+        Send a request, retrying 429s: the bucket has taken the server's
+        Retry-After, so the retry waits for the window to reset.
+        """
+        for _ in range(RATE_LIMIT_RETRIES):
+            response = await self.client.request(method, path, **kwargs)
+            if response.status_code != 429:
+                return response
+        return await self.client.request(method, path, **kwargs)
 
     async def close(self):
         """Close HTTP client."""
@@ -37,8 +220,7 @@ class APIClient:
                 json={"username": username, "password": password}
             )
             if response.status_code == 201:
-                data = response.json()
-                self.token = data["access_token"]
+                self._start_session(response.json())
                 self.username = username.lower()
                 return True
             return False
@@ -54,8 +236,7 @@ class APIClient:
                 json={"username": username, "password": password}
             )
             if response.status_code == 200:
-                data = response.json()
-                self.token = data["access_token"]
+                self._start_session(response.json())
                 self.username = username.lower()
                 return True
             return False
@@ -63,116 +244,645 @@ class APIClient:
             logger.error(f"Login error: {e}")
             return False
 
-    async def send_message(self, recipient: str, encrypted_content: str) -> bool:
-        """Send an encrypted message to a recipient."""
-        if not self.token:
-            return False
+    async def logout(self):
+        """Revoke the session's refresh token and forget the tokens."""
+        if self.refresh_token:
+            try:
+                await self.client.post("/token/revoke", json={"refresh_token": self.refresh_token})
+            except httpx.HTTPError as e:
+                logger.error(f"Logout error: {e}")
+        self.token = self.refresh_token = None
+        self.token_expires_at = 0.0
+
+    def _start_session(self, data: Dict):
+        """Keep the tokens from a login, signup or refresh response."""
+        self.token = data["access_token"]
+        self.refresh_token = data.get("refresh_token")
+        expires_in = data.get("expires_in")
+        self.token_expires_at = time.time() + expires_in if expires_in else 0.0
+
+    async def refresh_session(self) -> bool:
+        """
+        Swap the refresh token for a new access/refresh pair. Concurrent
+        callers share one exchange - refresh tokens are single use, and the
+        server revokes the session if one is presented twice.
+        """
+        stale = self.token
+        async with self._refresh_lock:
+            if self.token != stale:
+                return True  # Another caller refreshed while we waited
+            if not self.refresh_token:
+                return False
+            try:
+                response = await self.client.post("/token/refresh", json={"refresh_token": self.refresh_token})
+            except httpx.HTTPError as e:
+                logger.error(f"Token refresh error: {e}")
+                return False
+            if response.status_code != 200:
+                if response.status_code == 401:
+                    self.refresh_token = None  # Expired or revoked: a new login is needed
+                return False
+            self._start_session(response.json())
+            return True
+
+    async def _authorized(self) -> bool:
+        """True if we have an access token, refreshing it first when it's about to expire."""
+        if self.refresh_token and self.token_expires_at and time.time() > self.token_expires_at - TOKEN_REFRESH_MARGIN:
+            await self.refresh_session()
+        return bool(self.token)
+
+    async def _conditional_get(self, path: str, params: Dict):
+        """
+        GET with If-None-Match from the last response to the same request.
+        Returns the JSON body (the cached one on 304), or None on error statuses.
+        """
+        cache_key = self._cache_key(path, params)
+        cached = self._etag_cache.get(cache_key)
+        if cached:
+            self._etag_cache.move_to_end(cache_key)
+        headers = {"If-None-Match": cached[0]} if cached else {}
+
+        response = await self._request("GET", path, params=params, headers=headers)
+        if response.status_code == 304 and cached:
+            return cached[1]
+        if response.status_code != 200:
+            return None
+        data = response.json()
+        if "etag" in response.headers:
+            self._etag_cache[cache_key] = (response.headers["etag"], data)
+            self._etag_cache.move_to_end(cache_key)
+            while len(self._etag_cache) > ETAG_CACHE_SIZE:
+                self._etag_cache.popitem(last=False)
+        return data
+
+    @staticmethod
+    def _cache_key(path: str, params: Dict) -> tuple:
+        return path, tuple(sorted((k, v) for k, v in params.items() if k != "token"))
+
+    async def _shared_get(self, path: str, params: Dict):
+        """
+        _conditional_get with single-flight and a short-lived cache: callers
+        asking for the same thing at the same time share one request, and
+        repeats within RESPONSE_CACHE_TTL are answered from memory.
+        """
+        key = self._cache_key(path, params)
+        cached = self._response_cache.get(key)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
+        pending = self._in_flight.get(key)
+        if pending is None:
+            pending = asyncio.ensure_future(self._fetch_shared(key, path, params))
+            self._in_flight[key] = pending
+
+            def forget(done):
+                if self._in_flight.get(key) is done:
+                    del self._in_flight[key]
+
+            pending.add_done_callback(forget)
+        # Shielded so one caller giving up doesn't cancel the request for the others
+        return await asyncio.shield(pending)
+
+    async def _fetch_shared(self, key: tuple, path: str, params: Dict):
+        generation = self._cache_generation
+        data = await self._conditional_get(path, params)
+        if data is not None and generation == self._cache_generation:
+            self._response_cache[key] = (time.monotonic() + RESPONSE_CACHE_TTL, data)
+        return data
+
+    def invalidate(self, peer: Optional[str] = None):
+        """
+        Drop cached responses a new message makes stale: the conversation
+        with `peer` and the contact/conversation lists (everything if no peer).
+        """
+        self._cache_generation += 1
+        paths = {"/contacts", "/conversations", f"/messages/{peer}"} if peer else None
+        for cache in (self._response_cache, self._in_flight):
+            for key in [key for key in cache if paths is None or key[0] in paths]:
+                del cache[key]
+
+    async def send_message(
+        self, recipient: str, encrypted_content: str, idempotency_key: Optional[str] = None
+    ) -> Optional[Dict]:
+        """
+        Send an encrypted message to a recipient.
+        Timeouts and transient errors are retried with backoff under one
+        idempotency key, so the server stores the message at most once.
+        Returns the server's receipt ({"timestamp", "seq"}), a rejection (see
+        rejection()) if resending can't help, or None on a failure worth retrying later.
+        """
+        if not await self._authorized():
+            return None
+
+        headers = {"Idempotency-Key": idempotency_key or uuid.uuid4().hex}
+        for attempt in range(SEND_ATTEMPTS):
+            if attempt:
+                # Full jitter keeps retrying clients from hitting the server in lockstep
+                await asyncio.sleep(random.uniform(0, SEND_BACKOFF * 2 ** attempt))
+            try:
+                response = await self.client.post(
+                    "/messages",
+                    json={"recipient": recipient, "encrypted_content": encrypted_content},
+                    params={"token": self.token},
+                    headers=headers
+                )
+            except httpx.TransportError as e:
+                logger.warning(f"Send message attempt {attempt + 1} failed: {e}")
+                continue
+            except httpx.HTTPError as e:
+                logger.error(f"Send message error: {e}")
+                return None
+
+            if response.status_code == 201:
+                self.invalidate(recipient)
+                return response.json()
+            if response.status_code not in RETRY_STATUSES:
+                return rejection(response)
+        return None
+
+    async def send_batch(self, messages: List[Dict]) -> Optional[List[Dict]]:
+        """
+        Upload several messages (dicts with recipient, encrypted_content and
+        idempotency_key) in one request. Returns the per-message results in
+        order, or None if the request failed.
+        A request the server refuses outright (e.g. 422 for one bad message)
+        is retried a message at a time, so only the bad ones are rejected.
+        """
+        if not await self._authorized():
+            return None
 
         try:
-            response = await self.client.post(
-                "/messages",
-                json={"recipient": recipient, "encrypted_content": encrypted_content},
-                params={"token": self.token}
+            response = await self._request(
+                "POST", "/messages/batch", json={"messages": messages}, params={"token": self.token},
+                extensions={"rate_limit_cost": len(messages)}
             )
-            return response.status_code == 201
         except httpx.HTTPError as e:
-            logger.error(f"Send message error: {e}")
-            return False
+            logger.error(f"Send batch error: {e}")
+            return None
 
-    async def get_messages(self, other_user: str) -> List[Dict]:
-        """Fetch messages with another user."""
-        if not self.token:
+        if response.status_code == 201:
+            for recipient in {msg["recipient"] for msg in messages}:
+                self.invalidate(recipient)
+            return response.json()["results"]
+        if response.status_code in (404, 405):
+            # Older server: fall back to one POST per message from now on
+            self.batch_supported = False
+        elif rejection(response) is not None:
+            return await self._send_each(messages)
+        return None
+
+    async def _send_each(self, messages: List[Dict]) -> List[Dict]:
+        """send_batch's results for messages sent one at a time, stopping at the first failure."""
+        results = []
+        for msg in messages:
+            receipt = await self.send_message(msg["recipient"], msg["encrypted_content"], msg["idempotency_key"])
+            if receipt is None:
+                break
+            results.append(receipt)
+        return results + [{"status": "failed", "detail": "Not sent"}] * (len(messages) - len(results))
+
+    async def send_outbox(self, messages: List[Dict]) -> List[Optional[Dict]]:
+        """
+        Send queued messages (outbox entries with peer, encrypted_content and
+        idempotency_key) in order, batched when the server supports it.
+        Returns a receipt, a rejection or None per message; sending stops at
+        the first failure so later messages never overtake earlier ones.
+        Rejected messages are skipped, since no retry will get them through.
+        """
+        receipts: List[Optional[Dict]] = [None] * len(messages)
+        index = 0
+        while index < len(messages):
+            if self.batch_supported:
+                chunk = messages[index:index + OUTBOX_BATCH_SIZE]
+                results = await self.send_batch([
+                    {"recipient": msg["peer"], "encrypted_content": msg["encrypted_content"],
+                     "idempotency_key": msg["idempotency_key"]}
+                    for msg in chunk
+                ])
+                if results is None:
+                    if self.batch_supported:
+                        break
+                    continue  # Retry this chunk one message at a time
+                for offset, result in enumerate(results):
+                    if result.get("status") in ("sent", REJECTED):
+                        receipts[index + offset] = result
+                if any(result.get("status") not in ("sent", REJECTED) for result in results):
+                    break
+                index += len(chunk)
+            else:
+                msg = messages[index]
+                receipt = await self.send_message(msg["peer"], msg["encrypted_content"], msg["idempotency_key"])
+                if receipt is None:
+                    break
+                receipts[index] = receipt
+                index += 1
+        return receipts
+
+    async def get_messages(self, other_user: str, after_seq: Optional[int] = None) -> List[Dict]:
+        """
+        Fetch messages with another user.
+        With after_seq, only messages newer than that sequence number are returned.
+        """
+        if not await self._authorized():
             return []
 
+        params = {"token": self.token}
+        if after_seq is not None:
+            params["after_seq"] = after_seq
+
         try:
-            response = await self.client.get(
-                f"/messages/{other_user}",
-                params={"token": self.token}
+            messages = await self._shared_get(f"/messages/{other_user}", params)
+            return messages if messages is not None else []
+        except httpx.HTTPError as e:
+            logger.error(f"Get messages error: {e}")
+            return []
+
+    async def wait_for_messages(self, other_user: str, after_seq: int, timeout: int = 25) -> List[Dict]:
+        """
+        Long-poll for messages from other_user newer than after_seq.
+        Returns as soon as there are any, or an empty list after `timeout` seconds.
+        For networks where neither WebSockets nor SSE stay open. Call
+        mark_read() once the messages are shown; the long-poll doesn't.
+        """
+        if not await self._authorized():
+            return []
+
+        try:
+            response = await self._request(
+                "GET", f"/messages/{other_user}/wait",
+                params={"token": self.token, "after": after_seq, "timeout": timeout},
+                timeout=timeout + 10.0
             )
             if response.status_code == 200:
                 return response.json()
             return []
         except httpx.HTTPError as e:
-            logger.error(f"Get messages error: {e}")
+            logger.error(f"Wait for messages error: {e}")
             return []
 
-    async def get_contacts(self) -> List[str]:
-        """Get list of recent chat contacts."""
-        if not self.token:
-            return []
+    async def get_conversations(self, limit: int = 20, cursor: Optional[str] = None) -> Dict:
+        """
+        Get recent conversations with last message metadata and unread counts.
+        Returns {"conversations": [...], "next_cursor": ...}.
+        """
+        empty = {"conversations": [], "next_cursor": None}
+        if not await self._authorized():
+            return empty
+
+        params = {"token": self.token, "limit": limit}
+        if cursor:
+            params["cursor"] = cursor
 
         try:
-            response = await self.client.get(
-                "/contacts",
-                params={"token": self.token}
+            page = await self._shared_get("/conversations", params)
+            return page if page is not None else empty
+        except httpx.HTTPError as e:
+            logger.error(f"Get conversations error: {e}")
+            return empty
+
+    async def mark_read(self, other_user: str) -> bool:
+        """Reset a conversation's unread count once its messages have been shown."""
+        if not await self._authorized():
+            return False
+
+        try:
+            response = await self._request(
+                "POST", f"/conversations/{other_user}/read", params={"token": self.token}
             )
+            return response.status_code == 204
+        except httpx.HTTPError as e:
+            logger.error(f"Mark read error: {e}")
+            return False
+
+    async def sync(self, cursor: Optional[str] = None, limit: int = 200) -> Dict:
+        """
+        Fetch every message sent to or by us since `cursor`, across all chats.
+        Returns {"messages": [...], "cursor": ..., "has_more": bool}.
+        """
+        empty = {"messages": [], "cursor": cursor, "has_more": False}
+        if not await self._authorized():
+            return empty
+
+        params = {"token": self.token, "limit": limit}
+        if cursor:
+            params["cursor"] = cursor
+
+        try:
+            response = await self._request("GET", "/sync", params=params)
             if response.status_code == 200:
                 return response.json()
+            return empty
+        except httpx.HTTPError as e:
+            logger.error(f"Sync error: {e}")
+            return empty
+
+    async def get_contacts(self) -> List[str]:
+        """Get list of recent chat contacts."""
+        if not await self._authorized():
             return []
+
+        try:
+            contacts = await self._shared_get("/contacts", {"token": self.token})
+            return contacts if contacts is not None else []
         except httpx.HTTPError as e:
             logger.error(f"Get contacts error: {e}")
             return []
 
 
-class WebSocketClient:
+class AuthenticationError(Exception):
+    """The server rejected the real-time connection's token."""
+
+
+class RealtimeClient(ABC):
     """
-    WebSocket client for real-time message updates.
-    Reconnects automatically on disconnect.
+    Connection state machine shared by the WebSocket and SSE clients.
+    States: connecting -> connected -> waiting (backoff) -> connecting ...,
+    ending in closed (disconnect()) or auth_failed (token rejected and no
+    fresh one available). Reconnects back off exponentially with full jitter,
+    so clients dropped by a redeploy don't all return at the same moment.
     """
 
-    def __init__(self, username: str, token: str, on_message: Callable):
+    def __init__(
+        self, username: str, token: str, on_message: Callable, on_connect: Optional[Callable] = None,
+        token_provider: Optional[Callable] = None, on_state_change: Optional[Callable] = None
+    ):
         self.username = username
         self.token = token
         self.on_message = on_message
-        self.ws = None
+        self.on_connect = on_connect  # Awaited in the background after each (re)connect
+        self.token_provider = token_provider  # Async; returns a fresh token or None
+        self.on_state_change = on_state_change  # Called with the new state
         self.running = False
-        self.reconnect_delay = 2  # Seconds
+        self.state = "closed"
+        self.backoff_base = RECONNECT_BASE
+        self.tasks: set = set()  # on_connect calls, held until they finish
+        self.stats = {
+            "connects": 0,
+            "reconnects": 0,
+            "failures": 0,
+            "last_connect_ms": None,  # Time to establish the latest connection
+            "connected_since": None,  # time.time() of the current connection
+        }
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            self.state = state
+            if self.on_state_change:
+                try:
+                    self.on_state_change(state)
+                except Exception as e:
+                    logger.error(f"Connection state callback error: {e}")
+
+    def _connected(self, started: float):
+        """Record a successful (re)connect; called by _session once the connection is open."""
+        self.stats["last_connect_ms"] = round((time.monotonic() - started) * 1000)
+        self.stats["connected_since"] = time.time()
+        if self.stats["connects"]:
+            self.stats["reconnects"] += 1
+        self.stats["connects"] += 1
+        self._set_state("connected")
+        if self.on_connect:
+            task = asyncio.create_task(self.on_connect())
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    def _cancel_tasks(self):
+        for task in self.tasks:
+            task.cancel()
+
+    @abstractmethod
+    async def _session(self, started: float):
+        """Open one connection and read from it until it ends."""
 
     async def connect(self):
-        """Connect to WebSocket and start listening."""
+        """Connect and keep reconnecting until disconnect()."""
         self.running = True
+        attempt = 0
         while self.running:
+            self._set_state("connecting")
+            started = time.monotonic()
             try:
-                ws_url = f"{WS_URL}/ws/{self.username}?token={self.token}"
-                async with ws_connect(ws_url) as websocket:
-                    self.ws = websocket
-                    logger.info("WebSocket connected")
-
-                    # Send periodic pings to keep connection alive
-                    async def ping_loop():
-                        while self.running:
-                            try:
-                                await websocket.send('{"type": "ping"}')
-                                await asyncio.sleep(30)
-                            except:
-                                break
-
-                    ping_task = asyncio.create_task(ping_loop())
-
-                    # Listen for messages
-                    try:
-                        async for message in websocket:
-                            if self.on_message:
-                                await self.on_message(message)
-                    except ConnectionClosed:
-                        logger.warning("WebSocket connection closed")
-                    finally:
-                        ping_task.cancel()
-
+                await self._session(started)
+            except AuthenticationError:
+                # The JWT expired (or was revoked): get a new one rather than retrying a dead token
+                token = await self.token_provider() if self.token_provider else None
+                if not token or token == self.token:
+                    logger.warning("Real-time connection rejected: session expired")
+                    self.running = False
+                    self._set_state("auth_failed")
+                    return
+                self.token = token
             except Exception as e:
-                logger.error(f"WebSocket error: {e}")
+                logger.error(f"{type(self).__name__} error: {e}")
+                self.stats["failures"] += 1
+            self.stats["connected_since"] = None
+
+            if not self.running:
+                break
+            if time.monotonic() - started >= STABLE_CONNECTION:
+                attempt = 0  # The last connection was healthy, start over
+            delay = random.uniform(0, min(RECONNECT_MAX, self.backoff_base * 2 ** attempt))
+            attempt += 1
+            self._set_state("waiting")
+            await asyncio.sleep(delay)
+        self._set_state("closed")
+
+
+class WebSocketClient(RealtimeClient):
+    """
+    WebSocket client for real-time message updates.
+    Reconnects automatically on disconnect.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ws = None
+
+    async def _session(self, started: float):
+        ws_url = f"{WS_URL}/ws/{self.username}?token={self.token}"
+        try:
+            # Negotiate permessage-deflate explicitly; the server enables it too
+            async with ws_connect(ws_url, compression="deflate") as websocket:
+                self.ws = websocket
+                logger.info("WebSocket connected")
+                self._connected(started)
+
+                # Send periodic pings to keep connection alive
+                async def ping_loop():
+                    while self.running:
+                        try:
+                            await websocket.send('{"type": "ping"}')
+                            await asyncio.sleep(30)
+                        except:
+                            break
+
+                ping_task = asyncio.create_task(ping_loop())
 
-            # Reconnect after delay if still running
-            if self.running:
-                await asyncio.sleep(self.reconnect_delay)
+                # Listen for messages
+                try:
+                    async for message in websocket:
+                        if self.on_message:
+                            await self.on_message(message)
+                except ConnectionClosed as e:
+                    if e.rcvd and e.rcvd.code == 1008:
+                        raise AuthenticationError() from e
+                    logger.warning("WebSocket connection closed")
+                finally:
+                    ping_task.cancel()
+        except InvalidStatus as e:
+            # A token rejected before accept() comes back as an HTTP 403
+            if e.response.status_code in (401, 403):
+                raise AuthenticationError() from e
+            raise
+        finally:
+            self.ws = None
 
     async def disconnect(self):
         """Disconnect from WebSocket."""
         self.running = False
+        self._cancel_tasks()
         if self.ws:
             await self.ws.close()
 
 
+class SSEClient(RealtimeClient):
+    """
+    Server-Sent Events client with the same interface as WebSocketClient.
+    Resumes from the last event id after a reconnect, so nothing is missed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.last_event_id: Optional[str] = None
+        # The server sends a keepalive every 15s, so a long silence means a dead stream
+        self.client = httpx.AsyncClient(base_url=BACKEND_URL, timeout=httpx.Timeout(10.0, read=45.0))
+
+    async def _session(self, started: float):
+        headers = {"Accept": "text/event-stream"}
+        if self.last_event_id:
+            headers["Last-Event-ID"] = self.last_event_id
+        async with self.client.stream(
+            "GET", "/events", params={"token": self.token}, headers=headers
+        ) as response:
+            if response.status_code in (401, 403):
+                raise AuthenticationError()
+            if response.status_code != 200:
+                raise httpx.HTTPStatusError(
+                    f"Event stream rejected: {response.status_code}", request=response.request, response=response
+                )
+            logger.info("Event stream connected")
+            self._connected(started)
+            await self._read_events(response)
+
+    async def _read_events(self, response: httpx.Response):
+        """Parse the text/event-stream body and dispatch each event's data."""
+        event_id, data = None, []
+        async for line in response.aiter_lines():
+            if not line:
+                # A blank line ends the event
+                if data:
+                    if event_id:
+                        self.last_event_id = event_id
+                    if self.on_message:
+                        await self.on_message("\n".join(data))
+                event_id, data = None, []
+            elif line.startswith(":"):
+                continue  # Keepalive comment
+            else:
+                field, _, value = line.partition(":")
+                value = value[1:] if value.startswith(" ") else value
+                if field == "data":
+                    data.append(value)
+                elif field == "id":
+                    event_id = value
+                elif field == "retry" and value.isdigit():
+                    # The server's suggested delay becomes the backoff base
+                    self.backoff_base = int(value) / 1000
+
+    async def disconnect(self):
+        """Close the event stream."""
+        self.running = False
+        self._cancel_tasks()
+        await self.client.aclose()
+
+
+def create_realtime_client(username: str, token: str, on_message: Callable, **callbacks) -> RealtimeClient:
+    """
+    Build the configured real-time client (WebSocket or SSE). Keyword
+    arguments are RealtimeClient's callbacks (on_connect, token_provider,
+    on_state_change).
+    """
+    client_class = SSEClient if REALTIME_TRANSPORT == "sse" else WebSocketClient
+    return client_class(username, token, on_message, **callbacks)
+
+
+class SendQueue:
+    """
+    Outbound message queue. A few workers drain it so sends to different
+    recipients can be in flight at once instead of each waiting for the
+    previous round trip. Sends to one recipient go one at a time, so they
+    are saved (and numbered) in the order they were queued. Each send retries
+    under its own idempotency key (see APIClient.send_message).
+    """
+
+    def __init__(self, client: APIClient, concurrency: int = MAX_SENDS_IN_FLIGHT):
+        self.client = client
+        self.concurrency = concurrency
+        self.pending: Dict[str, deque] = {}  # Recipient -> sends not yet started
+        self.queue: asyncio.Queue = asyncio.Queue()  # Recipients with a send ready to go
+        self.workers: List[asyncio.Task] = []
+
+    def submit(
+        self, recipient: str, encrypted_content: str, on_done: Callable, idempotency_key: Optional[str] = None
+    ):
+        """
+        Queue a message. `on_done(receipt)` is awaited when the send finishes,
+        with the server's receipt or None once retries are exhausted.
+        """
+        if not self.workers:
+            # Started lazily, inside the running event loop
+            self.workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        if recipient not in self.pending:
+            # Otherwise the recipient is queued or being sent to already
+            self.pending[recipient] = deque()
+            self.queue.put_nowait(recipient)
+        self.pending[recipient].append((encrypted_content, idempotency_key or uuid.uuid4().hex, on_done))
+
+    async def join(self):
+        """Wait until everything queued so far has been sent (or given up on)."""
+        await self.queue.join()
+
+    async def _worker(self):
+        while True:
+            recipient = await self.queue.get()
+            encrypted_content, idempotency_key, on_done = self.pending[recipient].popleft()
+            try:
+                receipt = await self.client.send_message(recipient, encrypted_content, idempotency_key)
+            except Exception as e:
+                logger.error(f"Queued send error: {e}")
+                receipt = None
+            try:
+                await on_done(receipt)
+            except Exception as e:
+                logger.error(f"Send callback error: {e}")
+            finally:
+                # The recipient's next send, if any, goes after this one
+                if self.pending[recipient]:
+                    self.queue.put_nowait(recipient)
+                else:
+                    del self.pending[recipient]
+                self.queue.task_done()
+
+    async def close(self):
+        """Stop the workers, dropping anything still queued."""
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        self.pending = {}
+        self.queue = asyncio.Queue()
+
+
 # Global instances
 api_client = APIClient()
-ws_client: Optional[WebSocketClient] = None
+send_queue = SendQueue(api_client)
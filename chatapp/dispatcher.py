@@ -0,0 +1,225 @@
+"""
+Client-side real-time event dispatcher.
+Owns the app's single WebSocket/SSE connection for the whole login session and
+routes each incoming event: to the open ChatScreen for that peer, or into a
+per-conversation buffer (with unread badge updates) when that chat isn't open.
+"""
+import json
+import random
+import asyncio
+import logging
+from collections import deque
+from typing import Callable, Dict, List, Optional, Tuple
+
+from api import api_client, create_realtime_client, is_rejected
+import store
+
+logger = logging.getLogger(__name__)
+
+BUFFER_SIZE = 500  # Events kept per conversation; beyond that the chat refetches on open
+READ_DELAY = 1.0  # Seconds; messages arriving together in an open chat share one read call
+# Outbox retries after a send fails while connected: full-jitter backoff, in seconds
+FLUSH_RETRY_BASE = 5.0
+FLUSH_RETRY_MAX = 300.0
+
+
+class EventDispatcher:
+    """Routes real-time events to the active chat, buffering the rest per conversation."""
+
+    def __init__(self):
+        self.client = None
+        self.chat = None  # The ChatScreen currently receiving events
+        self.buffers: Dict[str, deque] = {}
+        self.seen: Dict[str, deque] = {}  # Recent seqs per peer, to drop events replayed on reconnect
+        self.overflowed: set = set()  # Peers whose buffer dropped events
+        self.listeners: List[Callable] = []  # listener(peer, event) for events that were buffered
+        self.flushing = False
+        self.state = "closed"  # The connection's state, see RealtimeClient
+        self.read_pending: set = set()  # Peers with a read call scheduled
+        self.tasks: set = set()  # Background calls, held until they finish
+        self.flush_retry: Optional[asyncio.Task] = None
+        self.flush_failures = 0  # Failed sends since the last one that got through
+
+    async def start(self):
+        """Open the real-time connection after login."""
+        if self.client:
+            return
+        self.client = create_realtime_client(
+            api_client.username, api_client.token, self.handle,
+            on_connect=self.flush_outbox,
+            token_provider=self.fresh_token,
+            on_state_change=self.on_state_change,
+        )
+        # Runs until stop(); the client reconnects on its own
+        self._spawn(self.client.connect())
+
+    async def stop(self):
+        """Close the connection and forget buffered events (logout)."""
+        if self.client:
+            await self.client.disconnect()
+            self.client = None
+        self.chat = None
+        self.buffers.clear()
+        self.seen.clear()
+        self.overflowed.clear()
+        for task in self.tasks:
+            task.cancel()
+        self.read_pending.clear()
+        self.flush_retry = None
+        self.flush_failures = 0
+
+    def _spawn(self, coro) -> asyncio.Task:
+        """Run `coro` in the background, holding the task until it finishes (or stop() cancels it)."""
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def fresh_token(self) -> Optional[str]:
+        """Token for reconnecting after the server rejected the current one."""
+        rejected = self.client.token if self.client else None
+        if api_client.token != rejected:
+            return api_client.token  # Already rotated (e.g. by an HTTP call): don't spend another
+        await api_client.refresh_session()
+        return api_client.token
+
+    def on_state_change(self, state: str):
+        self.state = state
+        if self.chat is not None:
+            self.chat.show_connection_state(state)
+
+    def take(self, peer: str) -> Tuple[List[Dict], bool]:
+        """
+        Remove and return the events buffered for a conversation, and whether
+        they're complete (False if the buffer overflowed and dropped some).
+        """
+        complete = peer not in self.overflowed
+        self.overflowed.discard(peer)
+        return list(self.buffers.pop(peer, ())), complete
+
+    def attach(self, chat) -> Tuple[List[Dict], bool]:
+        """
+        Make `chat` the receiver for its peer's events and send results - call
+        it before loading history, so nothing settles behind the chat's back.
+        Returns what was buffered for that peer meanwhile, as take() does.
+        """
+        self.chat = chat
+        chat.show_connection_state(self.state)
+        return self.take(chat.other_user)
+
+    def detach(self, chat):
+        if self.chat is chat:
+            self.chat = None
+
+    def add_listener(self, listener: Callable):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener: Callable):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    async def handle(self, message: str):
+        """Route one raw event from the real-time connection."""
+        try:
+            data = json.loads(message)
+        except ValueError:
+            return  # Ignore malformed messages
+        if data.get("type") != "new_message":
+            return
+
+        peer = data.get("sender")
+        seq = data.get("seq")
+        if seq is not None:
+            # An SSE resume repeats a few seconds of events so none are skipped
+            seen = self.seen.setdefault(peer, deque(maxlen=BUFFER_SIZE))
+            if seq in seen:
+                return
+            seen.append(seq)
+        api_client.invalidate(peer)  # Cached history and lists no longer include this message
+        if self.chat is not None and self.chat.other_user == peer:
+            await self.chat.on_message_event(data)
+            return
+
+        buffer = self.buffers.setdefault(peer, deque(maxlen=BUFFER_SIZE))
+        if len(buffer) == BUFFER_SIZE:
+            self.overflowed.add(peer)
+        buffer.append(data)
+        for listener in list(self.listeners):
+            try:
+                listener(peer, data)
+            except Exception as e:
+                logger.error(f"Event listener error: {e}")
+
+    def mark_read(self, peer: str):
+        """
+        Reset a conversation's unread count on the server after the open chat
+        showed its messages. A burst of messages costs one call.
+        """
+        if peer in self.read_pending:
+            return
+        self.read_pending.add(peer)
+        self._spawn(self._mark_read(peer))
+
+    async def _mark_read(self, peer: str):
+        await asyncio.sleep(READ_DELAY)
+        self.read_pending.discard(peer)  # Messages from here on need a call of their own
+        await api_client.mark_read(peer)
+
+    def settle_send(
+        self, peer: str, idempotency_key: str, encrypted: str, text: Optional[str], receipt: Optional[Dict]
+    ):
+        """
+        Record how a send finished: the open chat updates its bubble, otherwise
+        an acknowledged message moves from the outbox to the local history and
+        a rejected one is dropped. A failed send schedules an outbox retry.
+        """
+        chat = self.chat
+        if chat is not None and chat.other_user == peer and idempotency_key in chat.outgoing:
+            chat.on_send_done(idempotency_key, encrypted, receipt)
+        elif receipt is not None and store.local_store:
+            store.local_store.remove_outgoing([idempotency_key])
+            if text is not None and not is_rejected(receipt):
+                store.local_store.save(peer, [{
+                    "seq": receipt.get("seq"), "sender": api_client.username,
+                    "timestamp": receipt["timestamp"], "encrypted_content": encrypted, "text": text
+                }])
+        if receipt is None:
+            self.schedule_flush()
+        elif not is_rejected(receipt):
+            self.flush_failures = 0
+
+    def schedule_flush(self):
+        """
+        Retry the outbox after a send failed (e.g. a 503) while the connection
+        stayed up, so it doesn't wait for the next reconnect. Backs off with
+        each failure; a retry already scheduled covers later ones.
+        """
+        if self.client is None or not store.local_store or self.flush_retry is not None:
+            return
+        delay = random.uniform(0, min(FLUSH_RETRY_MAX, FLUSH_RETRY_BASE * 2 ** self.flush_failures))
+        self.flush_failures += 1
+        self.flush_retry = self._spawn(self._retry_flush(delay))
+
+    async def _retry_flush(self, delay: float):
+        await asyncio.sleep(delay)
+        self.flush_retry = None  # Failures in this flush schedule the next retry
+        await self.flush_outbox()
+
+    async def flush_outbox(self):
+        """
+        Send everything in the outbox, oldest first, when the real-time
+        connection (re)opens. Goes out as batch uploads, so a reconnect costs
+        one request rather than a burst of individual sends.
+        """
+        if not store.local_store or self.flushing:
+            return
+        self.flushing = True
+        try:
+            # Sends the queue is still retrying settle on their own
+            busy = self.chat.in_flight if self.chat is not None else set()
+            queued = [msg for msg in store.local_store.outbox() if msg["idempotency_key"] not in busy]
+            receipts = await api_client.send_outbox(queued)
+            for msg, receipt in zip(queued, receipts):
+                self.settle_send(msg["peer"], msg["idempotency_key"], msg["encrypted_content"], msg["text"], receipt)
+        finally:
+            self.flushing = False
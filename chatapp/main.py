@@ -9,6 +9,7 @@ load_dotenv()
 
 from textual.app import App
 from screens import LoginScreen
+from dispatcher import EventDispatcher
 
 
 class ChatApp(App):
@@ -282,6 +283,11 @@ class ChatApp(App):
         width: auto;
     }
 
+    #chat_container #connection_badge {
+        width: auto;
+        margin-left: 2;
+    }
+
     #chat_container #encryption_badge {
         text-align: right;
         color: $success;
@@ -301,14 +307,6 @@ class ChatApp(App):
         border: none;
     }
 
-    #chat_container MessageBubble {
-        margin: 1 0;
-    }
-
-    #chat_container SystemMessage {
-        text-align: center;
-        margin: 1 0;
-    }
 
     #chat_container #input_row {
         height: auto;
@@ -352,6 +350,11 @@ class ChatApp(App):
     TITLE = "Ephemeral Chat"
     SUB_TITLE = "Secure E2E Encrypted Messaging"
 
+    def __init__(self):
+        super().__init__()
+        # One real-time connection per session, routed to whichever screen needs it
+        self.dispatcher = EventDispatcher()
+
     def on_mount(self) -> None:
         """Start with login screen."""
         self.push_screen(LoginScreen())
@@ -7,76 +7,252 @@ from textual.screen import Screen
 from textual.containers import Container, Vertical, Horizontal, ScrollableContainer, Center
 from textual.widgets import Header, Footer, Input, Button, Label, Static, LoadingIndicator
 from textual.binding import Binding
+from textual.geometry import Size
+from textual.scroll_view import ScrollView
+from textual.strip import Strip
 from rich.text import Text
 from rich.panel import Panel
 from rich.align import Align
+from bisect import bisect_right
 from datetime import datetime
 import asyncio
-import json
+import uuid
+from typing import Dict, List, Optional
 
-from api import api_client, ws_client, WebSocketClient
+from api import api_client, send_queue, is_rejected
+import store
 from crypto import get_or_create_chat_crypto, encrypt_for_peer, decrypt_from_peer
 
+# History is decrypted off the UI thread this many messages at a time, newest first
+DECRYPT_CHUNK = 100
+
+
+# Connection states (see api.RealtimeClient) as shown in the chat header
+CONNECTION_LABELS = {
+    "connecting": "[yellow]◌ Connecting...[/]",
+    "connected": "[green]● Live[/]",
+    "waiting": "[yellow]◌ Reconnecting...[/]",
+    "auth_failed": "[red]✗ Session expired - log in again[/]",
+    "closed": "[dim]○ Offline[/]",
+}
+
+# Delivery marks on our own bubbles
+STATUS_MARKS = {
+    "pending": ("…", "dim"),
+    "sent": ("✓", "dim"),
+    "queued": ("⏱ queued", "yellow"),
+    "failed": ("✗ not sent", "bold red"),
+}
+
+
+def bubble_panel(sender: str, text: str, timestamp: str, is_mine: bool = False, status: str = "sent") -> Panel:
+    """Render a chat message as a styled panel."""
+    # Format timestamp
+    try:
+        dt = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+        time_str = dt.strftime("%H:%M")
+    except:
+        time_str = ""
+
+    # Create message content
+    content = Text()
+
+    if is_mine:
+        mark, mark_style = STATUS_MARKS[status]
+        content.append(f"{text}\n", style="bold cyan")
+        content.append(f"{time_str} ", style="dim")
+        content.append(mark, style=mark_style)
+        panel = Panel(
+            content,
+            border_style="red" if status == "failed" else "cyan",
+            title=f"[bold cyan]You[/]",
+            title_align="right",
+            padding=(0, 1),
+        )
+    else:
+        content.append(f"{text}\n", style="bold green")
+        content.append(f"{time_str}", style="dim")
+        panel = Panel(
+            content,
+            border_style="green",
+            title=f"[bold green]{sender}[/]",
+            title_align="left",
+            padding=(0, 1),
+        )
 
-class MessageBubble(Static):
-    """A styled message bubble for chat messages."""
-
-    def __init__(self, sender: str, text: str, timestamp: str, is_mine: bool = False):
-        self.sender = sender
-        self.text = text
-        self.timestamp = timestamp
-        self.is_mine = is_mine
-        super().__init__()
-
-    def render(self) -> Panel:
-        """Render message as a styled panel."""
-        # Format timestamp
-        try:
-            dt = datetime.fromisoformat(self.timestamp.replace('Z', '+00:00'))
-            time_str = dt.strftime("%H:%M")
-        except:
-            time_str = ""
-
-        # Create message content
-        content = Text()
-
-        if self.is_mine:
-            content.append(f"{self.text}\n", style="bold cyan")
-            content.append(f"{time_str} ✓", style="dim")
-            panel = Panel(
-                content,
-                border_style="cyan",
-                title=f"[bold cyan]You[/]",
-                title_align="right",
-                padding=(0, 1),
-            )
-        else:
-            content.append(f"{self.text}\n", style="bold green")
-            content.append(f"{time_str}", style="dim")
-            panel = Panel(
-                content,
-                border_style="green",
-                title=f"[bold green]{self.sender}[/]",
-                title_align="left",
-                padding=(0, 1),
-            )
+    return panel
 
-        return panel
 
+def system_text(text: str) -> Text:
+    """Render a system notice as italic text."""
+    msg = Text(justify="center")
+    msg.append("● ", style="yellow")
+    msg.append(text, style="italic yellow dim")
+    return msg
 
-class SystemMessage(Static):
-    """A system message for notifications."""
 
-    def __init__(self, text: str):
-        self.text = text
-        super().__init__()
+class MessageLog(ScrollView):
+    """
+    Virtualized chat log. Messages live in a backing list and only the lines in
+    view are rendered; each entry's rendered strips are cached until the width
+    changes, so scrolling a long history never re-renders or relayouts. Older
+    batches can be inserted above earlier ones without moving the view.
+    """
 
-    def render(self) -> Text:
-        """Render as centered italic text."""
-        msg = Text()
-        msg.append("● ", style="yellow")
-        msg.append(self.text, style="italic yellow dim")
-        return msg
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.entries: List[tuple] = []  # ("message", (sender, text, timestamp, is_mine)) or ("system", text)
+        self.message_count = 0
+        self._offsets: List[int] = []  # First line of each entry
+        self._heights: List[int] = []
+        self._strips: List[Optional[List[Strip]]] = []  # Rendered lines per entry, None until drawn
+        self._width = 0
+
+    def add_messages(self, messages: List[tuple], before: Optional[tuple] = None) -> Optional[tuple]:
+        """
+        Add (sender, text, timestamp, is_mine) tuples in one batch, appended or
+        inserted above the entry `before`. Returns the first new entry, to pass
+        as `before` when adding an older batch.
+        """
+        if not messages:
+            return before
+        entries = [("message", message) for message in messages]
+        index = len(self.entries) if before is None else self._index_of(before)
+        self._insert(index, entries)
+        self.message_count += len(messages)
+        return entries[0]
+
+    def add_system(self, text: str, before: Optional[tuple] = None) -> tuple:
+        """Add a system line, appended or inserted above the entry `before`. Returns the entry."""
+        entry = ("system", text)
+        self._insert(len(self.entries) if before is None else self._index_of(before), [entry])
+        return entry
+
+    def update_message(self, entry: tuple, message: tuple) -> tuple:
+        """Replace a message entry's payload in place (e.g. its delivery status). Returns the new entry."""
+        index = self._index_of(entry)
+        if index == len(self.entries):
+            return entry
+        new_entry = ("message", message)
+        self.entries[index] = new_entry
+        self._strips[index] = None
+        if self._width:
+            self._heights[index] = self._entry_height(new_entry)
+            self._reflow(index)
+        self._update_size()
+        return new_entry
+
+    def remove(self, entry: tuple):
+        """Remove an entry, e.g. a pending bubble that a history fetch already showed."""
+        index = self._index_of(entry)
+        if index == len(self.entries):
+            return
+        del self.entries[index], self._strips[index]
+        if self._width:
+            del self._heights[index]
+            self._reflow(index)
+        if entry[0] == "message":
+            self.message_count -= 1
+        self._update_size()
+
+    def clear(self):
+        self.entries.clear()
+        self._offsets.clear()
+        self._heights.clear()
+        self._strips.clear()
+        self.message_count = 0
+        self._update_size()
+
+    def _index_of(self, entry: tuple) -> int:
+        # By identity: equal tuples (same text, same minute) can be different entries
+        for index in range(len(self.entries) - 1, -1, -1):
+            if self.entries[index] is entry:
+                return index
+        return len(self.entries)
+
+    def _insert(self, index: int, entries: List[tuple]):
+        at_bottom = self.scroll_y >= self.max_scroll_y
+        above_view = bool(self._offsets) and index < len(self._offsets) and self._offsets[index] <= self.scroll_y
+        self.entries[index:index] = entries
+        self._strips[index:index] = [None] * len(entries)
+        added = 0
+        if self._width:
+            heights = [self._entry_height(entry) for entry in entries]
+            self._heights[index:index] = heights
+            self._reflow(index)
+            added = sum(heights)
+        self._update_size()
+        if at_bottom:
+            self.call_after_refresh(self.scroll_end, animate=False)
+        elif above_view and added:
+            # Keep the lines being read in place while older history lands above
+            self.scroll_to(y=self.scroll_y + added, animate=False)
+
+    def _renderable(self, entry: tuple):
+        kind, payload = entry
+        return bubble_panel(*payload) if kind == "message" else system_text(payload)
+
+    def _entry_height(self, entry: tuple) -> int:
+        """Lines an entry takes at the current width, without rendering it."""
+        console = self.app.console
+        kind, payload = entry
+        if kind == "message":
+            # Border and padding take 4 columns; borders plus the time line take 3 rows
+            inner = Text(payload[1])
+            lines = len(inner.wrap(console, max(1, self._width - 4)))
+            return lines + 3 + 1  # Blank line between bubbles
+        return len(system_text(payload).wrap(console, self._width)) + 1
+
+    def _measure(self):
+        self._heights = [self._entry_height(entry) for entry in self.entries]
+        self._reflow(0)
+
+    def _reflow(self, start: int):
+        """Recompute line offsets from entry `start` on."""
+        del self._offsets[start:]
+        offset = self._offsets[-1] + self._heights[start - 1] if start else 0
+        for height in self._heights[start:]:
+            self._offsets.append(offset)
+            offset += height
+
+    def _update_size(self):
+        total = self._offsets[-1] + self._heights[-1] if self._offsets else 0
+        self.virtual_size = Size(self._width, total)
+        self.refresh()
+
+    def on_resize(self) -> None:
+        width = self.scrollable_content_region.width
+        if width != self._width:
+            # Wrapping changes with width, so every cached render is stale
+            self._width = width
+            self._strips = [None] * len(self.entries)
+            self._measure()
+            self._update_size()
+
+    def _render_entry(self, index: int) -> List[Strip]:
+        strips = self._strips[index]
+        if strips is None:
+            console = self.app.console
+            lines = console.render_lines(
+                self._renderable(self.entries[index]),
+                console.options.update_width(self._width),
+                style=self.rich_style,
+            )
+            strips = [Strip(line, self._width) for line in lines]
+            # Keep the measured height exactly so line offsets stay valid
+            height = self._heights[index]
+            strips = strips[:height] + [Strip.blank(self._width, self.rich_style)] * (height - len(strips))
+            self._strips[index] = strips
+        return strips
+
+    def render_line(self, y: int) -> Strip:
+        scroll_x, scroll_y = self.scroll_offset
+        line = scroll_y + y
+        if not self._offsets or line >= self._offsets[-1] + self._heights[-1]:
+            return Strip.blank(self.size.width, self.rich_style)
+        index = bisect_right(self._offsets, line) - 1
+        strip = self._render_entry(index)[line - self._offsets[index]]
+        return strip.crop(scroll_x, scroll_x + self.size.width)
 
 
 class LoginScreen(Screen):
@@ -160,6 +336,9 @@ class LoginScreen(Screen):
             success = await api_client.signup(username, password)
 
         if success:
+            # Key derivation for the local store takes a moment - keep the UI responsive
+            await asyncio.to_thread(store.open_store, api_client.username, password)
+            await self.app.dispatcher.start()
             status_label.update(f"[green]✓ Welcome, {username}![/]")
             await asyncio.sleep(0.5)  # Brief pause for effect
             self.app.push_screen(MenuScreen())
@@ -236,6 +415,10 @@ class MenuScreen(Screen):
 
     async def action_logout(self) -> None:
         """Logout and return to login screen."""
+        await self.app.dispatcher.stop()
+        await send_queue.close()
+        store.close_store()
+        await api_client.logout()
         await api_client.close()
         self.app.pop_screen()
 
@@ -323,6 +506,10 @@ class RecentChatsScreen(Screen):
         Binding("escape", "back", "Back"),
     ]
 
+    def __init__(self):
+        super().__init__()
+        self.conversations: Dict[str, dict] = {}
+
     def compose(self) -> ComposeResult:
         yield Header(show_clock=True)
         yield Container(
@@ -342,10 +529,12 @@ class RecentChatsScreen(Screen):
         container = self.query_one("#contacts_list", ScrollableContainer)
 
         try:
-            contacts = await api_client.get_contacts()
+            # One request gives peers, last activity and unread counts
+            page = await api_client.get_conversations()
+            conversations = page["conversations"]
             loading.remove()
 
-            if not contacts:
+            if not conversations:
                 container.mount(
                     Static(
                         "[dim]No recent conversations\nStart a new chat to get started![/]",
@@ -353,9 +542,12 @@ class RecentChatsScreen(Screen):
                     )
                 )
             else:
-                for i, contact in enumerate(contacts):
+                for i, conversation in enumerate(conversations):
+                    contact = conversation["peer"]
+                    # A copy: badge updates mustn't leak into the client's response cache
+                    self.conversations[contact] = dict(conversation)
                     btn = Button(
-                        f"💬  {contact}",
+                        self.conversation_label(conversation),
                         id=f"contact_{contact}",
                         variant="primary" if i == 0 else "default"
                     )
@@ -367,6 +559,52 @@ class RecentChatsScreen(Screen):
                 Static(f"[red]Failed to load contacts: {str(e)}[/]")
             )
 
+        # Keep badges live while the list is open
+        self.app.dispatcher.add_listener(self.on_chat_event)
+
+    def on_unmount(self) -> None:
+        self.app.dispatcher.remove_listener(self.on_chat_event)
+
+    def on_chat_event(self, peer: str, event: dict) -> None:
+        """Bump a conversation's unread badge and move it to the top."""
+        container = self.query_one("#contacts_list", ScrollableContainer)
+        conversation = self.conversations.setdefault(peer, {"peer": peer, "unread_count": 0})
+        conversation["unread_count"] = conversation.get("unread_count", 0) + 1
+        conversation["last_message_at"] = event.get("timestamp", "")
+        label = self.conversation_label(conversation)
+
+        buttons = self.query(f"#contact_{peer}")
+        if buttons:
+            btn = buttons.first(Button)
+            btn.label = label
+            if container.children and container.children[0] is not btn:
+                container.move_child(btn, before=0)
+        else:
+            for empty in self.query("#empty_state"):
+                empty.remove()
+            btn = Button(label, id=f"contact_{peer}", variant="default")
+            if container.children:
+                container.mount(btn, before=0)
+            else:
+                container.mount(btn)
+
+    @staticmethod
+    def conversation_label(conversation: dict) -> str:
+        """Button text: peer, unread badge and last activity time."""
+        label = f"💬  {conversation['peer']}"
+
+        unread = conversation.get("unread_count", 0)
+        if unread:
+            label += f"  ({unread} new)"
+
+        try:
+            dt = datetime.fromisoformat(conversation["last_message_at"].replace('Z', '+00:00'))
+            label += f"  · {dt.strftime('%H:%M')}"
+        except (KeyError, ValueError, AttributeError):
+            pass
+
+        return label
+
     async def on_button_pressed(self, event: Button.Pressed) -> None:
         """Handle contact selection or back."""
         if event.button.id == "back":
@@ -394,24 +632,31 @@ class ChatScreen(Screen):
         super().__init__()
         self.other_user = other_user
         self.crypto = get_or_create_chat_crypto(other_user)
-        self.ws_client = None
-        self.message_count = 0
+        self.last_seq = 0  # Highest per-conversation sequence number seen
+        self.seen_seqs: set = set()
+        self.outgoing: Dict[str, tuple] = {}  # Idempotency key -> bubble awaiting an ack
+        self.in_flight: set = set()  # Keys the send queue is working on
+        self.loading = True  # Until the history is shown; new events wait in held_events
+        self.held_events: List[Dict] = []
+        self.history_anchor: Optional[tuple] = None  # History goes above this line
 
     def compose(self) -> ComposeResult:
         yield Header(show_clock=True)
         yield Container(
             Horizontal(
                 Label(f"💬 {self.other_user}", id="chat_header"),
+                Label("", id="connection_badge"),
                 Label("🔒 E2E Encrypted", id="encryption_badge"),
                 id="chat_header_row"
             ),
             Static("", id="divider"),
-            ScrollableContainer(id="messages"),
+            MessageLog(id="messages"),
             Static("", id="input_divider"),
             Horizontal(
                 Input(
                     placeholder="💭 Type your message... (Press Enter to send)",
-                    id="message_input"
+                    id="message_input",
+                    max_length=2000  # Keeps the ciphertext inside the server's size budget
                 ),
                 Button("Send ➤", variant="primary", id="send"),
                 id="input_row"
@@ -422,62 +667,68 @@ class ChatScreen(Screen):
         yield Footer()
 
     async def on_mount(self) -> None:
-        """Load message history and start WebSocket."""
-        messages_container = self.query_one("#messages", ScrollableContainer)
-        footer = self.query_one("#chat_footer", Static)
+        """Start loading history in the background and focus the input."""
+        self.history_anchor = self.query_one("#messages", MessageLog).add_system("Loading conversation history...")
+        # A worker, so input stays live while a long history is decrypted
+        self.run_worker(self.load_history(), exclusive=True)
+        self.query_one("#message_input", Input).focus()
 
-        # Show loading state
-        messages_container.mount(
-            SystemMessage("Loading conversation history...")
-        )
+    async def load_history(self) -> None:
+        """
+        Load message history above the loading line. The chat receives its
+        events and send results from the start, so bubbles sent meanwhile stay
+        below the history and new messages are held until it's shown.
+        """
+        log = self.query_one("#messages", MessageLog)
+        footer = self.query_one("#chat_footer", Static)
+        dispatcher = self.app.dispatcher
+        anchor = self.history_anchor
+        # Whatever arrived while the chat was closed
+        buffered, complete = dispatcher.attach(self)
 
         try:
-            # Load existing messages
-            messages = await api_client.get_messages(self.other_user)
-
-            # Clear loading message
-            messages_container.remove_children()
+            # Show what's stored locally, plus the buffered events or a fetch
+            stored = store.local_store.load(self.other_user) if store.local_store else []
+            stored = await self.retry_undecrypted(stored)
+            after_seq = max((msg["seq"] for msg in stored), default=None)
+            if complete and self.continues(after_seq, buffered):
+                messages = buffered  # Nothing missing, so no fetch needed
+            else:
+                messages = await api_client.get_messages(self.other_user, after_seq=after_seq)
 
-            if not messages:
-                messages_container.mount(
-                    SystemMessage(f"Start of conversation with {self.other_user}")
-                )
+            if not stored and not messages:
+                log.add_system(f"Start of conversation with {self.other_user}", before=anchor)
             else:
-                for msg in messages:
-                    try:
-                        # Decrypt message
-                        decrypted = decrypt_from_peer(msg["sender"], msg["encrypted_content"])
-                        if decrypted:
-                            self.display_message(
-                                msg["sender"],
-                                decrypted,
-                                msg["timestamp"]
-                            )
-                    except Exception:
-                        # Skip messages that can't be decrypted
-                        continue
+                self.display_stored(stored, before=anchor)
+                await self.display_history(messages, before=anchor)
+            self.display_outbox(before=anchor)
 
             footer.update(f"[dim]{self.message_count} messages • Press ESC to go back[/]")
+            # Covers the history just shown, fetched or not
+            dispatcher.mark_read(self.other_user)
 
         except Exception as e:
-            messages_container.remove_children()
-            messages_container.mount(
-                SystemMessage(f"Failed to load messages: {str(e)}")
-            )
+            log.add_system(f"Failed to load messages: {str(e)}", before=anchor)
 
-        # Start WebSocket for real-time updates
-        global ws_client
-        if not ws_client:
-            ws_client = WebSocketClient(
-                api_client.username,
-                api_client.token,
-                self.on_websocket_message
-            )
-            asyncio.create_task(ws_client.connect())
-            messages_container.mount(SystemMessage("Connected • Real-time messaging active"))
+        log.remove(anchor)
+        self.loading = False
+        # Buffered events (in case the fetch lacked them) and ones that came in
+        # while loading; anything already shown is skipped by seq
+        held, self.held_events = self.held_events, []
+        for event in buffered + held:
+            await self.on_message_event(event)
 
-        # Focus message input
-        self.query_one("#message_input", Input).focus()
+    @staticmethod
+    def continues(after_seq: Optional[int], events: List[Dict]) -> bool:
+        """True if the events' seqs follow on from after_seq without a gap."""
+        start = (after_seq or 0) + 1
+        return bool(events) and [event.get("seq") for event in events] == list(range(start, start + len(events)))
+
+    def on_unmount(self) -> None:
+        self.app.dispatcher.detach(self)
+
+    def show_connection_state(self, state: str):
+        self.query_one("#connection_badge", Label).update(CONNECTION_LABELS.get(state, state))
 
     async def on_button_pressed(self, event: Button.Pressed) -> None:
         """Handle send button."""
@@ -490,7 +741,7 @@ class ChatScreen(Screen):
             await self.send_message()
 
     async def send_message(self) -> None:
-        """Encrypt and send a message."""
+        """Encrypt a message, show it straight away as pending and queue it for sending."""
         message_input = self.query_one("#message_input", Input)
         text = message_input.value.strip()
 
@@ -500,58 +751,204 @@ class ChatScreen(Screen):
         try:
             # Encrypt message
             encrypted = encrypt_for_peer(self.other_user, text)
+        except RuntimeError:
+            # Key exchange needed
+            self.display_system_message("Establishing secure connection...")
+            return
 
-            # Send to backend
-            success = await api_client.send_message(self.other_user, encrypted)
-
-            if success:
-                # Display locally
-                self.display_message(api_client.username, text, datetime.now().isoformat())
-                message_input.value = ""
+        message_input.value = ""
+        timestamp = datetime.now().isoformat()
+        key = uuid.uuid4().hex
+        if store.local_store:
+            # Persisted first, so an offline send survives until the next reconnect
+            store.local_store.queue_outgoing(self.other_user, key, encrypted, text, timestamp)
+        message = (api_client.username, text, timestamp, True, "pending")
+        self.outgoing[key] = self.query_one("#messages", MessageLog).add_messages([message])
+        self.in_flight.add(key)
+
+        dispatcher = self.app.dispatcher
+
+        async def on_done(receipt: Optional[Dict]):
+            # Through the dispatcher, so a send finishing after the chat closed is still recorded
+            dispatcher.settle_send(self.other_user, key, encrypted, text, receipt)
+
+        send_queue.submit(self.other_user, encrypted, on_done, idempotency_key=key)
+
+    def on_send_done(self, key: str, encrypted: str, receipt: Optional[Dict]):
+        """
+        Mark a pending bubble sent, queued for a retry, or failed if the server
+        rejected it, once its send finishes.
+        """
+        self.in_flight.discard(key)
+        entry = self.outgoing.get(key)
+        if entry is None:
+            return  # An outbox flush already settled it
+        log = self.query_one("#messages", MessageLog)
+        footer = self.query_one("#chat_footer", Static)
+        sender, text, timestamp, is_mine, _ = entry[1]
+
+        if is_rejected(receipt):
+            # No retry will get it through, so it mustn't hold up the outbox
+            del self.outgoing[key]
+            if store.local_store:
+                store.local_store.remove_outgoing([key])
+            log.update_message(entry, (sender, text, timestamp, is_mine, "failed"))
+            footer.update(f"[dim]{self.message_count} messages • [red]Message not sent ✗[/][/]")
+            return
 
-                # Update footer
-                footer = self.query_one("#chat_footer", Static)
-                footer.update(f"[dim]{self.message_count} messages • Message sent ✓[/]")
+        if receipt is None:
+            if store.local_store:
+                # Still in the outbox: it goes out on the next retry or reconnect
+                self.outgoing[key] = log.update_message(entry, (sender, text, timestamp, is_mine, "queued"))
+                footer.update(f"[dim]{self.message_count} messages • [yellow]Offline - message queued[/][/]")
             else:
-                self.display_system_message("Failed to send message - please try again")
+                del self.outgoing[key]
+                log.update_message(entry, (sender, text, timestamp, is_mine, "failed"))
+                footer.update(f"[dim]{self.message_count} messages • [red]Message not sent ✗[/][/]")
+            return
 
-        except RuntimeError:
-            # Key exchange needed
-            self.display_system_message("Establishing secure connection...")
+        del self.outgoing[key]
+        if store.local_store:
+            store.local_store.remove_outgoing([key])
+        if self.track_seq(receipt.get("seq")):
+            log.update_message(entry, (sender, text, timestamp, is_mine, "sent"))
+            self.remember([{
+                "seq": receipt.get("seq"), "sender": sender,
+                "timestamp": receipt["timestamp"], "encrypted_content": encrypted, "text": text
+            }])
+        else:
+            # A gap fill already showed (and stored) it
+            log.remove(entry)
+        footer.update(f"[dim]{self.message_count} messages • Message sent ✓[/]")
+
+    def display_outbox(self, before: Optional[tuple] = None):
+        """Show messages still waiting in the outbox from an earlier session."""
+        if not store.local_store:
+            return
+        log = self.query_one("#messages", MessageLog)
+        for msg in store.local_store.outbox(self.other_user):
+            if msg["idempotency_key"] not in self.outgoing and msg["text"] is not None:
+                message = (api_client.username, msg["text"], msg["timestamp"], True, "queued")
+                self.outgoing[msg["idempotency_key"]] = log.add_messages([message], before=before)
+
+    def track_seq(self, seq: Optional[int]) -> bool:
+        """Record a sequence number. Returns False if it was already displayed."""
+        if seq is None:
+            return True
+        if seq in self.seen_seqs:
+            return False
+        self.seen_seqs.add(seq)
+        self.last_seq = max(self.last_seq, seq)
+        return True
+
+    def remember(self, messages: List[Dict]):
+        """Save messages (with their decrypted text) to the local store."""
+        if store.local_store and messages:
+            store.local_store.save(self.other_user, messages)
+
+    @property
+    def message_count(self) -> int:
+        return self.query_one("#messages", MessageLog).message_count
+
+    def display_stored(self, messages: List[Dict], before: Optional[tuple] = None):
+        """Display messages from the local store - already decrypted - in one batch."""
+        self.query_one("#messages", MessageLog).add_messages([
+            (msg["sender"], msg["text"], msg["timestamp"], msg["sender"] == api_client.username)
+            for msg in messages
+            if self.track_seq(msg["seq"]) and msg["text"] is not None
+        ], before=before)
+
+    async def retry_undecrypted(self, stored: List[Dict]) -> List[Dict]:
+        """
+        Decrypt stored messages that had no text when saved (e.g. received
+        before the key exchange finished), keeping any that now succeed.
+        """
+        missing = [msg for msg in stored if msg["text"] is None]
+        if not missing:
+            return stored
+        decrypted = {
+            msg["seq"]: msg for msg in await asyncio.to_thread(self.decrypt_chunk, missing)
+            if msg["text"] is not None
+        }
+        self.remember(list(decrypted.values()))
+        return [decrypted.get(msg["seq"], msg) for msg in stored]
+
+    async def display_history(self, messages: List[Dict], before: Optional[tuple] = None):
+        """
+        Decrypt and display fetched messages (appended, or above the entry
+        `before`), skipping ones already shown.
+        Decryption runs in a worker thread a chunk at a time, newest first; each
+        chunk is inserted above the previous one so recent messages show up
+        straight away and the UI stays responsive while older ones load.
+        """
+        log = self.query_one("#messages", MessageLog)
+        footer = self.query_one("#chat_footer", Static)
+        pending = [msg for msg in messages if self.track_seq(msg.get("seq"))]
+        for end in range(len(pending), 0, -DECRYPT_CHUNK):
+            fetched = await asyncio.to_thread(self.decrypt_chunk, pending[max(0, end - DECRYPT_CHUNK):end])
+            before = log.add_messages([
+                (msg["sender"], msg["text"], msg["timestamp"], msg["sender"] == api_client.username)
+                for msg in fetched if msg["text"]
+            ], before=before)
+            self.remember(fetched)
+            if len(pending) > DECRYPT_CHUNK:
+                done = len(pending) - max(0, end - DECRYPT_CHUNK)
+                footer.update(f"[dim]🔓 Decrypting history... {done}/{len(pending)}[/]")
+
+    @staticmethod
+    def decrypt_chunk(messages: List[Dict]) -> List[Dict]:
+        """Decrypt a batch of messages (runs in a worker thread)."""
+        fetched = []
+        for msg in messages:
+            try:
+                # Decrypt message
+                decrypted = decrypt_from_peer(msg["sender"], msg["encrypted_content"])
+            except Exception:
+                # Messages that can't be decrypted are stored but not shown
+                decrypted = None
+            fetched.append({**msg, "text": decrypted})
+        return fetched
+
+    async def fill_gap(self):
+        """Fetch exactly the messages missed since the last known sequence number."""
+        missed = await api_client.get_messages(self.other_user, after_seq=self.last_seq)
+        await self.display_history(missed)
 
     def display_message(self, sender: str, text: str, timestamp: str):
         """Display a message bubble in the chat."""
-        messages_container = self.query_one("#messages", ScrollableContainer)
-
         is_me = sender == api_client.username
-        bubble = MessageBubble(sender, text, timestamp, is_me)
-
-        messages_container.mount(bubble)
-        messages_container.scroll_end()
-        self.message_count += 1
+        self.query_one("#messages", MessageLog).add_messages([(sender, text, timestamp, is_me)])
 
     def display_system_message(self, text: str):
         """Display a system message."""
-        messages_container = self.query_one("#messages", ScrollableContainer)
-        messages_container.mount(SystemMessage(text))
-        messages_container.scroll_end()
+        self.query_one("#messages", MessageLog).add_system(text)
 
-    async def on_websocket_message(self, message: str):
-        """Handle incoming WebSocket messages."""
+    async def on_message_event(self, data: Dict):
+        """Handle a new_message event routed here by the dispatcher."""
+        if self.loading:
+            self.held_events.append(data)  # Shown once the history is in place
+            return
         try:
-            data = json.loads(message)
-
-            if data.get("type") == "new_message":
-                sender = data["sender"]
-                if sender == self.other_user:
-                    # Decrypt and display
-                    decrypted = decrypt_from_peer(sender, data["encrypted_content"])
-                    if decrypted:
-                        self.display_message(sender, decrypted, data["timestamp"])
-
-                        # Update footer
-                        footer = self.query_one("#chat_footer", Static)
-                        footer.update(f"[dim]{self.message_count} messages • New message received ✓[/]")
+            seq = data.get("seq")
+            if seq is not None and self.last_seq and seq > self.last_seq + 1:
+                # Missed one or more messages (e.g. during a reconnect)
+                await self.fill_gap()
+                self.app.dispatcher.mark_read(self.other_user)
+            # The fill may not include this event yet (write-behind, cached history),
+            # so it's shown here unless the fill already did
+            if not self.track_seq(seq):
+                return
+            self.app.dispatcher.mark_read(self.other_user)
+
+            # Decrypt and display
+            decrypted = decrypt_from_peer(data["sender"], data["encrypted_content"])
+            self.remember([{**data, "text": decrypted}])
+            if decrypted:
+                self.display_message(data["sender"], decrypted, data["timestamp"])
+
+                # Update footer
+                footer = self.query_one("#chat_footer", Static)
+                footer.update(f"[dim]{self.message_count} messages • New message received ✓[/]")
 
         except Exception:
             pass  # Ignore malformed messages
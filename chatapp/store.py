@@ -0,0 +1,233 @@
+"""
+Local on-disk message store for the TUI, encrypted at rest.
+Keeps each conversation's messages (ciphertext and decrypted text) in SQLite so
+reopening a chat only fetches messages newer than the last stored sequence number,
+plus an outbox of sent messages the server hasn't acknowledged yet.
+Message text is sealed with ChaCha20-Poly1305 under a key derived from the
+user's password; routing metadata (peer, sender, seq, time) stays in the clear
+so it can be indexed.
+"""
+import os
+import sqlite3
+import time
+from datetime import datetime, timezone
+from typing import Optional, List, Dict
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+
+# Data directory from env or ~/.chatapp
+DATA_DIR = os.getenv("CHATAPP_DATA_DIR", os.path.join(os.path.expanduser("~"), ".chatapp"))
+
+RETENTION_HOURS = 24  # Matches the server's message TTL
+_CHECK_VALUE = b"chatapp-store-v1"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS messages (
+    peer TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    sender TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    created REAL NOT NULL,
+    encrypted_content TEXT NOT NULL,
+    sealed_text BLOB,
+    PRIMARY KEY (peer, seq)
+);
+CREATE INDEX IF NOT EXISTS messages_created ON messages (created);
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    peer TEXT NOT NULL,
+    idempotency_key TEXT NOT NULL UNIQUE,
+    timestamp TEXT NOT NULL,
+    encrypted_content TEXT NOT NULL,
+    sealed_text BLOB NOT NULL
+);
+"""
+
+
+class StoreKeyError(Exception):
+    """Raised when the password doesn't open an existing store."""
+
+
+def _epoch(timestamp: str) -> float:
+    """Epoch seconds for an API timestamp (naive timestamps are UTC)."""
+    parsed = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+class LocalStore:
+    """Per-user SQLite message store."""
+
+    def __init__(self, username: str, password: str, data_dir: str = DATA_DIR):
+        os.makedirs(data_dir, mode=0o700, exist_ok=True)
+        self.path = os.path.join(data_dir, f"{username}.db")
+        # Opened off the UI thread at login, then used from the event loop
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.executescript(_SCHEMA)
+        self.cipher = ChaCha20Poly1305(self._derive_key(password))
+        self._check_key()
+
+    def _meta(self, key: str) -> Optional[bytes]:
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _derive_key(self, password: str) -> bytes:
+        salt = self._meta("salt")
+        if salt is None:
+            salt = os.urandom(16)
+            with self.db:
+                self.db.execute("INSERT INTO meta VALUES ('salt', ?)", (salt,))
+        return Scrypt(salt=salt, length=32, n=2 ** 14, r=8, p=1).derive(password.encode("utf-8"))
+
+    def _check_key(self):
+        """Verify the derived key against the store, or initialize a new store."""
+        check = self._meta("check")
+        if check is None:
+            with self.db:
+                self.db.execute("INSERT INTO meta VALUES ('check', ?)", (self._seal(_CHECK_VALUE, b"check"),))
+        elif self._open(check, b"check") != _CHECK_VALUE:
+            self.db.close()
+            raise StoreKeyError("Password does not match the local message store")
+
+    def _seal(self, data: bytes, aad: bytes) -> bytes:
+        nonce = os.urandom(12)
+        return nonce + self.cipher.encrypt(nonce, data, aad)
+
+    def _open(self, sealed: bytes, aad: bytes) -> Optional[bytes]:
+        try:
+            return self.cipher.decrypt(sealed[:12], sealed[12:], aad)
+        except InvalidTag:
+            return None
+
+    @staticmethod
+    def _aad(peer: str, seq: int) -> bytes:
+        # Binds each sealed row to its place, so rows can't be swapped around
+        return f"{peer}:{seq}".encode("utf-8")
+
+    def last_seq(self, peer: str) -> int:
+        """Highest stored sequence number in a conversation (0 if none)."""
+        row = self.db.execute("SELECT MAX(seq) FROM messages WHERE peer = ?", (peer,)).fetchone()
+        return row[0] or 0
+
+    def load(self, peer: str) -> List[Dict]:
+        """Stored messages for a conversation in sequence order, with decrypted text (or None)."""
+        rows = self.db.execute(
+            "SELECT seq, sender, timestamp, encrypted_content, sealed_text FROM messages "
+            "WHERE peer = ? AND created >= ? ORDER BY seq",
+            (peer, time.time() - RETENTION_HOURS * 3600)
+        ).fetchall()
+
+        messages = []
+        for seq, sender, timestamp, encrypted_content, sealed_text in rows:
+            text = self._open(sealed_text, self._aad(peer, seq)) if sealed_text else None
+            messages.append({
+                "seq": seq,
+                "sender": sender,
+                "timestamp": timestamp,
+                "encrypted_content": encrypted_content,
+                "text": text.decode("utf-8") if text is not None else None,
+            })
+        return messages
+
+    def save(self, peer: str, messages: List[Dict]):
+        """
+        Store messages (API dicts plus a "text" key holding the plaintext, or None
+        if it couldn't be decrypted). Messages without a seq are skipped. Rows
+        without text keep their ciphertext so a later load can retry them, and
+        never replace text already stored.
+        """
+        rows = [
+            (
+                peer, msg["seq"], msg["sender"], msg["timestamp"], _epoch(msg["timestamp"]),
+                msg["encrypted_content"],
+                self._seal(msg["text"].encode("utf-8"), self._aad(peer, msg["seq"]))
+                if msg.get("text") is not None else None,
+            )
+            for msg in messages if msg.get("seq")
+        ]
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (peer, seq) DO UPDATE SET "
+                "sender = excluded.sender, timestamp = excluded.timestamp, created = excluded.created, "
+                "encrypted_content = excluded.encrypted_content, "
+                "sealed_text = COALESCE(excluded.sealed_text, messages.sealed_text)",
+                rows
+            )
+
+    def queue_outgoing(self, peer: str, idempotency_key: str, encrypted_content: str, text: str, timestamp: str):
+        """Hold a sent message in the outbox until the server acknowledges it."""
+        sealed = self._seal(text.encode("utf-8"), f"outbox:{idempotency_key}".encode("utf-8"))
+        with self.db:
+            self.db.execute(
+                "INSERT OR IGNORE INTO outbox (peer, idempotency_key, timestamp, encrypted_content, sealed_text) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (peer, idempotency_key, timestamp, encrypted_content, sealed)
+            )
+
+    def outbox(self, peer: Optional[str] = None) -> List[Dict]:
+        """Unacknowledged messages in the order they were sent, optionally for one conversation."""
+        query = "SELECT peer, idempotency_key, timestamp, encrypted_content, sealed_text FROM outbox"
+        params: tuple = ()
+        if peer is not None:
+            query += " WHERE peer = ?"
+            params = (peer,)
+        rows = self.db.execute(query + " ORDER BY id", params).fetchall()
+
+        messages = []
+        for peer, idempotency_key, timestamp, encrypted_content, sealed_text in rows:
+            text = self._open(sealed_text, f"outbox:{idempotency_key}".encode("utf-8"))
+            messages.append({
+                "peer": peer,
+                "idempotency_key": idempotency_key,
+                "timestamp": timestamp,
+                "encrypted_content": encrypted_content,
+                "text": text.decode("utf-8") if text is not None else None,
+            })
+        return messages
+
+    def remove_outgoing(self, idempotency_keys: List[str]):
+        """Drop acknowledged messages from the outbox."""
+        with self.db:
+            self.db.executemany("DELETE FROM outbox WHERE idempotency_key = ?", [(key,) for key in idempotency_keys])
+
+    def prune(self, hours: int = RETENTION_HOURS) -> int:
+        """Delete messages older than the retention window. Returns how many were removed."""
+        with self.db:
+            cursor = self.db.execute("DELETE FROM messages WHERE created < ?", (time.time() - hours * 3600,))
+        return cursor.rowcount
+
+    def close(self):
+        self.db.close()
+
+
+# Opened at login, closed at logout
+local_store: Optional[LocalStore] = None
+
+
+def open_store(username: str, password: str) -> Optional[LocalStore]:
+    """Open (or create) the user's store and prune expired messages."""
+    global local_store
+    try:
+        try:
+            local_store = LocalStore(username, password)
+        except StoreKeyError:
+            # The server accepted the password, so it changed - the old store is unreadable
+            os.remove(os.path.join(DATA_DIR, f"{username}.db"))
+            local_store = LocalStore(username, password)
+    except (StoreKeyError, sqlite3.Error, OSError):
+        # A store we can't open just means no local history this session
+        local_store = None
+        return None
+    local_store.prune()
+    return local_store
+
+
+def close_store():
+    global local_store
+    if local_store:
+        local_store.close()
+        local_store = None
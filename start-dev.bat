@@ -26,4 +26,4 @@ echo [2/2] Starting FastAPI server on http://127.0.0.1:8000
 echo Press Ctrl+C to stop the server
 echo.
 
-uvicorn app:app --host 127.0.0.1 --port 8000 --reload
+uvicorn app:app --host 127.0.0.1 --port 8000 --reload --ws-max-size 16384
@@ -20,4 +20,4 @@ echo "[2/2] Starting FastAPI server on http://0.0.0.0:10000"
 echo "Production mode (no auto-reload)"
 echo ""
 
-uvicorn app:app --host 0.0.0.0 --port 10000
+uvicorn app:app --host 0.0.0.0 --port 10000 --ws-per-message-deflate true --ws-max-size 16384
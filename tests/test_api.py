@@ -5,6 +5,7 @@ Uses TestClient for testing with proper mocking.
 import pytest
 import sys
 import os
+import asyncio
 from datetime import datetime
 
 # Add backend to path
@@ -29,21 +30,41 @@ async def mock_get_user(username):
         }
     return None
 
-async def mock_save_message(sender, recipient, encrypted_content):
+async def mock_save_message(sender, recipient, encrypted_content, seq=None):
     return {
         "_id": "123",
         "sender": sender,
         "recipient": recipient,
         "encrypted_content": encrypted_content,
-        "timestamp": datetime.now()
+        "timestamp": datetime.now(),
+        "seq": 1
     }
 
 async def mock_get_messages_between(user1, user2, hours=24):
     return []
 
-async def mock_get_contacts(username):
+async def mock_get_contacts(username, limit=50):
     return []
 
+async def mock_get_conversations(username, limit=20, before=None):
+    return [
+        {"peer": "alice", "last_message_at": datetime(2024, 1, 1, 12, 0), "last_sender": "alice",
+         "last_ciphertext": "encrypted", "unread": 2},
+        {"peer": "bob", "last_message_at": datetime(2024, 1, 1, 11, 0)},
+    ][:limit]
+
+async def mock_mark_conversation_read(username, peer):
+    pass
+
+async def mock_get_recent_messages_for_user(username, hours=24, after=None, limit=None):
+    from bson import ObjectId
+    messages = [
+        {"_id": ObjectId(), "sender": "alice", "recipient": username,
+         "encrypted_content": f"encrypted{i}", "timestamp": datetime(2024, 1, 1, 12, i)}
+        for i in range(3)
+    ]
+    return messages[:limit]
+
 async def mock_init_db():
     pass
 
@@ -64,18 +85,33 @@ sys.modules['db'].get_user = mock_get_user
 sys.modules['db'].save_message = mock_save_message
 sys.modules['db'].get_messages_between = mock_get_messages_between
 sys.modules['db'].get_contacts = mock_get_contacts
+sys.modules['db'].get_conversations = mock_get_conversations
+sys.modules['db'].mark_conversation_read = mock_mark_conversation_read
+sys.modules['db'].get_recent_messages_for_user = mock_get_recent_messages_for_user
+sys.modules['db'].create_refresh_token = AsyncMock()
+sys.modules['db'].rotate_refresh_token = AsyncMock(return_value="testuser")
+sys.modules['db'].revoke_refresh_token = AsyncMock()
 
 # Patch cache module
 sys.modules['cache'].init_redis = mock_init_redis
 sys.modules['cache'].close_redis = mock_close_redis
-sys.modules['cache'].cache_messages = AsyncMock()
-sys.modules['cache'].get_cached_messages = AsyncMock(return_value=None)
-sys.modules['cache'].invalidate_message_cache = AsyncMock()
+sys.modules['cache'].get_or_load_conversation = AsyncMock(return_value=[])
+sys.modules['cache'].invalidate_conversation_cache = AsyncMock()
+sys.modules['cache'].claim_idempotency_key = AsyncMock(return_value=None)
+sys.modules['cache'].store_idempotent_result = AsyncMock()
+sys.modules['cache'].release_idempotency_key = AsyncMock()
+sys.modules['cache'].IDEMPOTENCY_PENDING = b"pending"
+sys.modules['cache'].get_version = AsyncMock(return_value=None)
+sys.modules['cache'].bump_versions = AsyncMock()
 sys.modules['cache'].cache_jwt_validation = AsyncMock()
 sys.modules['cache'].get_cached_jwt_validation = AsyncMock(return_value=None)
+sys.modules['cache'].get_pipeline_stats = MagicMock(return_value={
+    "commands": 0, "round_trips": 0, "pipelines": 0, "round_trips_saved": 0
+})
 
 # Now import app
 from fastapi.testclient import TestClient
+import app as app_module
 from app import app
 
 
@@ -94,6 +130,13 @@ def test_root_endpoint(client):
     assert response.json()["status"] == "online"
 
 
+def test_metrics_endpoint(client):
+    """Test performance counters endpoint."""
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert "round_trips_saved" in response.json()["cache"]
+
+
 def test_signup_success(client):
     """Test successful user signup."""
     response = client.post("/signup", json={
@@ -150,6 +193,18 @@ def test_login_success(client):
         assert response.status_code == 200
         data = response.json()
         assert "access_token" in data
+        assert data["refresh_token"]
+        assert data["expires_in"] == 3600
+
+
+def test_rate_limit_headers(client):
+    """Test that limited endpoints tell clients their remaining budget."""
+    with patch('app.verify_password', return_value=True):
+        response = client.post("/login", json={"username": "testuser", "password": "correctpassword"})
+
+    assert response.headers["X-RateLimit-Limit"] == "10"
+    assert int(response.headers["X-RateLimit-Remaining"]) < 10
+    assert "X-RateLimit-Reset" in response.headers
 
 
 def test_login_invalid_credentials(client):
@@ -162,6 +217,30 @@ def test_login_invalid_credentials(client):
     assert response.status_code == 401
 
 
+def test_refresh_token_rotates(client):
+    """Test that a refresh token buys a new access token and a new refresh token."""
+    from auth import hash_refresh_token, verify_jwt_token
+    rotate = AsyncMock(return_value="testuser")
+
+    with patch.object(app_module, "rotate_refresh_token", rotate):
+        response = client.post("/token/refresh", json={"refresh_token": "old-token"})
+
+    assert response.status_code == 200
+    data = response.json()
+    assert verify_jwt_token(data["access_token"]) == "testuser"
+    assert data["refresh_token"] != "old-token"
+    # Only hashes reach the database
+    assert rotate.call_args[0][:2] == (hash_refresh_token("old-token"), hash_refresh_token(data["refresh_token"]))
+
+
+def test_refresh_token_rejected(client):
+    """Test that an unknown, expired or reused refresh token gets a 401."""
+    with patch.object(app_module, "rotate_refresh_token", AsyncMock(return_value=None)):
+        response = client.post("/token/refresh", json={"refresh_token": "stale-token"})
+
+    assert response.status_code == 401
+
+
 def test_send_message_unauthorized(client):
     """Test sending message without authentication."""
     response = client.post("/messages", json={
@@ -172,6 +251,409 @@ def test_send_message_unauthorized(client):
     assert response.status_code == 422  # Missing token parameter
 
 
+def test_send_message_stores_idempotent_result(client):
+    """Test that a keyed send records its result for later duplicates."""
+    from auth import create_jwt_token
+    token = create_jwt_token("testuser")
+    store = AsyncMock()
+
+    with patch.object(app_module, "store_idempotent_result", store):
+        response = client.post(
+            "/messages",
+            params={"token": token},
+            json={"recipient": "alice", "encrypted_content": "encrypted_data"},
+            headers={"Idempotency-Key": "key-1"}
+        )
+
+    assert response.status_code == 201
+    store.assert_awaited_once()
+    assert store.call_args[0][:2] == ("testuser", "key-1")
+    assert store.call_args[0][2] == response.json()
+
+
+def test_send_message_duplicate_replays_result(client):
+    """Test that a retried key returns the first result without saving again."""
+    from auth import create_jwt_token
+    token = create_jwt_token("testuser")
+    stored = b'{"status": "sent", "timestamp": "2024-01-01T12:00:00+00:00", "seq": 7}'
+    save = AsyncMock()
+
+    with patch.object(app_module, "claim_idempotency_key", AsyncMock(return_value=stored)), \
+            patch.object(app_module, "save_message", save):
+        response = client.post(
+            "/messages",
+            params={"token": token},
+            json={"recipient": "alice", "encrypted_content": "encrypted_data"},
+            headers={"Idempotency-Key": "key-1"}
+        )
+
+    assert response.status_code == 201
+    assert response.json()["seq"] == 7
+    assert response.headers["Idempotent-Replayed"] == "true"
+    save.assert_not_awaited()
+
+
+def test_send_message_numbered_by_writer_while_stopped(client):
+    """Test that with write-behind on but stopped, direct saves take seqs from the writer's allocator."""
+    from auth import create_jwt_token
+    token = create_jwt_token("testuser")
+    writer = app_module.message_writer
+
+    with patch.object(writer, "enabled", True), \
+            patch.object(writer, "next_sequence", AsyncMock(return_value=9)), \
+            patch.object(app_module, "save_message", AsyncMock(side_effect=mock_save_message)) as save:
+        response = client.post("/messages", params={"token": token}, json={
+            "recipient": "alice", "encrypted_content": "encrypted_data"
+        })
+
+    assert response.status_code == 201
+    assert save.await_args.args == ("testuser", "alice", "encrypted_data", 9)
+
+
+def test_send_message_duplicate_in_progress(client):
+    """Test that a duplicate of a still-running request gets a 409."""
+    from auth import create_jwt_token
+    token = create_jwt_token("testuser")
+
+    with patch.object(app_module, "claim_idempotency_key", AsyncMock(return_value=b"pending")):
+        response = client.post(
+            "/messages",
+            params={"token": token},
+            json={"recipient": "alice", "encrypted_content": "encrypted_data"},
+            headers={"Idempotency-Key": "key-1"}
+        )
+
+    assert response.status_code == 409
+
+
+def test_send_message_batch_in_order(client):
+    """Test that a batch saves every message in order and reports each result."""
+    from auth import create_jwt_token
+    token = create_jwt_token("testuser")
+    stored = b'{"status": "sent", "timestamp": "2024-01-01T12:00:00+00:00", "seq": 3}'
+
+    async def claim(username, key):
+        return stored if key == "key-0" else None
+
+    with patch.object(app_module, "claim_idempotency_key", AsyncMock(side_effect=claim)), \
+            patch.object(app_module, "save_message", AsyncMock(side_effect=mock_save_message)) as save:
+        response = client.post("/messages/batch", params={"token": token}, json={"messages": [
+            {"recipient": "alice", "encrypted_content": f"encrypted{i}", "idempotency_key": f"key-{i}"}
+            for i in range(3)
+        ]})
+
+    assert response.status_code == 201
+    results = response.json()["results"]
+    assert [result["status"] for result in results] == ["sent"] * 3
+    assert results[0]["seq"] == 3  # Replayed, not saved again
+    assert [call.args[2] for call in save.await_args_list] == ["encrypted1", "encrypted2"]
+
+
+def test_send_message_batch_partial_failure(client):
+    """Test that a batch stops at the first message that can't be saved, keeping order."""
+    from auth import create_jwt_token
+    token = create_jwt_token("testuser")
+
+    async def claim(username, key):
+        return b"pending" if key == "key-1" else None
+
+    with patch.object(app_module, "claim_idempotency_key", AsyncMock(side_effect=claim)), \
+            patch.object(app_module, "save_message", AsyncMock(side_effect=mock_save_message)) as save:
+        response = client.post("/messages/batch", params={"token": token}, json={"messages": [
+            {"recipient": "alice", "encrypted_content": f"encrypted{i}", "idempotency_key": f"key-{i}"}
+            for i in range(3)
+        ]})
+
+    assert response.status_code == 201
+    assert [result["status"] for result in response.json()["results"]] == ["sent", "failed", "failed"]
+    assert [call.args[2] for call in save.await_args_list] == ["encrypted0"]
+
+
+def test_send_limit_shared_by_batches(client):
+    """Test that batched messages count against the same budget as single sends."""
+    from auth import create_jwt_token
+    token = create_jwt_token("testuser")
+    app.state.limiter = app_module.limiter  # The 429 handler reads its headers from here
+    app_module.limiter.reset()
+
+    try:
+        for size in (20, 10):
+            response = client.post("/messages/batch", params={"token": token}, json={"messages": [
+                {"recipient": "alice", "encrypted_content": "encrypted", "idempotency_key": f"key-{size}-{i}"}
+                for i in range(size)
+            ]})
+            assert response.status_code == 201
+        response = client.post("/messages", params={"token": token}, json={
+            "recipient": "alice", "encrypted_content": "encrypted_data"
+        })
+    finally:
+        app_module.limiter.reset()
+
+    assert response.status_code == 429
+
+
+def test_send_message_too_large(client):
+    """Test that oversized message bodies are rejected before parsing."""
+    from auth import create_jwt_token
+    from models import MAX_ENCRYPTED_CONTENT
+    token = create_jwt_token("testuser")
+
+    response = client.post("/messages", params={"token": token}, json={
+        "recipient": "alice",
+        "encrypted_content": "x" * (MAX_ENCRYPTED_CONTENT + 2048)
+    })
+
+    assert response.status_code == 413
+
+
+def test_send_message_content_max_length(client):
+    """Test that ciphertext over the model limit fails validation."""
+    from auth import create_jwt_token
+    from models import MAX_ENCRYPTED_CONTENT
+    token = create_jwt_token("testuser")
+
+    response = client.post("/messages", params={"token": token}, json={
+        "recipient": "alice",
+        "encrypted_content": "x" * (MAX_ENCRYPTED_CONTENT + 1)
+    })
+
+    assert response.status_code == 422
+
+
+def test_list_conversations(client):
+    """Test conversation list with unread counts and paging cursor."""
+    from auth import create_jwt_token
+    token = create_jwt_token("testuser")
+
+    response = client.get("/conversations", params={"token": token, "limit": 1})
+
+    assert response.status_code == 200
+    data = response.json()
+    assert data["conversations"][0]["peer"] == "alice"
+    assert data["conversations"][0]["unread_count"] == 2
+    assert data["next_cursor"].endswith(":alice")
+
+
+def test_list_conversations_bad_cursor(client):
+    """Test that a malformed cursor is rejected."""
+    from auth import create_jwt_token
+    token = create_jwt_token("testuser")
+
+    response = client.get("/conversations", params={"token": token, "cursor": "garbage"})
+
+    assert response.status_code == 400
+
+
+def test_sync_pages_with_cursor(client):
+    """Test delta sync returns a page and a cursor for the next one."""
+    from auth import create_jwt_token
+    token = create_jwt_token("testuser")
+
+    response = client.get("/sync", params={"token": token, "limit": 2})
+
+    assert response.status_code == 200
+    data = response.json()
+    assert len(data["messages"]) == 2
+    assert data["has_more"] is True
+    assert data["cursor"].startswith("1704110460000:")  # 2024-01-01 12:01 UTC
+
+
+def test_sync_cursor_trails_recent_messages(client):
+    """Test that the last page's cursor stays behind messages that may still be committing."""
+    from auth import create_jwt_token
+    from bson import ObjectId
+    from datetime import timezone
+    token = create_jwt_token("testuser")
+    now = datetime.now(timezone.utc)
+    recent = [{"_id": ObjectId(), "sender": "alice", "recipient": "testuser",
+               "encrypted_content": "encrypted", "timestamp": now}]
+
+    with patch.object(app_module, "get_recent_messages_for_user", AsyncMock(return_value=recent)):
+        response = client.get("/sync", params={"token": token})
+
+    data = response.json()
+    assert len(data["messages"]) == 1 and data["has_more"] is False
+    cursor_ms = int(data["cursor"].split(":")[0])
+    assert cursor_ms <= (now - app_module.SYNC_OVERLAP).timestamp() * 1000 + 1000
+
+
+def test_sync_bad_cursor(client):
+    """Test that a malformed sync cursor is rejected."""
+    from auth import create_jwt_token
+    token = create_jwt_token("testuser")
+
+    response = client.get("/sync", params={"token": token, "cursor": "123:not-an-id"})
+
+    assert response.status_code == 400
+
+
+def test_get_messages_after_seq(client):
+    """Test that after_seq returns only the messages a client is missing."""
+    from auth import create_jwt_token
+    token = create_jwt_token("testuser")
+    history = [
+        {"sender": "alice", "recipient": "testuser", "encrypted_content": f"c{seq}",
+         "timestamp": datetime(2024, 1, 1, 12, seq), "seq": seq}
+        for seq in range(1, 5)
+    ]
+
+    with patch.object(app_module, "get_or_load_conversation", AsyncMock(return_value=history)):
+        response = client.get("/messages/alice", params={"token": token, "after_seq": 2})
+
+    assert response.status_code == 200
+    assert [msg["seq"] for msg in response.json()] == [3, 4]
+
+
+def test_reading_history_does_not_mark_read(client):
+    """Test that GET /messages has no write; the read endpoint resets unread."""
+    from auth import create_jwt_token
+    token = create_jwt_token("testuser")
+    mark_read = AsyncMock()
+
+    with patch.object(app_module, "mark_conversation_read", mark_read):
+        assert client.get("/messages/alice", params={"token": token}).status_code == 200
+        mark_read.assert_not_called()
+
+        response = client.post("/conversations/alice/read", params={"token": token})
+
+    assert response.status_code == 204
+    mark_read.assert_awaited_once_with("testuser", "alice")
+
+
+def test_wait_returns_pending_messages_immediately(client):
+    """Test that the long-poll returns at once when newer messages exist."""
+    from auth import create_jwt_token
+    token = create_jwt_token("testuser")
+    history = [
+        {"sender": "alice", "recipient": "testuser", "encrypted_content": "c1",
+         "timestamp": datetime(2024, 1, 1, 12, 1), "seq": 1},
+        {"sender": "alice", "recipient": "testuser", "encrypted_content": "c2",
+         "timestamp": datetime(2024, 1, 1, 12, 2), "seq": 2},
+    ]
+
+    mark_read = AsyncMock()
+
+    with patch.object(app_module, "get_or_load_conversation", AsyncMock(return_value=history)), \
+            patch.object(app_module, "mark_conversation_read", mark_read):
+        response = client.get("/messages/alice/wait", params={"token": token, "after": 1})
+
+    assert response.status_code == 200
+    assert [msg["seq"] for msg in response.json()] == [2]
+    mark_read.assert_not_called()  # The client marks what it shows as read
+
+
+@pytest.mark.asyncio
+async def test_wait_woken_by_new_message():
+    """Test that a waiting long-poll is woken by fan-out and returns only the peer's new messages."""
+    queue = app_module.manager.subscribe("testuser")
+
+    async def publish():
+        await asyncio.sleep(0.01)
+        for sender, seq in (("mallory", 3), ("alice", 4)):
+            await app_module.manager.send_message("testuser", {
+                "type": "new_message", "sender": sender, "encrypted_content": "c",
+                "timestamp": "2024-01-01T12:00:00+00:00", "seq": seq
+            })
+
+    try:
+        messages, _ = await asyncio.gather(
+            app_module._wait_for_events(queue, "testuser", "alice", after=3, timeout=5),
+            publish()
+        )
+    finally:
+        app_module.manager.unsubscribe("testuser", queue)
+
+    assert [(msg["sender"], msg["seq"], msg["recipient"]) for msg in messages] == [("alice", 4, "testuser")]
+
+
+@pytest.mark.asyncio
+async def test_wait_times_out_empty():
+    """Test that a long-poll with nothing new returns an empty list."""
+    queue = app_module.manager.subscribe("testuser")
+    try:
+        messages = await app_module._wait_for_events(queue, "testuser", "alice", after=0, timeout=0.05)
+    finally:
+        app_module.manager.unsubscribe("testuser", queue)
+
+    assert messages == []
+
+
+@pytest.mark.asyncio
+async def test_event_stream_resumes_then_streams_live():
+    """Test SSE replay after Last-Event-ID, then live fan-out without duplicates."""
+    from bson import ObjectId
+    from datetime import timezone
+    request = MagicMock()
+    request.is_disconnected = AsyncMock(return_value=False)
+    after = (datetime(2024, 1, 1, tzinfo=timezone.utc), ObjectId())
+    stream = app_module.event_stream(request, "testuser", after)
+
+    assert (await stream.__anext__()).startswith("retry:")
+    replayed = [await stream.__anext__() for _ in range(3)]
+    assert all("event: new_message" in frame for frame in replayed)
+    assert '"encrypted_content": "encrypted2"' in replayed[-1]
+
+    # A live copy of an already replayed message is skipped, a new one is sent
+    duplicate_id = replayed[-1].split("\n")[0][len("id: "):]
+    live = {"_id": ObjectId(), "sender": "alice", "recipient": "testuser",
+            "encrypted_content": "live", "timestamp": datetime(2024, 1, 1, 13, 0), "seq": 9}
+    await app_module.manager.send_message("testuser", {"type": "new_message"}, event_id=duplicate_id)
+    await app_module.manager.send_message(
+        "testuser", app_module._message_event(live), event_id=app_module._encode_sync_cursor(live)
+    )
+
+    frame = await stream.__anext__()
+    assert frame.startswith(f"id: {app_module._encode_sync_cursor(live)}\n")
+    assert '"seq": 9' in frame
+
+    await stream.aclose()
+    assert "testuser" not in app_module.manager.subscribers
+
+
+def test_events_bad_last_event_id(client):
+    """Test that an unparseable Last-Event-ID is rejected."""
+    from auth import create_jwt_token
+    token = create_jwt_token("testuser")
+
+    response = client.get("/events", params={"token": token}, headers={"Last-Event-ID": "nope"})
+
+    assert response.status_code == 400
+
+
+def test_get_messages_etag_not_modified(client):
+    """Test that a matching If-None-Match gets a 304 without loading messages."""
+    from auth import create_jwt_token
+    token = create_jwt_token("testuser")
+    load = AsyncMock(return_value=[])
+
+    with patch.object(app_module, "get_version", AsyncMock(return_value="42")), \
+            patch.object(app_module, "get_or_load_conversation", load):
+        first = client.get("/messages/alice", params={"token": token})
+        etag = first.headers["ETag"]
+        second = client.get("/messages/alice", params={"token": token}, headers={"If-None-Match": etag})
+        # Weak comparison: a proxy may have dropped the W/ prefix
+        third = client.get("/messages/alice", params={"token": token}, headers={"If-None-Match": '"42-all"'})
+
+    assert first.status_code == 200
+    assert etag == 'W/"42-all"'  # Weak, since the body may be sent gzipped or not
+    assert second.status_code == 304
+    assert second.headers["ETag"] == etag
+    assert third.status_code == 304
+    load.assert_awaited_once()
+
+
+def test_get_contacts_etag_changes_with_version(client):
+    """Test that a stale ETag gets the full contact list again."""
+    from auth import create_jwt_token
+    token = create_jwt_token("testuser")
+
+    with patch.object(app_module, "get_version", AsyncMock(return_value="43")):
+        response = client.get("/contacts", params={"token": token}, headers={"If-None-Match": '"42-50"'})
+
+    assert response.status_code == 200
+    assert response.headers["ETag"] == 'W/"43-50"'
+
+
 def test_get_messages_unauthorized(client):
     """Test getting messages without authentication."""
     response = client.get("/messages/otheruser")
@@ -9,7 +9,10 @@ import os
 # Add backend to path for imports
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
 
-from auth import hash_password, verify_password, create_jwt_token, verify_jwt_token
+from auth import (
+    hash_password, verify_password, create_jwt_token, verify_jwt_token,
+    create_refresh_token, hash_refresh_token
+)
 import time
 
 
@@ -89,5 +92,16 @@ def test_jwt_token_expiration():
     # In production, you'd advance time and verify it expires after 1 hour
 
 
+def test_refresh_tokens_random_and_hashed():
+    """Test that refresh tokens are unique and hash to a stable storage key."""
+    token1 = create_refresh_token()
+    token2 = create_refresh_token()
+
+    assert token1 != token2
+    assert hash_refresh_token(token1) == hash_refresh_token(token1)
+    assert hash_refresh_token(token1) != hash_refresh_token(token2)
+    assert token1 not in hash_refresh_token(token1)
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
@@ -14,6 +14,23 @@ from importlib import reload
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
 
 
+class FakePipeline:
+    """Records pipelined commands and replays them against the mock client."""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return queue
+
+    async def execute(self, raise_on_error=True):
+        return [await getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+
+
 @pytest.fixture
 def fresh_cache_module():
     """Get a fresh cache module instance for each test."""
@@ -30,6 +47,7 @@ def fresh_cache_module():
     mock_redis.get = AsyncMock()
     mock_redis.delete = AsyncMock()
     mock_redis.aclose = AsyncMock()
+    mock_redis.pipeline = MagicMock(side_effect=lambda transaction=True: FakePipeline(mock_redis))
 
     # Replace the redis_client in the module
     cache.redis_client = mock_redis
@@ -38,8 +56,8 @@ def fresh_cache_module():
 
 
 @pytest.mark.asyncio
-async def test_cache_messages(fresh_cache_module):
-    """Test message caching."""
+async def test_cache_conversation(fresh_cache_module):
+    """Test conversation caching under the shared key with a jittered TTL."""
     cache_module, mock_redis = fresh_cache_module
 
     messages = [
@@ -51,18 +69,18 @@ async def test_cache_messages(fresh_cache_module):
         }
     ]
 
-    await cache_module.cache_messages("alice", messages, ttl=300)
+    await cache_module.cache_conversation("alice", "bob", messages, ttl=300)
 
     # Verify setex was called
     mock_redis.setex.assert_called_once()
     call_args = mock_redis.setex.call_args
-    assert call_args[0][0] == "messages:alice"  # Key
-    assert call_args[0][1] == 300  # TTL
+    assert call_args[0][0] == "conversation:alice:bob"  # Key
+    assert 270 <= call_args[0][1] <= 330  # TTL +/- jitter
 
 
 @pytest.mark.asyncio
-async def test_get_cached_messages(fresh_cache_module):
-    """Test retrieving cached messages."""
+async def test_get_cached_conversation_legacy_json(fresh_cache_module):
+    """Test that entries cached as JSON before the binary format still load."""
     cache_module, mock_redis = fresh_cache_module
 
     # Mock Redis returning cached data
@@ -74,35 +92,26 @@ async def test_get_cached_messages(fresh_cache_module):
     }])
     mock_redis.get.return_value = cached_data
 
-    result = await cache_module.get_cached_messages("alice")
+    result = await cache_module.get_cached_conversation("alice", "bob")
 
     assert result is not None
     assert len(result) == 1
     assert result[0]["sender"] == "alice"
+    assert result[0]["timestamp"] == datetime(2024, 1, 1)
 
 
 @pytest.mark.asyncio
-async def test_get_cached_messages_miss(fresh_cache_module):
+async def test_get_cached_conversation_miss(fresh_cache_module):
     """Test cache miss."""
     cache_module, mock_redis = fresh_cache_module
 
     mock_redis.get.return_value = None
 
-    result = await cache_module.get_cached_messages("alice")
+    result = await cache_module.get_cached_conversation("alice", "bob")
 
     assert result is None
 
 
-@pytest.mark.asyncio
-async def test_invalidate_message_cache(fresh_cache_module):
-    """Test cache invalidation."""
-    cache_module, mock_redis = fresh_cache_module
-
-    await cache_module.invalidate_message_cache("alice")
-
-    mock_redis.delete.assert_called_once_with("messages:alice")
-
-
 @pytest.mark.asyncio
 async def test_cache_jwt_validation(fresh_cache_module):
     """Test JWT validation caching."""
@@ -135,5 +144,184 @@ async def test_invalidate_jwt_cache(fresh_cache_module):
     mock_redis.delete.assert_called_once_with("jwt:token123")
 
 
+@pytest.mark.asyncio
+async def test_cache_empty_conversation_short_ttl(fresh_cache_module):
+    """Test that empty conversations are cached briefly (negative caching)."""
+    cache_module, mock_redis = fresh_cache_module
+
+    await cache_module.cache_conversation("bob", "alice", [], ttl=300)
+
+    call_args = mock_redis.setex.call_args
+    assert call_args[0][0] == "conversation:alice:bob"  # Same key for both users
+    assert call_args[0][1] <= cache_module.EMPTY_CONVERSATION_TTL * (1 + cache_module.TTL_JITTER)
+
+
+@pytest.mark.asyncio
+async def test_get_cached_empty_conversation_is_hit(fresh_cache_module):
+    """Test that a cached empty conversation is a hit, not a miss."""
+    cache_module, mock_redis = fresh_cache_module
+
+    mock_redis.get.return_value = "[]"
+
+    result = await cache_module.get_cached_conversation("alice", "bob")
+
+    assert result == []
+
+
+@pytest.mark.asyncio
+async def test_concurrent_misses_share_one_load(fresh_cache_module):
+    """Test that concurrent cache misses for one conversation hit the DB once."""
+    import asyncio
+    cache_module, mock_redis = fresh_cache_module
+
+    mock_redis.get.return_value = None
+    mock_redis.set = AsyncMock(return_value=True)
+    mock_redis.eval = AsyncMock(return_value=1)
+    loads = 0
+
+    async def loader():
+        nonlocal loads
+        loads += 1
+        await asyncio.sleep(0.01)
+        return []
+
+    results = await asyncio.gather(*[
+        cache_module.get_or_load_conversation("alice", "bob", loader) for _ in range(10)
+    ])
+
+    assert loads == 1
+    assert all(result == [] for result in results)
+    # The lock is released by compare-and-delete with the token it was taken with
+    lock_token = next(call for call in mock_redis.set.call_args_list if call[0][0].startswith("lock:"))[0][1]
+    mock_redis.eval.assert_called_once_with(
+        cache_module._RELEASE_LOCK, 1, "lock:conversation:alice:bob", lock_token
+    )
+
+
+@pytest.mark.asyncio
+async def test_send_during_load_not_shared_or_cached(fresh_cache_module):
+    """Test that a load racing a send is neither joined afterwards nor cached unconditionally."""
+    import asyncio
+    cache_module, mock_redis = fresh_cache_module
+
+    mock_redis.get.side_effect = lambda key: b"7" if key.startswith("version:") else None
+    mock_redis.set = AsyncMock(return_value=True)
+    mock_redis.eval = AsyncMock(return_value=None)
+    release = asyncio.Event()
+    loads = 0
+
+    async def loader():
+        nonlocal loads
+        loads += 1
+        await release.wait()
+        return []
+
+    first = asyncio.ensure_future(cache_module.get_or_load_conversation("alice", "bob", loader))
+    await asyncio.sleep(0.01)
+    await cache_module.invalidate_conversation_cache("bob", "alice")
+    second = asyncio.ensure_future(cache_module.get_or_load_conversation("alice", "bob", loader))
+    await asyncio.sleep(0.01)
+    release.set()
+    await asyncio.gather(first, second)
+
+    assert loads == 2
+    mock_redis.setex.assert_not_called()
+    cache_writes = [call for call in mock_redis.eval.call_args_list if call[0][0] == cache_module._CACHE_IF_CURRENT]
+    assert len(cache_writes) == 2
+    assert all(call[0][2:5] == ("conversation:alice:bob", "version:conversation:alice:bob", "7")
+               for call in cache_writes)
+
+
+@pytest.mark.asyncio
+async def test_loads_only_shared_at_the_same_version(fresh_cache_module):
+    """Test that a caller holding a newer version never joins an older load."""
+    import asyncio
+    cache_module, mock_redis = fresh_cache_module
+
+    mock_redis.get.return_value = None
+    mock_redis.set = AsyncMock(return_value=True)
+    mock_redis.eval = AsyncMock(return_value=1)
+
+    async def loader():
+        await asyncio.sleep(0.01)
+        return []
+
+    def load(version):
+        return cache_module.get_or_load_conversation("alice", "bob", loader, version=version)
+
+    await asyncio.gather(load("5"), load("5"), load("6"))
+
+    cache_writes = [call[0][4] for call in mock_redis.eval.call_args_list
+                    if call[0][0] == cache_module._CACHE_IF_CURRENT]
+    assert sorted(cache_writes) == ["5", "6"]  # One load per version, cached against it
+
+
+@pytest.mark.asyncio
+async def test_batch_writes_single_round_trip(fresh_cache_module):
+    """Test that writes inside batch_writes() go out as one pipeline."""
+    cache_module, mock_redis = fresh_cache_module
+
+    async with cache_module.batch_writes():
+        await cache_module.invalidate_jwt_cache("token1")
+        await cache_module.invalidate_jwt_cache("token2")
+        mock_redis.delete.assert_not_called()  # Deferred until scope exit
+
+    assert mock_redis.delete.call_count == 2
+    stats = cache_module.get_pipeline_stats()
+    assert stats["commands"] == 2
+    assert stats["round_trips"] == 1
+    assert stats["round_trips_saved"] == 1
+
+
+@pytest.mark.asyncio
+async def test_same_tick_reads_are_pipelined(fresh_cache_module):
+    """Test that concurrent reads in the same tick share a round trip."""
+    import asyncio
+    cache_module, mock_redis = fresh_cache_module
+
+    mock_redis.get.return_value = "alice"
+
+    results = await asyncio.gather(
+        cache_module.get_cached_jwt_validation("token1"),
+        cache_module.get_cached_jwt_validation("token2"),
+        cache_module.get_cached_jwt_validation("token3"),
+    )
+
+    assert results == ["alice", "alice", "alice"]
+    assert cache_module.get_pipeline_stats()["round_trips"] == 1
+    await asyncio.sleep(0)
+    assert not cache_module._batch_tasks  # Finished batches are released
+
+
+@pytest.mark.asyncio
+async def test_claim_idempotency_key(fresh_cache_module):
+    """Test that the first claim wins and duplicates see the stored value."""
+    cache_module, mock_redis = fresh_cache_module
+    mock_redis.set = AsyncMock(side_effect=[True, None])
+    mock_redis.get.return_value = cache_module.IDEMPOTENCY_PENDING
+
+    assert await cache_module.claim_idempotency_key("alice", "key-1") is None
+    assert await cache_module.claim_idempotency_key("alice", "key-1") == cache_module.IDEMPOTENCY_PENDING
+
+    key, value = mock_redis.set.call_args[0]
+    assert key == "idempotency:alice:key-1"
+    assert mock_redis.set.call_args[1] == {"nx": True, "ex": cache_module.IDEMPOTENCY_PENDING_TTL}
+    mock_redis.get.assert_called_once_with("idempotency:alice:key-1")
+
+
+@pytest.mark.asyncio
+async def test_version_counter_starts_at_time(fresh_cache_module):
+    """Test that a missing version counter is created in the same round trip as the read."""
+    cache_module, mock_redis = fresh_cache_module
+    mock_redis.set = AsyncMock(return_value=True)
+    mock_redis.get.return_value = b"1700000000000000000"
+
+    version = await cache_module.get_version(cache_module.contacts_version_key("alice"))
+
+    assert version == "1700000000000000000"
+    assert mock_redis.set.call_args[1] == {"nx": True, "ex": cache_module.VERSION_TTL}
+    assert cache_module.get_pipeline_stats()["round_trips"] == 1
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
@@ -0,0 +1,445 @@
+"""
+Tests for the TUI's HTTP client helpers.
+Uses a fake APIClient so no backend is needed.
+"""
+import pytest
+import sys
+import os
+import asyncio
+import time
+import json
+import httpx
+
+# Add chatapp to path for imports
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'chatapp'))
+
+import api
+from api import APIClient, SendQueue, RealtimeClient, AuthenticationError, TokenBucket, RECONNECT_MAX
+
+
+class FakeClient:
+    """Records sends; each takes `delay` seconds and fails for recipients in `failing`."""
+
+    def __init__(self, delay: float = 0.05, failing=()):
+        self.delay = delay
+        self.failing = set(failing)
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.keys = []
+
+    async def send_message(self, recipient, encrypted_content, idempotency_key=None):
+        self.keys.append(idempotency_key)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(self.delay)
+        self.in_flight -= 1
+        if recipient in self.failing:
+            return None
+        return {"status": "sent", "seq": len(self.keys)}
+
+
+@pytest.mark.asyncio
+async def test_sends_run_concurrently():
+    """Test that sends to different recipients are in flight at once."""
+    client = FakeClient()
+    queue = SendQueue(client, concurrency=3)
+    receipts = []
+
+    async def on_done(receipt):
+        receipts.append(receipt)
+
+    for i in range(6):
+        queue.submit(f"peer{i}", f"msg{i}", on_done)
+    await asyncio.wait_for(queue.join(), timeout=1)
+    await queue.close()
+
+    assert len(receipts) == 6
+    assert client.max_in_flight == 3
+    assert len(set(client.keys)) == 6  # One idempotency key per message
+
+
+@pytest.mark.asyncio
+async def test_sends_to_one_recipient_keep_order():
+    """Test that sends to the same recipient go one at a time, in the order queued."""
+    client = FakeClient(delay=0.01)
+    queue = SendQueue(client, concurrency=3)
+    receipts = []
+
+    async def on_done(receipt):
+        receipts.append(receipt)
+
+    for i in range(4):
+        queue.submit("alice", f"msg{i}", on_done, idempotency_key=f"key-{i}")
+    queue.submit("bob", "msg", on_done, idempotency_key="key-bob")
+    await asyncio.wait_for(queue.join(), timeout=1)
+    await queue.close()
+
+    assert len(receipts) == 5
+    assert client.max_in_flight == 2  # Alice's sends one at a time, bob's alongside
+    assert [key for key in client.keys if key != "key-bob"] == [f"key-{i}" for i in range(4)]
+
+
+@pytest.mark.asyncio
+async def test_failed_send_reported():
+    """Test that a send which exhausts its retries completes with None."""
+    queue = SendQueue(FakeClient(failing={"bob"}))
+    receipts = []
+
+    async def on_done(receipt):
+        receipts.append(receipt)
+
+    queue.submit("bob", "msg", on_done)
+    await asyncio.wait_for(queue.join(), timeout=1)
+    await queue.close()
+
+    assert receipts == [None]
+
+
+def outbox(count: int) -> list:
+    return [
+        {"peer": "alice", "encrypted_content": f"encrypted{i}", "idempotency_key": f"key-{i}", "text": "hi"}
+        for i in range(count)
+    ]
+
+
+@pytest.mark.asyncio
+async def test_outbox_sent_in_batches():
+    """Test that the outbox goes out as ordered batch uploads."""
+    client = APIClient()
+    batches = []
+
+    async def send_batch(messages):
+        batches.append([msg["idempotency_key"] for msg in messages])
+        return [{"status": "sent", "seq": int(msg["idempotency_key"][4:])} for msg in messages]
+
+    client.send_batch = send_batch
+    receipts = await client.send_outbox(outbox(25))
+    await client.close()
+
+    assert [len(batch) for batch in batches] == [20, 5]
+    assert [receipt["seq"] for receipt in receipts] == list(range(25))
+
+
+@pytest.mark.asyncio
+async def test_outbox_stops_at_first_failure():
+    """Test that later messages are held back when an earlier one fails."""
+    client = APIClient()
+
+    async def send_batch(messages):
+        return [{"status": "sent"}, {"status": "failed", "detail": "busy"}, {"status": "sent"}]
+
+    client.send_batch = send_batch
+    receipts = await client.send_outbox(outbox(25))
+    await client.close()
+
+    assert receipts[0] is not None
+    assert receipts[1] is None
+    assert all(receipt is None for receipt in receipts[3:])
+
+
+@pytest.mark.asyncio
+async def test_outbox_continues_past_rejected():
+    """Test that a message the server rejects for good doesn't hold back later ones."""
+    client = APIClient()
+
+    async def send_batch(messages):
+        return [{"status": "sent"}, {"status": "rejected", "status_code": 422}, {"status": "sent"}]
+
+    client.send_batch = send_batch
+    receipts = await client.send_outbox(outbox(3))
+    await client.close()
+
+    assert [receipt["status"] for receipt in receipts] == ["sent", "rejected", "sent"]
+
+
+@pytest.mark.asyncio
+async def test_rejected_batch_sent_one_at_a_time():
+    """Test that a batch refused over one bad message is resent singly, rejecting only that one."""
+    def handler(request):
+        if request.url.path == "/messages/batch":
+            return httpx.Response(422, json={"detail": "invalid"})
+        if json.loads(request.content)["recipient"] == "not valid":
+            return httpx.Response(422, json={"detail": "invalid"})
+        return httpx.Response(201, json={"status": "sent", "seq": 1})
+
+    client, paths = counting_client(handler)
+    results = await client.send_batch([
+        {"recipient": recipient, "encrypted_content": "encrypted", "idempotency_key": f"key-{i}"}
+        for i, recipient in enumerate(["alice", "not valid", "alice"])
+    ])
+    await client.close()
+
+    assert [result["status"] for result in results] == ["sent", "rejected", "sent"]
+    assert paths == ["/messages/batch"] + ["/messages"] * 3  # The rejection isn't retried
+
+
+@pytest.mark.asyncio
+async def test_outbox_falls_back_to_single_sends():
+    """Test that a server without the batch endpoint gets one POST per message."""
+    client = APIClient()
+    sent = []
+
+    async def send_batch(messages):
+        client.batch_supported = False
+        return None
+
+    async def send_message(recipient, encrypted_content, idempotency_key=None):
+        sent.append(idempotency_key)
+        return {"status": "sent"}
+
+    client.send_batch = send_batch
+    client.send_message = send_message
+    receipts = await client.send_outbox(outbox(3))
+    await client.close()
+
+    assert sent == ["key-0", "key-1", "key-2"]
+    assert all(receipts)
+
+
+@pytest.mark.asyncio
+async def test_token_refreshed_once_before_expiry():
+    """Test that an expiring token is refreshed once, even for concurrent requests."""
+    refreshes = []
+
+    def handler(request):
+        if request.url.path == "/token/refresh":
+            refreshes.append(request.content)
+            return httpx.Response(200, json={
+                "access_token": "access-2", "refresh_token": "refresh-2", "expires_in": 3600
+            })
+        assert request.url.params["token"] == "access-2"
+        return httpx.Response(200, json=["alice"])
+
+    client = APIClient()
+    client.client = httpx.AsyncClient(base_url="http://test", transport=httpx.MockTransport(handler))
+    client.token, client.refresh_token = "access-1", "refresh-1"
+    client.token_expires_at = time.time() + 60  # Inside the refresh margin
+
+    results = await asyncio.gather(client.get_contacts(), client.get_contacts())
+    await client.close()
+
+    assert results == [["alice"], ["alice"]]
+    assert len(refreshes) == 1
+    assert client.refresh_token == "refresh-2"
+
+
+def counting_client(handler):
+    """APIClient whose requests go to `handler`; returns it with the list of request paths."""
+    paths = []
+
+    def record(request):
+        paths.append(request.url.path)
+        return handler(request)
+
+    client = APIClient()
+    client.client = client.http_client(base_url="http://test", transport=httpx.MockTransport(record))
+    client.token = "access-1"
+    return client, paths
+
+
+@pytest.mark.asyncio
+async def test_identical_gets_share_one_request():
+    """Test that concurrent and repeated identical GETs hit the server once."""
+    client, paths = counting_client(lambda request: httpx.Response(200, json=["alice"]))
+
+    first = await asyncio.gather(*(client.get_contacts() for _ in range(5)))
+    again = await client.get_contacts()
+    await client.close()
+
+    assert first == [["alice"]] * 5 and again == ["alice"]
+    assert paths == ["/contacts"]
+
+
+@pytest.mark.asyncio
+async def test_send_invalidates_cached_history():
+    """Test that sending a message drops the cached conversation and lists."""
+    def handler(request):
+        if request.method == "POST":
+            return httpx.Response(201, json={"status": "sent", "seq": 1})
+        return httpx.Response(200, json=[])
+
+    client, paths = counting_client(handler)
+
+    await client.get_messages("alice")
+    await client.get_contacts()
+    await client.send_message("alice", "encrypted")
+    await client.get_messages("alice")
+    await client.get_contacts()
+    await client.close()
+
+    assert paths == ["/messages/alice", "/contacts", "/messages", "/messages/alice", "/contacts"]
+
+
+@pytest.mark.asyncio
+async def test_etag_cache_bounded(monkeypatch):
+    """Test that conditional-GET bodies are capped, dropping the least recently used."""
+    monkeypatch.setattr(api, "ETAG_CACHE_SIZE", 2)
+    client, paths = counting_client(lambda request: httpx.Response(200, json=[], headers={"ETag": 'W/"1-x"'}))
+
+    for after in (1, 2, 1, 3):
+        await client._conditional_get("/messages/alice", {"token": "t", "after_seq": after})
+    await client.close()
+
+    assert [dict(key[1])["after_seq"] for key in client._etag_cache] == [1, 3]
+
+
+def test_bucket_smooths_bursts():
+    """Test that a bucket allows its rate as a burst, then spaces requests out."""
+    bucket = TokenBucket(2, period=1.0)
+    bucket.tokens -= 2
+
+    assert 0.4 < bucket.delay() <= 0.5  # One token refills every half second
+
+
+def test_bucket_honours_server_headers():
+    """Test that an exhausted budget or a Retry-After blocks the bucket."""
+    bucket = TokenBucket(30)
+    bucket.update(200, httpx.Headers({"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": str(time.time() + 20)}))
+    assert 19 < bucket.delay() <= 20
+
+    bucket = TokenBucket(30)
+    bucket.update(429, httpx.Headers({"Retry-After": "7"}))
+    assert 6 < bucket.delay() <= 7
+
+
+@pytest.mark.asyncio
+async def test_rate_limited_get_retried(no_sleep):
+    """Test that a 429 waits out Retry-After and retries instead of failing."""
+    responses = [httpx.Response(429, headers={"Retry-After": "3"}), httpx.Response(200, json=["alice"])]
+    client, paths = counting_client(lambda request: responses.pop(0))
+
+    contacts = await client.get_contacts()
+    await client.close()
+
+    assert contacts == ["alice"]
+    assert paths == ["/contacts", "/contacts"]
+
+
+def test_bucket_charges_cost():
+    """Test that a request costing several tokens waits for all of them, capped at capacity."""
+    bucket = TokenBucket(2, period=1.0)
+    bucket.tokens -= 1
+
+    assert 0.4 < bucket.delay(2) <= 0.5
+    assert 0.4 < bucket.delay(20) <= 0.5  # More than the capacity waits for a full bucket
+
+
+@pytest.mark.asyncio
+async def test_batch_shares_send_bucket():
+    """Test that a batch upload spends /messages tokens, one per message."""
+    def handler(request):
+        count = len(json.loads(request.content)["messages"])
+        return httpx.Response(201, json={"results": [{"status": "sent", "seq": i} for i in range(count)]})
+
+    client, paths = counting_client(handler)
+    bucket = client.rate_limits[("POST", "/messages")]
+
+    await client.send_batch([
+        {"recipient": "alice", "encrypted_content": f"msg{i}", "idempotency_key": f"key-{i}"} for i in range(5)
+    ])
+    await client.close()
+
+    assert client.rate_limits[("POST", "/messages/batch")] is bucket
+    assert 24 < bucket.tokens < 26
+
+
+class ScriptedClient(RealtimeClient):
+    """Runs each session from a script: an exception to raise, or "ok" to connect then drop."""
+
+    def __init__(self, script, **kwargs):
+        super().__init__("bob", "token-1", None, **kwargs)
+        self.script = list(script)
+        self.tokens = []
+
+    async def _session(self, started):
+        self.tokens.append(self.token)
+        if not self.script:
+            self.running = False
+            return
+        step = self.script.pop(0)
+        if step == "ok":
+            self._connected(started)
+            return
+        raise step
+
+
+def test_realtime_client_needs_a_transport():
+    """Test that the base client can't be used without a _session implementation."""
+    with pytest.raises(TypeError):
+        RealtimeClient("bob", "token-1", None)
+
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    """Record backoff ceilings instead of sleeping."""
+    ceilings = []
+
+    async def sleep(delay):
+        pass
+
+    monkeypatch.setattr(api.random, "uniform", lambda low, high: ceilings.append(high) or high)
+    monkeypatch.setattr(api.asyncio, "sleep", sleep)
+    return ceilings
+
+
+@pytest.mark.asyncio
+async def test_on_connect_task_held():
+    """Test that the on_connect call is kept referenced until it finishes, and cancellable."""
+    started = asyncio.Event()
+
+    async def on_connect():
+        started.set()
+        await asyncio.sleep(60)
+
+    client = ScriptedClient(["ok"], on_connect=on_connect)
+    await client.connect()
+    await started.wait()
+
+    (task,) = client.tasks
+    client._cancel_tasks()
+    await asyncio.gather(task, return_exceptions=True)
+    assert task.cancelled() and not client.tasks
+
+
+@pytest.mark.asyncio
+async def test_reconnect_backoff_grows_and_caps(no_sleep):
+    """Test exponential, capped backoff between failed connects, and the metrics."""
+    states = []
+    client = ScriptedClient([OSError("refused")] * 8 + ["ok"], on_state_change=states.append)
+
+    await client.connect()
+
+    assert no_sleep[:7] == [1, 2, 4, 8, 16, 32, RECONNECT_MAX]
+    assert client.stats["failures"] == 8
+    assert client.stats["connects"] == 1
+    assert "connected" in states and states[-1] == "closed"
+
+
+@pytest.mark.asyncio
+async def test_rejected_token_refreshed(no_sleep):
+    """Test that an auth rejection reconnects with a fresh token from the provider."""
+    async def provider():
+        return "token-2"
+
+    client = ScriptedClient([AuthenticationError(), "ok"], token_provider=provider)
+
+    await client.connect()
+
+    assert client.tokens[:2] == ["token-1", "token-2"]
+    assert client.stats["connects"] == 1
+
+
+@pytest.mark.asyncio
+async def test_rejected_token_without_refresh_stops(no_sleep):
+    """Test that a rejected token with no replacement stops instead of looping."""
+    states = []
+    client = ScriptedClient([AuthenticationError()] * 5, on_state_change=states.append)
+
+    await client.connect()
+
+    assert client.tokens == ["token-1"]
+    assert states[-1] == "auth_failed"
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
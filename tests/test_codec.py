@@ -0,0 +1,88 @@
+"""
+Tests for the binary message cache encoding.
+Verifies round-trips, dropped fields and version handling.
+"""
+import pytest
+import sys
+import os
+from datetime import datetime, timezone
+
+# Add backend to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+from codec import encode_messages, decode_messages, is_encoded, MAGIC
+
+
+def make_messages():
+    return [
+        {
+            "_id": "507f1f77bcf86cd799439011",
+            "sender": "alice",
+            "recipient": "bob",
+            "encrypted_content": "aGVsbG8gYm9i",
+            "timestamp": datetime(2024, 1, 1, 12, 30, 15, 123000),
+            "seq": 41
+        },
+        {
+            "sender": "bob",
+            "recipient": "alice",
+            "encrypted_content": "plain text with ünïcode ✓",
+            "timestamp": datetime(2024, 1, 1, 12, 31, tzinfo=timezone.utc)
+        },
+    ]
+
+
+def test_round_trip():
+    """Test that messages survive encode/decode."""
+    decoded = decode_messages(encode_messages(make_messages()))
+
+    assert len(decoded) == 2
+    assert decoded[0]["sender"] == "alice"
+    assert decoded[0]["recipient"] == "bob"
+    assert decoded[0]["encrypted_content"] == "aGVsbG8gYm9i"
+    # Naive timestamps (as Mongo returns them) are treated as UTC
+    assert decoded[0]["timestamp"] == datetime(2024, 1, 1, 12, 30, 15, 123000, tzinfo=timezone.utc)
+    assert decoded[1]["encrypted_content"] == "plain text with ünïcode ✓"
+    assert decoded[1]["timestamp"] == datetime(2024, 1, 1, 12, 31, tzinfo=timezone.utc)
+
+
+def test_seq_round_trip():
+    """Test that sequence numbers survive and missing ones come back as None."""
+    decoded = decode_messages(encode_messages(make_messages()))
+
+    assert decoded[0]["seq"] == 41
+    assert decoded[1]["seq"] is None
+
+
+def test_id_not_stored():
+    """Test that Mongo's _id is not part of the payload."""
+    data = encode_messages(make_messages())
+
+    assert b"507f1f77bcf86cd799439011" not in data
+    assert "_id" not in decode_messages(data)[0]
+
+
+def test_empty_list():
+    """Test that empty conversations encode (used for negative caching)."""
+    data = encode_messages([])
+
+    assert is_encoded(data)
+    assert decode_messages(data) == []
+
+
+def test_unknown_version_is_miss():
+    """Test that a newer format version decodes to None instead of garbage."""
+    data = bytearray(encode_messages(make_messages()))
+    data[2] = 99  # Version byte
+
+    assert decode_messages(bytes(data)) is None
+
+
+def test_legacy_json_not_detected():
+    """Test that JSON cache entries aren't mistaken for binary ones."""
+    assert not is_encoded(b'[{"sender": "alice"}]')
+    assert encode_messages([])[:2] == MAGIC
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,101 @@
+"""
+Tests for the MongoDB data layer.
+Runs against mocked or in-memory (mongomock) collections, so no database server is needed.
+"""
+import pytest
+import sys
+import os
+from datetime import datetime, timedelta, timezone
+from unittest.mock import AsyncMock, MagicMock
+from mongomock_motor import AsyncMongoMockClient
+from pymongo.errors import BulkWriteError
+
+# Add backend to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+
+@pytest.fixture
+def fresh_db_module():
+    """Get a fresh db module (test_api.py replaces it with a mock) with mocked collections."""
+    sys.modules.pop('db', None)
+
+    import db
+
+    db.db = MagicMock()
+    for collection in (db.db.messages, db.db.contacts, db.db.counters):
+        collection.insert_many = AsyncMock()
+        collection.bulk_write = AsyncMock()
+    return db
+
+
+@pytest.fixture
+def mongo_db_module():
+    """Get a fresh db module backed by an in-memory database."""
+    sys.modules.pop('db', None)
+
+    import db
+
+    db.db = AsyncMongoMockClient()["chatapp"]
+    return db
+
+
+def duplicate(index: int, key_pattern: dict) -> dict:
+    return {"index": index, "code": 11000, "keyPattern": key_pattern, "errmsg": "E11000 duplicate key error"}
+
+
+@pytest.mark.asyncio
+async def test_replayed_ids_ignored(fresh_db_module):
+    """Test that messages already written by an earlier attempt don't fail the batch."""
+    db = fresh_db_module
+    messages = [db.new_message("alice", "bob", f"ciphertext{i}", seq=i + 1) for i in range(2)]
+    db.db.messages.insert_many.side_effect = BulkWriteError({"writeErrors": [duplicate(0, {"_id": 1})]})
+
+    await db.save_messages(messages)
+
+    db.db.contacts.bulk_write.assert_awaited_once()
+    db.db.counters.bulk_write.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_taken_seq_raised(fresh_db_module):
+    """Test that a seq collision is reported, and only stored messages update contacts and counters."""
+    db = fresh_db_module
+    messages = [db.new_message("alice", "bob", f"ciphertext{i}", seq=i + 1) for i in range(2)]
+    db.db.messages.insert_many.side_effect = BulkWriteError({"writeErrors": [
+        duplicate(1, {"conversation": 1, "seq": 1})
+    ]})
+
+    with pytest.raises(db.SequenceConflictError) as raised:
+        await db.save_messages(messages)
+
+    assert raised.value.messages == [messages[1]]
+    counters = db.db.counters.bulk_write.call_args[0][0]
+    assert [update._doc for update in counters] == [{"$max": {"seq": 1}}]
+
+
+@pytest.mark.asyncio
+async def test_other_duplicates_raised(fresh_db_module):
+    """Test that a duplicate on any other index is raised as it is."""
+    db = fresh_db_module
+    db.db.messages.insert_many.side_effect = BulkWriteError({"writeErrors": [duplicate(0, {"other": 1})]})
+
+    with pytest.raises(BulkWriteError):
+        await db.save_messages([db.new_message("alice", "bob", "ciphertext", seq=1)])
+
+    db.db.contacts.bulk_write.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_reused_refresh_token_revokes_family(mongo_db_module):
+    """Test that replaying an already-rotated refresh token revokes its whole family."""
+    db = mongo_db_module
+    expires_at = datetime.now(timezone.utc) + timedelta(days=1)
+    await db.create_refresh_token("alice", "hash-1", "family-1", expires_at)
+    await db.create_refresh_token("alice", "other-1", "family-2", expires_at)  # Another login
+
+    assert await db.rotate_refresh_token("hash-1", "hash-2", expires_at) == "alice"
+    assert await db.rotate_refresh_token("hash-1", "hash-3", expires_at) is None  # Replayed
+
+    assert await db.db.refresh_tokens.count_documents({"family": "family-1"}) == 0
+    assert await db.rotate_refresh_token("hash-2", "hash-4", expires_at) is None  # The live token went too
+    assert await db.rotate_refresh_token("other-1", "other-2", expires_at) == "alice"
@@ -0,0 +1,256 @@
+"""
+Tests for the TUI's real-time event dispatcher.
+Uses a fake chat screen, so no Textual app or connection is needed.
+"""
+import pytest
+import sys
+import os
+import json
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+
+# Add chatapp to path for imports
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'chatapp'))
+
+import dispatcher as dispatcher_module
+from dispatcher import EventDispatcher
+from screens import ChatScreen
+
+
+class FakeChat:
+    """Stands in for an open ChatScreen, recording what the dispatcher routes to it."""
+
+    def __init__(self, other_user: str = "alice"):
+        self.other_user = other_user
+        self.outgoing = {}  # Idempotency key -> bubble, as on ChatScreen
+        self.events = []
+        self.settled = []
+        self.states = []
+
+    def show_connection_state(self, state):
+        self.states.append(state)
+
+    async def on_message_event(self, data):
+        self.events.append(data)
+
+    def on_send_done(self, key, encrypted, receipt):
+        self.settled.append((key, receipt))
+
+
+def event(seq: int, sender: str = "alice") -> str:
+    return json.dumps({
+        "type": "new_message", "sender": sender, "encrypted_content": f"encrypted{seq}",
+        "timestamp": "2024-01-01T12:00:00", "seq": seq
+    })
+
+
+@pytest.fixture
+def local_store(monkeypatch):
+    local_store = MagicMock()
+    monkeypatch.setattr(dispatcher_module.store, "local_store", local_store)
+    return local_store
+
+
+@pytest.mark.asyncio
+async def test_events_buffered_until_taken():
+    """Test that events for a closed chat are buffered, reported to listeners and taken once."""
+    dispatcher = EventDispatcher()
+    heard = []
+    dispatcher.add_listener(lambda peer, data: heard.append((peer, data["seq"])))
+
+    for seq in (1, 2):
+        await dispatcher.handle(event(seq))
+    await dispatcher.handle("not json")
+    await dispatcher.handle(json.dumps({"type": "typing", "sender": "alice"}))
+
+    events, complete = dispatcher.take("alice")
+    assert [data["seq"] for data in events] == [1, 2]
+    assert complete
+    assert heard == [("alice", 1), ("alice", 2)]
+    assert dispatcher.take("alice") == ([], True)
+
+
+@pytest.mark.asyncio
+async def test_overflowed_buffer_incomplete(monkeypatch):
+    """Test that a buffer that dropped events is reported incomplete, once."""
+    monkeypatch.setattr(dispatcher_module, "BUFFER_SIZE", 3)
+    dispatcher = EventDispatcher()
+
+    for seq in range(1, 6):
+        await dispatcher.handle(event(seq))
+
+    events, complete = dispatcher.take("alice")
+    assert [data["seq"] for data in events] == [3, 4, 5]
+    assert not complete
+    assert dispatcher.take("alice") == ([], True)
+
+
+@pytest.mark.asyncio
+async def test_events_routed_to_attached_chat():
+    """Test that the open chat gets its peer's events and other peers' are buffered."""
+    dispatcher = EventDispatcher()
+    chat = FakeChat("alice")
+    await dispatcher.handle(event(1))
+
+    assert dispatcher.attach(chat) == ([json.loads(event(1))], True)
+    await dispatcher.handle(event(2))
+    await dispatcher.handle(event(1, sender="bob"))
+    dispatcher.detach(chat)
+    await dispatcher.handle(event(3))
+
+    assert [data["seq"] for data in chat.events] == [2]
+    assert chat.states == ["closed"]
+    assert [data["seq"] for data in dispatcher.take("bob")[0]] == [1]
+    assert [data["seq"] for data in dispatcher.take("alice")[0]] == [3]
+
+
+@pytest.mark.asyncio
+async def test_replayed_events_dropped():
+    """Test that an event repeated by a resumed connection is routed once."""
+    dispatcher = EventDispatcher()
+    chat = FakeChat("alice")
+    dispatcher.attach(chat)
+
+    for seq in (1, 2, 1, 2, 3):
+        await dispatcher.handle(event(seq))
+
+    assert [data["seq"] for data in chat.events] == [1, 2, 3]
+
+
+@pytest.mark.asyncio
+async def test_chat_attached_while_history_loads(local_store):
+    """Test that sends and events during a history load reach the chat, not the store or buffer."""
+    dispatcher = EventDispatcher()
+    chat = FakeChat("alice")
+    dispatcher.attach(chat)  # ChatScreen.load_history attaches before fetching
+    chat.outgoing["key-1"] = ("message", "bubble")  # Sent while the fetch was in flight
+    receipt = {"status": "sent", "timestamp": "2024-01-01T12:00:00", "seq": 4}
+
+    dispatcher.settle_send("alice", "key-1", "encrypted", "hi", receipt)
+    await dispatcher.handle(event(5))
+
+    assert chat.settled == [("key-1", receipt)]
+    assert [data["seq"] for data in chat.events] == [5]
+    assert dispatcher.take("alice") == ([], True)
+    local_store.save.assert_not_called()
+
+
+def test_send_settled_to_store_without_chat(local_store):
+    """Test that a send finishing with no chat open moves from the outbox to the history."""
+    dispatcher = EventDispatcher()
+    receipt = {"status": "sent", "timestamp": "2024-01-01T12:00:00", "seq": 4}
+
+    dispatcher.settle_send("alice", "key-1", "encrypted", "hi", receipt)
+    dispatcher.settle_send("alice", "key-2", "encrypted", "hi", None)
+
+    local_store.remove_outgoing.assert_called_once_with(["key-1"])
+    (peer, messages), _ = local_store.save.call_args
+    assert peer == "alice" and messages[0]["seq"] == 4 and messages[0]["text"] == "hi"
+
+
+def test_rejected_send_dropped_from_outbox(local_store):
+    """Test that a send the server rejected leaves the outbox without entering the history."""
+    dispatcher = EventDispatcher()
+
+    dispatcher.settle_send("alice", "key-1", "encrypted", "hi", {"status": "rejected", "status_code": 422})
+
+    local_store.remove_outgoing.assert_called_once_with(["key-1"])
+    local_store.save.assert_not_called()
+    assert dispatcher.flush_retry is None
+
+
+@pytest.mark.asyncio
+async def test_failed_send_retries_outbox(local_store, monkeypatch):
+    """Test that a send failing while connected schedules an outbox flush, backing off."""
+    monkeypatch.setattr(dispatcher_module.random, "uniform", lambda low, high: 0)
+    local_store.outbox.return_value = [
+        {"peer": "alice", "idempotency_key": "key-1", "encrypted_content": "encrypted", "text": "hi"}
+    ]
+    receipt = {"status": "sent", "timestamp": "2024-01-01T12:00:00", "seq": 4}
+    send_outbox = AsyncMock(side_effect=[[None], [receipt]])
+    monkeypatch.setattr(dispatcher_module.api_client, "send_outbox", send_outbox)
+    dispatcher = EventDispatcher()
+    dispatcher.client = MagicMock()  # Connected
+
+    dispatcher.settle_send("alice", "key-1", "encrypted", "hi", None)
+    dispatcher.settle_send("alice", "key-2", "encrypted", "hi", None)  # Covered by the same retry
+    while dispatcher.tasks:
+        await asyncio.gather(*dispatcher.tasks)
+
+    assert send_outbox.await_count == 2  # The first retry failed, so a second was scheduled
+    local_store.remove_outgoing.assert_called_once_with(["key-1"])
+    assert dispatcher.flush_failures == 0
+
+
+@pytest.mark.asyncio
+async def test_connection_task_held_until_stop(monkeypatch):
+    """Test that the connection's task is kept referenced, and cancelled by stop()."""
+    connection = MagicMock()
+    connection.connect = AsyncMock(side_effect=lambda: asyncio.sleep(60))
+    connection.disconnect = AsyncMock()
+    monkeypatch.setattr(dispatcher_module, "create_realtime_client", lambda *args, **kwargs: connection)
+    dispatcher = EventDispatcher()
+
+    await dispatcher.start()
+    (task,) = dispatcher.tasks
+    await dispatcher.stop()
+    await asyncio.gather(task, return_exceptions=True)
+
+    assert task.cancelled()
+    connection.disconnect.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_fresh_token_reuses_rotated_token(monkeypatch):
+    """Test that a reconnect only rotates the refresh token if nobody else has already."""
+    refresh_session = AsyncMock(return_value=True)
+    monkeypatch.setattr(dispatcher_module.api_client, "refresh_session", refresh_session)
+    monkeypatch.setattr(dispatcher_module.api_client, "token", "access-2")
+    dispatcher = EventDispatcher()
+    dispatcher.client = SimpleNamespace(token="access-1")  # The token the server rejected
+
+    assert await dispatcher.fresh_token() == "access-2"
+    refresh_session.assert_not_awaited()
+
+    dispatcher.client.token = "access-2"
+    await dispatcher.fresh_token()
+    refresh_session.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_mark_read_coalesced(monkeypatch):
+    """Test that a burst of mark_read calls for a peer costs one request."""
+    monkeypatch.setattr(dispatcher_module, "READ_DELAY", 0)
+    mark_read = AsyncMock(return_value=True)
+    monkeypatch.setattr(dispatcher_module.api_client, "mark_read", mark_read)
+    dispatcher = EventDispatcher()
+
+    for _ in range(3):
+        dispatcher.mark_read("alice")
+    dispatcher.mark_read("bob")
+    await asyncio.gather(*dispatcher.tasks)
+    dispatcher.mark_read("alice")
+    await asyncio.gather(*dispatcher.tasks)
+
+    assert [call.args[0] for call in mark_read.await_args_list] == ["alice", "bob", "alice"]
+
+
+@pytest.mark.asyncio
+async def test_loading_chat_holds_events():
+    """Test that a chat still loading its history holds new events back."""
+    chat = SimpleNamespace(loading=True, held_events=[])
+
+    await ChatScreen.on_message_event(chat, json.loads(event(1)))
+
+    assert [data["seq"] for data in chat.held_events] == [1]
+
+
+def test_buffered_events_continue_history():
+    """Test that buffered events stand in for a fetch only when they follow on without a gap."""
+    events = [{"seq": seq} for seq in (4, 5, 6)]
+
+    assert ChatScreen.continues(3, events)
+    assert not ChatScreen.continues(2, events)
+    assert not ChatScreen.continues(3, [])
+    assert ChatScreen.continues(None, [{"seq": 1}])
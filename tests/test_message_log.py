@@ -0,0 +1,108 @@
+"""
+Tests for the TUI's virtualized message log.
+Runs MessageLog in a bare Textual app with App.run_test(), so no backend is needed.
+"""
+import pytest
+import sys
+import os
+
+from textual.app import App, ComposeResult
+
+# Add chatapp to path for imports
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'chatapp'))
+
+from screens import MessageLog
+
+
+class LogApp(App):
+    CSS = "MessageLog { height: 1fr; }"
+
+    def compose(self) -> ComposeResult:
+        yield MessageLog(id="messages")
+
+
+async def settle(pilot):
+    """Let queued refreshes and the scrolls deferred until after them run."""
+    for _ in range(3):
+        await pilot.pause()
+
+
+def message(i: int, text: str = "hello", status: str = "sent") -> tuple:
+    return ("alice", f"{text} {i}", "2024-01-01T12:00:00", True, status)
+
+
+@pytest.mark.asyncio
+async def test_only_visible_entries_rendered():
+    """Test that a long log renders just the entries in view, but sizes for all of them."""
+    async with LogApp().run_test(size=(60, 20)) as pilot:
+        log = pilot.app.query_one(MessageLog)
+        log.add_messages([message(i) for i in range(200)])
+        await settle(pilot)
+
+        rendered = [index for index, strips in enumerate(log._strips) if strips is not None]
+        assert 0 < len(rendered) < 15  # A screenful or two, not 200
+        assert 199 in rendered
+        assert log.virtual_size.height == sum(log._heights) == log._offsets[-1] + log._heights[-1]
+
+
+@pytest.mark.asyncio
+async def test_offsets_follow_height_changes():
+    """Test that a bubble changing height moves every later entry, and a status change re-renders it."""
+    async with LogApp().run_test(size=(60, 20)) as pilot:
+        log = pilot.app.query_one(MessageLog)
+        first, second, _ = [log.add_messages([message(i, status="queued")]) for i in range(3)]
+        await settle(pilot)
+        height = log._heights[1]
+
+        second = log.update_message(second, message(1, "a much longer line of text " * 10, status="queued"))
+        assert log._heights[1] > height
+        assert log._offsets[2] == log._offsets[1] + log._heights[1]
+        assert log.virtual_size.height == sum(log._heights)
+
+        await settle(pilot)
+        offsets = list(log._offsets)
+        log.update_message(second, message(1, "a much longer line of text " * 10, status="failed"))
+        assert log._strips[1] is None  # Redrawn with the new mark
+        assert log._offsets == offsets
+
+        log.remove(first)
+        assert log._offsets[0] == 0 and log.message_count == 2
+        assert log.virtual_size.height == sum(log._heights)
+
+
+@pytest.mark.asyncio
+async def test_sticks_to_bottom_only_when_there():
+    """Test that new messages keep a bottom-scrolled log at the bottom, but don't move a reader."""
+    async with LogApp().run_test(size=(60, 20)) as pilot:
+        log = pilot.app.query_one(MessageLog)
+        log.add_messages([message(i) for i in range(50)])
+        await settle(pilot)
+        assert log.scroll_y == log.max_scroll_y > 0
+
+        log.add_messages([message(50)])
+        await settle(pilot)
+        assert log.scroll_y == log.max_scroll_y
+
+        log.scroll_to(y=10, animate=False)
+        await settle(pilot)
+        log.add_messages([message(51)])
+        await settle(pilot)
+        assert log.scroll_y == 10
+
+
+@pytest.mark.asyncio
+async def test_older_history_inserted_above_view():
+    """Test that a batch inserted above the view shifts the scroll so the lines in view stay put."""
+    async with LogApp().run_test(size=(60, 20)) as pilot:
+        log = pilot.app.query_one(MessageLog)
+        oldest = log.add_messages([message(i) for i in range(50)])
+        await settle(pilot)
+        log.scroll_to(y=40, animate=False)
+        await settle(pilot)
+        in_view = log.render_line(0).text
+
+        log.add_messages([message(i, "older") for i in range(3)], before=oldest)
+        await settle(pilot)
+
+        assert log.scroll_y == 40 + sum(log._heights[:3])
+        assert log.render_line(0).text == in_view
@@ -0,0 +1,126 @@
+"""
+Tests for the ASGI middleware: response compression and request body limits.
+Runs minimal apps wrapped in each middleware.
+"""
+import pytest
+import sys
+import os
+import json
+
+# Add backend to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+from fastapi import FastAPI
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from middleware import CompressionMiddleware, BodySizeLimitMiddleware, negotiate
+
+HISTORY = [{"sender": "alice", "encrypted_content": "aGVsbG8=" * 20, "seq": i} for i in range(100)]
+
+
+async def history(request):
+    return JSONResponse(HISTORY)
+
+
+async def small(request):
+    return JSONResponse({"status": "online"})
+
+
+async def events(request):
+    async def stream():
+        yield "data: " + "x" * 4096 + "\n\n"
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+
+@pytest.fixture
+def client():
+    app = Starlette(routes=[Route("/history", history), Route("/small", small), Route("/events", events)])
+    app.add_middleware(CompressionMiddleware, minimum_size=1024, encodings="gzip")
+    return TestClient(app)
+
+
+def test_large_response_gzipped(client):
+    """Test that a large JSON body is gzipped when the client accepts it."""
+    response = client.get("/history", headers={"Accept-Encoding": "gzip"})
+
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert int(response.headers["Content-Length"]) < len(json.dumps(HISTORY))
+    assert response.json() == HISTORY  # Decompressed transparently by the client
+
+
+def test_small_response_not_compressed(client):
+    """Test that bodies under the threshold are sent as-is."""
+    response = client.get("/small", headers={"Accept-Encoding": "gzip"})
+
+    assert "Content-Encoding" not in response.headers
+    assert response.json() == {"status": "online"}
+
+
+def test_no_accept_encoding_not_compressed(client):
+    """Test that clients which don't accept gzip get plain bodies."""
+    response = client.get("/history", headers={"Accept-Encoding": "identity"})
+
+    assert "Content-Encoding" not in response.headers
+    assert response.json() == HISTORY
+
+
+def test_event_stream_not_compressed(client):
+    """Test that SSE responses are never buffered for compression."""
+    response = client.get("/events", headers={"Accept-Encoding": "gzip"})
+
+    assert "Content-Encoding" not in response.headers
+    assert response.text.startswith("data: ")
+
+
+def test_negotiate_respects_preference_and_q():
+    """Test Accept-Encoding negotiation."""
+    assert negotiate("gzip, br", ["zstd", "br", "gzip"]) == "br"
+    assert negotiate("br;q=0, gzip;q=0.5", ["br", "gzip"]) == "gzip"
+    assert negotiate("*", ["gzip"]) == "gzip"
+    assert negotiate("identity", ["gzip"]) is None
+
+
+@pytest.fixture
+def limited_client():
+    app = FastAPI()
+
+    @app.post("/echo")
+    async def echo(payload: dict):
+        return {"size": len(payload["data"])}
+
+    app.add_middleware(BodySizeLimitMiddleware, default_limit=64, route_limits={"/echo": 1024})
+    return TestClient(app)
+
+
+def test_body_within_limit(limited_client):
+    """Test that bodies under the route's budget are processed normally."""
+    response = limited_client.post("/echo", json={"data": "x" * 500})
+
+    assert response.status_code == 200
+    assert response.json() == {"size": 500}
+
+
+def test_declared_oversized_body_rejected(limited_client):
+    """Test that an oversized Content-Length is rejected with 413."""
+    response = limited_client.post("/echo", json={"data": "x" * 2000})
+
+    assert response.status_code == 413
+
+
+def test_streamed_oversized_body_rejected(limited_client):
+    """Test that a chunked body without Content-Length is cut off at the limit."""
+    def chunks():
+        for _ in range(10):
+            yield b'{"data": "' + b"x" * 200 + b'"}'
+
+    response = limited_client.post("/echo", content=chunks(), headers={"Content-Type": "application/json"})
+
+    assert response.status_code == 413
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,126 @@
+"""
+Tests for the TUI's local encrypted message store.
+Verifies round-trips, encryption at rest, incremental sync state and pruning.
+"""
+import pytest
+import sys
+import os
+import sqlite3
+from datetime import datetime, timedelta, timezone
+
+# Add chatapp to path for imports
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'chatapp'))
+
+from store import LocalStore, StoreKeyError
+
+
+def make_message(seq: int, text: str = "hello", age: timedelta = timedelta(minutes=5)) -> dict:
+    return {
+        "seq": seq,
+        "sender": "alice",
+        "timestamp": (datetime.now(timezone.utc) - age).isoformat(),
+        "encrypted_content": f"Y2lwaGVy{seq}",
+        "text": text,
+    }
+
+
+@pytest.fixture
+def local_store(tmp_path):
+    store = LocalStore("bob", "correct horse battery", data_dir=str(tmp_path))
+    yield store
+    store.close()
+
+
+def test_save_and_load_round_trip(local_store):
+    """Test that stored messages come back in order with their text."""
+    local_store.save("alice", [make_message(2, "second"), make_message(1, "first")])
+
+    messages = local_store.load("alice")
+
+    assert [msg["seq"] for msg in messages] == [1, 2]
+    assert [msg["text"] for msg in messages] == ["first", "second"]
+    assert messages[0]["encrypted_content"] == "Y2lwaGVy1"
+    assert local_store.load("carol") == []
+
+
+def test_last_seq_for_incremental_fetch(local_store):
+    """Test that last_seq tracks the newest stored message per conversation."""
+    assert local_store.last_seq("alice") == 0
+
+    local_store.save("alice", [make_message(1), make_message(7)])
+
+    assert local_store.last_seq("alice") == 7
+
+
+def test_text_encrypted_at_rest(local_store):
+    """Test that plaintext never appears in the database file."""
+    local_store.save("alice", [make_message(1, "meet at the usual place")])
+
+    with open(local_store.path, "rb") as f:
+        assert b"meet at the usual place" not in f.read()
+
+
+def test_wrong_password_rejected(local_store, tmp_path):
+    """Test that a different password can't open the store."""
+    with pytest.raises(StoreKeyError):
+        LocalStore("bob", "wrong password!", data_dir=str(tmp_path))
+
+
+def test_undecryptable_and_unsequenced_messages(local_store):
+    """Test that messages without text are kept and ones without seq are skipped."""
+    local_store.save("alice", [make_message(1, text=None), {**make_message(2), "seq": None}])
+
+    messages = local_store.load("alice")
+
+    assert len(messages) == 1
+    assert messages[0]["text"] is None
+
+
+def test_undecrypted_copy_keeps_stored_text(local_store):
+    """Test that saving a message without text doesn't erase text stored for it."""
+    local_store.save("alice", [make_message(1, "hello")])
+    local_store.save("alice", [make_message(1, text=None)])
+    assert local_store.load("alice")[0]["text"] == "hello"
+
+    local_store.save("alice", [make_message(2, text=None)])
+    local_store.save("alice", [make_message(2, "decrypted later")])
+    assert local_store.load("alice")[1]["text"] == "decrypted later"
+
+
+def test_prune_removes_expired(local_store):
+    """Test that messages past the 24h retention are deleted."""
+    local_store.save("alice", [make_message(1, age=timedelta(hours=25)), make_message(2)])
+
+    assert local_store.prune() == 1
+    assert [msg["seq"] for msg in local_store.load("alice")] == [2]
+
+
+def test_rows_bound_to_their_position(local_store):
+    """Test that a sealed row moved to another seq no longer decrypts."""
+    local_store.save("alice", [make_message(1, "one")])
+    db = sqlite3.connect(local_store.path)
+    with db:
+        db.execute("UPDATE messages SET seq = 5 WHERE seq = 1")
+    db.close()
+
+    assert local_store.load("alice")[0]["text"] is None
+
+
+def test_outbox_keeps_send_order(local_store):
+    """Test that queued messages come back oldest first, sealed, until removed."""
+    local_store.queue_outgoing("alice", "key-1", "Y2lwaGVy1", "first", "2024-01-01T12:00:00")
+    local_store.queue_outgoing("carol", "key-2", "Y2lwaGVy2", "second", "2024-01-01T12:01:00")
+    local_store.queue_outgoing("alice", "key-3", "Y2lwaGVy3", "third", "2024-01-01T12:02:00")
+
+    assert [msg["idempotency_key"] for msg in local_store.outbox()] == ["key-1", "key-2", "key-3"]
+    assert [msg["text"] for msg in local_store.outbox("alice")] == ["first", "third"]
+    with open(local_store.path, "rb") as f:
+        assert b"second" not in f.read()
+
+    local_store.remove_outgoing(["key-1", "key-2"])
+
+    assert [msg["idempotency_key"] for msg in local_store.outbox()] == ["key-3"]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
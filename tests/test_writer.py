@@ -0,0 +1,142 @@
+"""
+Tests for the write-behind message writer.
+Runs the in-process queue mode with the database layer replaced.
+"""
+import pytest
+import sys
+import os
+import asyncio
+from itertools import count
+from unittest.mock import AsyncMock, MagicMock
+
+# Add backend to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+
+@pytest.fixture
+def fresh_writer_module():
+    """Get a fresh writer module with Redis disabled and saves recorded."""
+    for module in ('writer', 'cache', 'db'):
+        sys.modules.pop(module, None)
+
+    import writer
+
+    writer.cache.redis_client = None
+    writer.save_messages = AsyncMock()
+    sequence = count(1)
+    writer.next_sequence = AsyncMock(side_effect=lambda *_: next(sequence))
+    return writer
+
+
+@pytest.mark.asyncio
+async def test_messages_flushed_in_one_batch(fresh_writer_module):
+    """Test that messages queued together are written with one insert."""
+    writer = fresh_writer_module
+    message_writer = writer.MessageWriter(enabled=True)
+    await message_writer.start()
+
+    for i in range(5):
+        doc = await message_writer.enqueue("alice", "bob", f"ciphertext{i}")
+        assert doc["_id"] is not None
+
+    await asyncio.sleep(0.1)
+    await message_writer.stop()
+
+    writer.save_messages.assert_awaited_once()
+    batch = writer.save_messages.call_args[0][0]
+    assert [msg["encrypted_content"] for msg in batch] == [f"ciphertext{i}" for i in range(5)]
+
+    stats = message_writer.get_stats()
+    assert stats["mode"] == "memory"
+    assert stats["flushes"] == 1
+    assert stats["last_batch_size"] == 5
+
+
+@pytest.mark.asyncio
+async def test_queue_depth_is_bounded(fresh_writer_module):
+    """Test that enqueue fails fast once the queue is full."""
+    writer = fresh_writer_module
+    writer.MAX_DEPTH = 2
+    message_writer = writer.MessageWriter(enabled=True)
+    await message_writer.start()
+
+    await message_writer.enqueue("alice", "bob", "one")
+    await message_writer.enqueue("alice", "bob", "two")
+    with pytest.raises(writer.QueueFullError):
+        await message_writer.enqueue("alice", "bob", "three")
+
+    await message_writer.stop()
+    assert message_writer.get_stats()["rejected"] == 1
+
+
+@pytest.mark.asyncio
+async def test_durable_enqueue_allocates_seq_in_redis(fresh_writer_module):
+    """Test that stream mode takes seqs from a Redis counter seeded once from MongoDB."""
+    writer = fresh_writer_module
+    redis = MagicMock()
+    redis.eval = AsyncMock(side_effect=[None, 8, 9])  # Missing counter, seeded, then warm
+    pipeline = MagicMock()
+    pipeline.execute = AsyncMock(return_value=[0, b"1-0"])
+    redis.pipeline = MagicMock(return_value=pipeline)
+    writer.cache.redis_client = redis
+    writer.current_sequence = AsyncMock(return_value=7)
+    message_writer = writer.MessageWriter(enabled=True)
+    message_writer.durable = True
+
+    first = await message_writer.enqueue("bob", "alice", "one")
+    second = await message_writer.enqueue("alice", "bob", "two")
+
+    assert (first["seq"], second["seq"]) == (8, 9)
+    writer.next_sequence.assert_not_awaited()
+    writer.current_sequence.assert_awaited_once_with("bob", "alice")
+    assert redis.eval.call_args_list[1][0][2:4] == ("sequence:alice:bob", 7)
+
+
+@pytest.mark.asyncio
+async def test_flush_renumbers_taken_seqs(fresh_writer_module):
+    """Test that messages whose seq turns out to be taken are stored under fresh ones, not dropped."""
+    writer = fresh_writer_module
+    message_writer = writer.MessageWriter(enabled=True)
+    batch = [writer.new_message("alice", "bob", f"ciphertext{i}", seq=i + 1) for i in range(2)]
+    saved = []
+
+    async def save_messages(messages):
+        saved.append([msg["seq"] for msg in messages])
+        if len(saved) == 1:
+            raise writer.SequenceConflictError([messages[1]])
+
+    writer.save_messages = save_messages
+    writer.next_sequence = AsyncMock(return_value=5)
+    await message_writer._flush(batch)
+
+    assert saved == [[1, 2], [5]]
+    assert message_writer.get_stats()["flushed"] == 2
+
+
+@pytest.mark.asyncio
+async def test_failed_start_leaves_writer_stopped(fresh_writer_module):
+    """Test that a writer whose stream can't be set up doesn't accept messages."""
+    writer = fresh_writer_module
+    writer.cache.redis_client = MagicMock()
+    writer.cache.redis_client.xgroup_create = AsyncMock(side_effect=ConnectionError("unreachable"))
+    message_writer = writer.MessageWriter(enabled=True)
+
+    with pytest.raises(ConnectionError):
+        await message_writer.start()
+
+    assert not message_writer.running
+    assert message_writer._task is None
+
+
+@pytest.mark.asyncio
+async def test_disabled_writer_does_not_start(fresh_writer_module):
+    """Test that write-behind stays off unless enabled."""
+    message_writer = fresh_writer_module.MessageWriter(enabled=False)
+    await message_writer.start()
+
+    assert not message_writer.running
+    assert message_writer.get_stats()["mode"] == "off"
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])